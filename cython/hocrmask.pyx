@@ -0,0 +1,348 @@
+# Thresholding of the word boxes of the hOCR mask, in C.
+#
+# This computes the same as create_hocr_mask used to do per word in Python:
+#
+# 1. Local (gaussian, like skimage's threshold_local) and Otsu (like skimage's
+#    threshold_otsu) thresholding of the word image, combined with 'and'
+# 2. The noise estimate of the result (like skimage's estimate_sigma: the
+#    median absolute value of the non-zero diagonal db2 wavelet detail
+#    coefficients, with the transform of the noise module)
+# 3. For noisy words, the same for the inverted word image, and the choice of
+#    polarity
+#
+# The floating point operations are done in the same order as scipy, skimage
+# and PyWavelets do them, so that the resulting mask is exactly the same. This
+# module must not be compiled with -ffast-math.
+#
+# All words are thresholded in parallel (OpenMP) without holding the GIL, and
+# then written to the mask in order, since word boxes can overlap.
+#
+# License: AGPL-v3
+
+import numpy as np
+cimport cython
+from cython.parallel cimport prange
+from libc.math cimport sqrt
+from libc.stdint cimport int64_t
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+
+from noise cimport _dec_hi, _median
+
+# Length of the db2 wavelet filters
+cdef int DB2_LEN = 4
+
+# scipy.stats.norm.ppf(0.75)
+cdef double NORM_PPF_075 = 0.6744897501960817
+
+# Words with a higher noise estimate are also thresholded inverted
+cdef double NOISE_THRESHOLD = 0.1
+
+
+cdef inline int _reflect(int i, int n) noexcept nogil:
+    # Index i in a line of length n extended like scipy.ndimage's 'reflect'
+    # mode (d c b a | a b c d | d c b a)
+    i = i % (2 * n)
+    if i < 0:
+        i += 2 * n
+    if i >= n:
+        i = 2 * n - 1 - i
+    return i
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _correlate_line(const double *line, double *out, int n, int stride,
+                          const double *weights, int radius) noexcept nogil:
+    # scipy.ndimage.correlate1d with a symmetric weights (of 2 * radius + 1)
+    # and 'reflect' mode, of the n values line[0], line[stride], ...
+    cdef int i, j
+    cdef double acc
+    cdef const double *w = weights + radius
+
+    cdef const double *px
+
+    for i in range(n):
+        acc = line[<int64_t>i * stride] * w[0]
+        if i >= radius and i + radius < n:
+            # No reflection needed
+            px = line + <int64_t>i * stride
+            for j in range(-radius, 0):
+                acc += (px[<int64_t>j * stride] + px[-<int64_t>j * stride]) * w[j]
+        else:
+            for j in range(-radius, 0):
+                acc += (line[<int64_t>_reflect(i + j, n) * stride] +
+                        line[<int64_t>_reflect(i - j, n) * stride]) * w[j]
+        out[<int64_t>i * stride] = acc
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int64_t _threshold_word(const unsigned char *img, int img_width,
+                             int left, int top, int width, int height,
+                             bint invert, const double *weights, int radius,
+                             unsigned char *out, double *buf) noexcept nogil:
+    # Thresholds the word image (inverted if invert is set) into out, like
+    # threshold_image2 does. buf must hold 3 * width * height doubles.
+    # Returns the amount of pixels that are set.
+    cdef int x, y, i, lo, hi, nbins, best
+    cdef int64_t size = <int64_t>width * height
+    cdef int64_t index, ones = 0
+    cdef unsigned char px
+    cdef double *pixels = buf
+    cdef double *tmp = buf + size
+    cdef double *local = buf + 2 * size
+    cdef int64_t counts[256]
+    cdef float weight1[256]
+    cdef float weight2[256]
+    cdef double mean1[256]
+    cdef double mean2[256]
+    cdef double csum, var, best_var
+    cdef float wsum
+
+    lo = 255
+    hi = 0
+    for i in range(256):
+        counts[i] = 0
+    for y in range(height):
+        for x in range(width):
+            px = img[<int64_t>(top + y) * img_width + left + x]
+            if invert:
+                px = 255 - px
+            pixels[<int64_t>y * width + x] = px
+            counts[px] += 1
+            lo = min(lo, px)
+            hi = max(hi, px)
+
+    # Local threshold: gaussian filter, first along the columns, then along
+    # the rows
+    for x in range(width):
+        _correlate_line(pixels + x, tmp + x, height, width, weights, radius)
+    for y in range(height):
+        _correlate_line(tmp + <int64_t>y * width, local + <int64_t>y * width,
+                        width, 1, weights, radius)
+
+    # Otsu threshold, with the histogram over [lo, hi]. skimage keeps the
+    # counts as float32, and the class means as float64
+    nbins = hi - lo + 1
+    wsum = 0
+    csum = 0
+    for i in range(nbins):
+        wsum += <float>counts[lo + i]
+        csum += <double>(<float>counts[lo + i]) * (lo + i)
+        weight1[i] = wsum
+        mean1[i] = csum / weight1[i]
+    wsum = 0
+    csum = 0
+    for i in range(nbins - 1, -1, -1):
+        wsum += <float>counts[lo + i]
+        csum += <double>(<float>counts[lo + i]) * (lo + i)
+        weight2[i] = wsum
+        mean2[i] = csum / weight2[i]
+
+    best = 0
+    best_var = -1
+    for i in range(nbins - 1):
+        var = <double>(<float>(weight1[i] * weight2[i + 1])) * \
+                ((mean1[i] - mean2[i + 1]) * (mean1[i] - mean2[i + 1]))
+        if var > best_var:
+            best_var = var
+            best = i
+
+    # With a single intensity, skimage returns that intensity as threshold,
+    # and no pixel is below it
+    for index in range(size):
+        if nbins > 1 and pixels[index] < local[index] and \
+                pixels[index] < lo + best:
+            out[index] = 1
+            ones += 1
+        else:
+            out[index] = 0
+
+    return ones
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef double _estimate_noise(const unsigned char *thres, int width, int height,
+                            double *buf) noexcept nogil:
+    # Noise estimate of the binary image thres, like
+    # mean_estimate_sigma(thres). Returns -1 where that would return NaN (no
+    # non-zero coefficients). buf must hold 3 * width * height doubles.
+    cdef int y
+    cdef int out_width = (width + DB2_LEN - 1) // 2
+    cdef int out_height = (height + DB2_LEN - 1) // 2
+    cdef int64_t index, count = 0
+    cdef int64_t size = <int64_t>width * height
+    cdef double *pixels = buf
+    cdef double *detail = buf + size
+    cdef double *coeffs = buf + size + <int64_t>width * out_height
+    cdef double *values = pixels
+
+    for index in range(size):
+        pixels[index] = thres[index]
+
+    # Detail along the columns, then the detail of that along the rows
+    _dec_hi(pixels, detail, height, width, width, width, 1)
+    for y in range(out_height):
+        _dec_hi(detail + <int64_t>y * width, coeffs + <int64_t>y * out_width,
+                width, 1, 1, 1, 1)
+
+    # pixels is not needed anymore: the absolute values are written from its
+    # start, which is always behind the coefficient that is being read
+    for index in range(<int64_t>out_width * out_height):
+        if coeffs[index] != 0:
+            values[count] = coeffs[index] if coeffs[index] > 0 else \
+                    -coeffs[index]
+            count += 1
+
+    if count == 0:
+        return -1
+
+    return _median(values, count) / NORM_PPF_075
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _word_mask(const unsigned char *img, int img_width, int left,
+                    int top, int width, int height, const double *weights,
+                    int radius, unsigned char *out) noexcept nogil:
+    # Writes the mask of a word to out, returns -1 if out of memory
+    cdef int x, y
+    cdef int64_t index, ones, ones_i
+    cdef int64_t size = <int64_t>width * height
+    cdef double sigma, sigma_i, center_x, center_y, thres_sum, thres_i_sum
+    cdef double *buf
+    cdef unsigned char *out_i
+
+    # The noise estimate needs a bit more than width * height doubles for its
+    # coefficients with very small words
+    buf = <double *>malloc((3 * size + 2 * (width + height) + 16) *
+                           sizeof(double))
+    out_i = <unsigned char *>malloc(size)
+    if buf == NULL or out_i == NULL:
+        free(buf)
+        free(out_i)
+        return -1
+
+    ones = _threshold_word(img, img_width, left, top, width, height, False,
+                           weights, radius, out, buf)
+    sigma = _estimate_noise(out, width, height, buf)
+
+    if sigma > NOISE_THRESHOLD:
+        ones_i = _threshold_word(img, img_width, left, top, width, height,
+                                 True, weights, radius, out_i, buf)
+        sigma_i = _estimate_noise(out_i, width, height, buf)
+
+        # (A noise estimate of -1 stands for NaN, which compares false)
+        if sigma_i >= 0 and sigma_i < sigma and ones_i < ones:
+            # Find what is closer to the center of the bounding box
+            center_x = height / 2.
+            center_y = width / 2.
+            thres_sum = 0
+            thres_i_sum = 0
+            for y in range(height):
+                for x in range(width):
+                    index = <int64_t>y * width + x
+                    if out[index]:
+                        thres_sum += sqrt((center_x - y) * (center_x - y) +
+                                          (center_y - x) * (center_y - x))
+                    # The inverted distance uses the column for both
+                    # coordinates, as the Python implementation always did
+                    if out_i[index]:
+                        thres_i_sum += sqrt((center_x - x) * (center_x - x) +
+                                            (center_y - x) * (center_y - x))
+            if ones > 0:
+                thres_sum /= ones
+            if ones_i > 0:
+                thres_i_sum /= ones_i
+
+            if not thres_sum < thres_i_sum:
+                for index in range(size):
+                    out[index] = out[index] | out_i[index]
+
+    free(buf)
+    free(out_i)
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def threshold_words(const unsigned char[:, ::1] img,
+                    unsigned char[:, ::1] mask, const int[:, ::1] boxes,
+                    const double[::1] weights, int threads=1):
+    """
+    Threshold the word boxes of the grayscale image img into mask (of the
+    same size, uint8), like create_hocr_mask does.
+
+    boxes holds a (left, top, right, bottom) row per word, which must lie
+    within the image. Later boxes overwrite earlier ones where they overlap.
+    weights are the (symmetric) gaussian weights of the local threshold.
+
+    threads is the amount of threads to threshold the words with.
+    """
+    cdef int i, x, y, left, top, width, height, failed = 0
+    cdef int count = boxes.shape[0]
+    cdef int radius = weights.shape[0] // 2
+    cdef int img_width = img.shape[1]
+    cdef int64_t total = 0
+    cdef int64_t *offsets
+    cdef unsigned char *out
+
+    if mask.shape[0] != img.shape[0] or mask.shape[1] != img.shape[1]:
+        raise ValueError('mask should be of the same size as img')
+    if count == 0:
+        return 0
+    if boxes.shape[1] != 4 or weights.shape[0] % 2 != 1:
+        raise ValueError('boxes should be (n, 4) and weights of odd length')
+
+    offsets = <int64_t *>malloc((count + 1) * sizeof(int64_t))
+    if offsets == NULL:
+        raise MemoryError()
+    for i in range(count):
+        if boxes[i, 0] < 0 or boxes[i, 1] < 0 or \
+                boxes[i, 2] > img.shape[1] or boxes[i, 3] > img.shape[0] or \
+                boxes[i, 0] >= boxes[i, 2] or boxes[i, 1] >= boxes[i, 3]:
+            free(offsets)
+            raise ValueError('Invalid bounding box: (%d, %d, %d, %d)' %
+                             (boxes[i, 0], boxes[i, 1], boxes[i, 2],
+                              boxes[i, 3]))
+        offsets[i] = total
+        total += <int64_t>(boxes[i, 2] - boxes[i, 0]) * \
+                (boxes[i, 3] - boxes[i, 1])
+    offsets[count] = total
+
+    out = <unsigned char *>malloc(total)
+    if out == NULL:
+        free(offsets)
+        raise MemoryError()
+
+    for i in prange(count, nogil=True, num_threads=max(1, threads),
+                    schedule='dynamic'):
+        if _word_mask(&img[0, 0], img_width, boxes[i, 0], boxes[i, 1],
+                      boxes[i, 2] - boxes[i, 0], boxes[i, 3] - boxes[i, 1],
+                      &weights[0], radius, out + offsets[i]) != 0:
+            failed += 1
+
+    if not failed:
+        with nogil:
+            for i in range(count):
+                left = boxes[i, 0]
+                top = boxes[i, 1]
+                width = boxes[i, 2] - left
+                height = boxes[i, 3] - top
+                for y in range(height):
+                    memcpy(&mask[top + y, left],
+                           out + offsets[i] + <int64_t>y * width, width)
+
+    free(out)
+    free(offsets)
+
+    if failed:
+        raise MemoryError()
+
+    return 0
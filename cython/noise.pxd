@@ -0,0 +1,9 @@
+from libc.stdint cimport int64_t
+
+ctypedef fused real:
+    float
+    double
+
+cdef void _dec_hi(const real *line, real *out, int n, int in_stride,
+                  int out_stride, int count, int line_stride) noexcept nogil
+cdef double _median(real *values, int64_t count) noexcept nogil
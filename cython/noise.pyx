@@ -0,0 +1,472 @@
+# Noise estimators for page images and masks.
+#
+# wavelet_sigma computes exactly what np.mean(estimate_sigma(arr)) of
+# skimage.restoration computes for a 2D array: the median absolute value of
+# the non-zero diagonal detail coefficients of the db2 wavelet decomposition
+# (PyWavelets, 'symmetric' mode), divided by scipy.stats.norm.ppf(0.75). Only
+# the diagonal detail coefficients are computed, in the same floating point
+# type and in the same order as PyWavelets does, so the result is the same
+# (note that on flat image regions the coefficients are not exactly zero but
+# tiny, which makes a difference for the median). This module must not be
+# compiled with -ffast-math.
+#
+# laplacian_sigma is a faster estimator in the spirit of Immerkaer's: the
+# image is convolved with the 3x3 Laplacian difference mask
+#
+#     1 -2  1
+#    -2  4 -2
+#     1 -2  1
+#
+# which removes (locally) flat and linear image content, and the noise is
+# estimated from the median absolute response, which is robust against the
+# edges of text. The responses of integer images are integers, so the median
+# is interpolated in the histogram of the responses. Like for wavelet_sigma,
+# responses in all-zero regions are left out.
+#
+# License: AGPL-v3
+
+import numpy as np
+cimport cython
+from cython.parallel cimport prange
+from libc.math cimport NAN
+from libc.stdint cimport int64_t
+from libc.stdlib cimport malloc, calloc, free
+
+ctypedef fused pixel:
+    unsigned char
+    float
+    double
+
+# High pass decomposition filter of the db2 wavelet, as in PyWavelets
+cdef double DB2_DEC_HI[4]
+DB2_DEC_HI[:] = [-0.48296291314453416, 0.8365163037378079,
+                 -0.2241438680420134, -0.12940952255126037]
+cdef int DB2_LEN = 4
+
+# scipy.stats.norm.ppf(0.75)
+cdef double NORM_PPF_075 = 0.6744897501960817
+
+# Norm of the Laplacian mask (the standard deviation of its response to unit
+# gaussian noise)
+cdef double LAPLACIAN_NORM = 6.0
+
+# Amount of columns that are transformed at once
+cdef int COLUMN_BLOCK = 64
+
+# Compile time constants, since they are used in the innermost loops
+cdef enum:
+    # The absolute response of the Laplacian mask of images with values in
+    # [0, 255] is at most 16 * 255
+    LAPLACIAN_MAX = 16 * 255
+    # Amount of interleaved histograms of the responses (by column), so that
+    # consecutive increments of the same bin do not wait for each other
+    HIST_INTERLEAVE = 4
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _dec_hi(const real *line, real *out, int n, int in_stride,
+                  int out_stride, int count, int line_stride) noexcept nogil:
+    # The detail coefficients of the db2 wavelet decomposition of count lines
+    # of n values: line l is line[l * line_stride + i * in_stride] and its
+    # coefficients are written to out[l * line_stride + o * out_stride].
+    # Lines are extended in 'symmetric' mode, and the sums are computed in the
+    # same order as PyWavelets does (downsampling_convolution), with the same
+    # precision as the lines.
+    cdef int i, j, k, l, o = 0
+    cdef int64_t out_index
+    cdef real f[4]
+
+    for j in range(DB2_LEN):
+        f[j] = <real>DB2_DEC_HI[j]
+
+    # The loops over l are innermost, so that transforming the columns of an
+    # image walks through it row by row
+    i = 1
+    # Left boundary overhang
+    while i < DB2_LEN and i < n:
+        out_index = <int64_t>o * out_stride
+        for l in range(count):
+            out[out_index + l * line_stride] = 0
+        j = 0
+        while j <= i:
+            for l in range(count):
+                out[out_index + l * line_stride] += f[j] * line[<int64_t>(i - j) * in_stride + l * line_stride]
+            j += 1
+        while j < DB2_LEN:
+            k = 0
+            while k < n and j < DB2_LEN:
+                for l in range(count):
+                    out[out_index + l * line_stride] += f[j] * line[<int64_t>k * in_stride + l * line_stride]
+                j += 1
+                k += 1
+            k = 0
+            while k < n and j < DB2_LEN:
+                for l in range(count):
+                    out[out_index + l * line_stride] += f[j] * line[<int64_t>(n - 1 - k) * in_stride + l * line_stride]
+                k += 1
+                j += 1
+        i += 2
+        o += 1
+
+    # Center, when the line is at least as long as the filter
+    while i < n:
+        out_index = <int64_t>o * out_stride
+        for l in range(count):
+            out[out_index + l * line_stride] = 0
+        for j in range(DB2_LEN):
+            for l in range(count):
+                out[out_index + l * line_stride] += line[<int64_t>(i - j) * in_stride + l * line_stride] * f[j]
+        i += 2
+        o += 1
+
+    # Center, when the filter is longer than the line
+    while i < DB2_LEN:
+        out_index = <int64_t>o * out_stride
+        for l in range(count):
+            out[out_index + l * line_stride] = 0
+        j = 0
+        while i - j >= n:
+            k = 0
+            while k < n and i - j >= n:
+                for l in range(count):
+                    out[out_index + l * line_stride] += f[i - n - j] * line[<int64_t>(n - 1 - k) * in_stride + l * line_stride]
+                j += 1
+                k += 1
+            k = 0
+            while k < n and i - j >= n:
+                for l in range(count):
+                    out[out_index + l * line_stride] += f[i - n - j] * line[<int64_t>k * in_stride + l * line_stride]
+                j += 1
+                k += 1
+        while j <= i:
+            for l in range(count):
+                out[out_index + l * line_stride] += f[j] * line[<int64_t>(i - j) * in_stride + l * line_stride]
+            j += 1
+        while j < DB2_LEN:
+            k = 0
+            while k < n and j < DB2_LEN:
+                for l in range(count):
+                    out[out_index + l * line_stride] += f[j] * line[<int64_t>k * in_stride + l * line_stride]
+                j += 1
+                k += 1
+            k = 0
+            while k < n and j < DB2_LEN:
+                for l in range(count):
+                    out[out_index + l * line_stride] += f[j] * line[<int64_t>(n - 1 - k) * in_stride + l * line_stride]
+                k += 1
+                j += 1
+        i += 2
+        o += 1
+
+    # Right boundary overhang
+    while i < n + DB2_LEN - 1:
+        out_index = <int64_t>o * out_stride
+        for l in range(count):
+            out[out_index + l * line_stride] = 0
+        j = 0
+        while i - j >= n:
+            k = 0
+            while k < n and i - j >= n:
+                for l in range(count):
+                    out[out_index + l * line_stride] += f[i - n - j] * line[<int64_t>(n - 1 - k) * in_stride + l * line_stride]
+                j += 1
+                k += 1
+            k = 0
+            while k < n and i - j >= n:
+                for l in range(count):
+                    out[out_index + l * line_stride] += f[i - n - j] * line[<int64_t>k * in_stride + l * line_stride]
+                j += 1
+                k += 1
+        while j < DB2_LEN:
+            for l in range(count):
+                out[out_index + l * line_stride] += f[j] * line[<int64_t>(i - j) * in_stride + l * line_stride]
+            j += 1
+        i += 2
+        o += 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef double _median(real *values, int64_t count) noexcept nogil:
+    # Median of values (which are reordered), like np.median: the mean of the
+    # middle values, in the precision of the values, for an even count
+    cdef int64_t lo = 0, hi = count - 1, i, j, k = count // 2
+    cdef real pivot, tmp, lower
+
+    # Quickselect the k-th smallest value
+    while lo < hi:
+        pivot = values[lo + (hi - lo) // 2]
+        i = lo
+        j = hi
+        while i <= j:
+            while values[i] < pivot:
+                i += 1
+            while values[j] > pivot:
+                j -= 1
+            if i <= j:
+                tmp = values[i]
+                values[i] = values[j]
+                values[j] = tmp
+                i += 1
+                j -= 1
+        if k <= j:
+            hi = j
+        elif k >= i:
+            lo = i
+        else:
+            break
+
+    if count % 2:
+        return values[k]
+
+    # The values before k are at most values[k]
+    lower = values[0]
+    for i in range(1, k):
+        if values[i] > lower:
+            lower = values[i]
+    return <real>((lower + values[k]) / 2)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _wavelet_sigma(const pixel *img, int width, int height, real *detail,
+                        real *values, int threads, double *sigma) noexcept nogil:
+    # detail must hold width * out_height values, values out_width *
+    # out_height. Returns -1 if out of memory.
+    cdef int block, blocks, x0, block_width, x, y, o, failed = 0
+    cdef int out_width = (width + DB2_LEN - 1) // 2
+    cdef int out_height = (height + DB2_LEN - 1) // 2
+    cdef int64_t index, count = 0
+    cdef real *buf
+    cdef real value
+
+    # Detail along the columns (axis 0), a block of columns at a time,
+    # converted to the precision of the transform
+    blocks = (width + COLUMN_BLOCK - 1) // COLUMN_BLOCK
+    for block in prange(blocks, num_threads=max(1, threads),
+                        schedule='static'):
+        x0 = block * COLUMN_BLOCK
+        block_width = min(COLUMN_BLOCK, width - x0)
+        buf = <real *>malloc(<int64_t>block_width * height * sizeof(real))
+        if buf == NULL:
+            failed += 1
+        else:
+            for y in range(height):
+                for x in range(block_width):
+                    buf[<int64_t>y * block_width + x] = \
+                            <real>img[<int64_t>y * width + x0 + x]
+            _dec_hi(buf, detail + x0, height, block_width, width,
+                    block_width, 1)
+            free(buf)
+    if failed:
+        return -1
+
+    # Detail of that along the rows (axis 1)
+    for o in prange(out_height, num_threads=max(1, threads),
+                    schedule='static'):
+        _dec_hi(detail + <int64_t>o * width, values + <int64_t>o * out_width,
+                width, 1, 1, 1, 1)
+
+    # Coefficients that are exactly zero are left out
+    for index in range(<int64_t>out_width * out_height):
+        value = values[index]
+        if value != 0:
+            values[count] = value if value > 0 else -value
+            count += 1
+
+    if count == 0:
+        sigma[0] = NAN
+    else:
+        sigma[0] = _median(values, count) / NORM_PPF_075
+    return 0
+
+
+cdef double _wavelet_sigma_typed(const pixel[:, ::1] img, real *detail,
+                                 real *values, int threads) except? -1:
+    cdef double sigma
+    cdef int ret
+    with nogil:
+        ret = _wavelet_sigma(&img[0, 0], img.shape[1], img.shape[0], detail,
+                             values, threads, &sigma)
+    if ret != 0:
+        raise MemoryError()
+    return sigma
+
+
+def wavelet_sigma(arr, int threads=1, bint single=False):
+    """
+    Estimate the (gaussian) noise standard deviation of the 2D image arr,
+    exactly like np.mean(skimage.restoration.estimate_sigma(arr)) does, but
+    faster and using threads threads.
+
+    float32 images are transformed in single precision, other images in
+    double precision, like PyWavelets does. If single is set, uint8 images
+    are transformed in single precision too, which gives the same estimate
+    as for the image converted to float32, without creating that copy.
+
+    Returns the estimate, which is NaN if the image is completely flat.
+    """
+    cdef int width, height, out_width, out_height
+    cdef void *detail
+    cdef void *values
+    cdef size_t size
+
+    arr = np.ascontiguousarray(arr)
+    if arr.ndim != 2:
+        raise ValueError('arr should be a 2D array')
+    if arr.dtype == np.bool_:
+        arr = arr.view(np.uint8)
+    elif arr.dtype not in (np.uint8, np.float32, np.float64):
+        arr = arr.astype(np.float64)
+
+    height, width = arr.shape
+    if width == 0 or height == 0:
+        return NAN
+    out_width = (width + DB2_LEN - 1) // 2
+    out_height = (height + DB2_LEN - 1) // 2
+
+    single = arr.dtype == np.float32 or (single and arr.dtype == np.uint8)
+    size = sizeof(float) if single else sizeof(double)
+    detail = malloc(<int64_t>width * out_height * size)
+    values = malloc(<int64_t>out_width * out_height * size)
+    if detail == NULL or values == NULL:
+        free(detail)
+        free(values)
+        raise MemoryError()
+
+    try:
+        if arr.dtype == np.float32:
+            return _wavelet_sigma_typed[float, float](arr, <float *>detail,
+                    <float *>values, threads)
+        elif arr.dtype == np.float64:
+            return _wavelet_sigma_typed[double, double](arr,
+                    <double *>detail, <double *>values, threads)
+        elif single:
+            return _wavelet_sigma_typed[cython.uchar, float](arr,
+                    <float *>detail, <float *>values, threads)
+        else:
+            return _wavelet_sigma_typed[cython.uchar, double](arr,
+                    <double *>detail, <double *>values, threads)
+    finally:
+        free(detail)
+        free(values)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _laplacian_hist(const pixel *img, int width, int height,
+                          int64_t *hist, int top, int bottom,
+                          int *vert, int *box) noexcept nogil:
+    # Adds the absolute Laplacian responses of rows [top, bottom) of img to
+    # the HIST_INTERLEAVE histograms in hist. The mask is separable, so the vertical differences (and sums, to
+    # find the all-zero regions) of a row are computed first, in vert and
+    # box, which must hold width values.
+    cdef int x, y, r
+    cdef const pixel *above
+    cdef const pixel *row
+    cdef const pixel *below
+
+    for y in range(max(1, top), min(height - 1, bottom)):
+        row = img + <int64_t>y * width
+        above = row - width
+        below = row + width
+        for x in range(width):
+            vert[x] = <int>above[x] - 2 * <int>row[x] + <int>below[x]
+            box[x] = <int>above[x] + <int>row[x] + <int>below[x]
+        for x in range(1, width - 1):
+            r = vert[x - 1] - 2 * vert[x] + vert[x + 1]
+            if r == 0 and box[x - 1] == 0 and box[x] == 0 and box[x + 1] == 0:
+                continue
+            if r < 0:
+                r = -r
+            hist[(x % HIST_INTERLEAVE) * (LAPLACIAN_MAX + 1) +
+                 min(r, LAPLACIAN_MAX)] += 1
+
+
+cdef double _laplacian_sigma_typed(const pixel[:, ::1] img,
+                                   int threads) except? -1:
+    cdef int width = img.shape[1]
+    cdef int height = img.shape[0]
+    cdef int band, bands, band_height, i
+    cdef int64_t total = 0, below = 0
+    cdef int64_t *hists
+    cdef int *rows
+    cdef double half, median
+
+    if width < 3 or height < 3:
+        return NAN
+
+    bands = max(1, min(threads, height))
+    band_height = (height + bands - 1) // bands
+    bands = (height + band_height - 1) // band_height
+
+    hists = <int64_t *>calloc(bands * HIST_INTERLEAVE * (LAPLACIAN_MAX + 1),
+                              sizeof(int64_t))
+    rows = <int *>malloc(<int64_t>bands * 2 * width * sizeof(int))
+    if hists == NULL or rows == NULL:
+        free(hists)
+        free(rows)
+        raise MemoryError()
+
+    for band in prange(bands, nogil=True, num_threads=bands,
+                       schedule='static'):
+        _laplacian_hist(&img[0, 0], width, height,
+                        hists + band * HIST_INTERLEAVE * (LAPLACIAN_MAX + 1),
+                        band * band_height, (band + 1) * band_height,
+                        rows + <int64_t>band * 2 * width,
+                        rows + <int64_t>band * 2 * width + width)
+    free(rows)
+
+    for band in range(1, bands * HIST_INTERLEAVE):
+        for i in range(LAPLACIAN_MAX + 1):
+            hists[i] += hists[band * (LAPLACIAN_MAX + 1) + i]
+    for i in range(LAPLACIAN_MAX + 1):
+        total += hists[i]
+
+    median = NAN
+    if total > 0:
+        # Interpolate the median in the bin that holds it: bin 0 covers
+        # [0, 0.5), bin i > 0 covers [i - 0.5, i + 0.5)
+        half = total / 2.
+        for i in range(LAPLACIAN_MAX + 1):
+            if below + hists[i] > half:
+                if i == 0:
+                    median = (half - below) / hists[i] * 0.5
+                else:
+                    median = i - 0.5 + (half - below) / hists[i]
+                break
+            below += hists[i]
+
+    free(hists)
+    return median / (NORM_PPF_075 * LAPLACIAN_NORM)
+
+
+def laplacian_sigma(arr, int threads=1):
+    """
+    Estimate the (gaussian) noise standard deviation of the 2D image arr
+    (with integer values in [0, 255], or a boolean mask) from the median
+    absolute response to a Laplacian mask, using threads threads. This is
+    much faster than wavelet_sigma, and gives comparable estimates for
+    images, but the estimates for masks are on a different scale.
+
+    Returns the estimate, which is NaN if the image is too small or
+    completely black.
+    """
+    arr = np.ascontiguousarray(arr)
+    if arr.ndim != 2:
+        raise ValueError('arr should be a 2D array')
+    if arr.dtype == np.bool_:
+        arr = arr.view(np.uint8)
+    elif arr.dtype not in (np.uint8, np.float32, np.float64):
+        arr = arr.astype(np.float64)
+
+    if arr.dtype == np.float32:
+        return _laplacian_sigma_typed[float](arr, threads)
+    elif arr.dtype == np.float64:
+        return _laplacian_sigma_typed[double](arr, threads)
+    return _laplacian_sigma_typed[cython.uchar](arr, threads)
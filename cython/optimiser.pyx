@@ -7,10 +7,23 @@
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel cimport parallel, prange, threadid
+cimport openmp
+from libc.stdint cimport int64_t
+from libc.stdlib cimport malloc, free
+
+cdef extern from *:
+    """
+    /* Wait for all threads of the enclosing OpenMP parallel region */
+    static void optimiser_barrier(void) {
+    #ifdef _OPENMP
+        _Pragma("omp barrier")
+    #endif
+    }
+    """
+    void optimiser_barrier() noexcept nogil
 
-INTDTYPE = np.int
 UINT8DTYPE = np.uint8
-ctypedef np.int_t INTDTYPE_t
 ctypedef np.uint8_t UINT8DTYPE_t
 
 # Speed up the code and let's make sure all variables have a c type, otherwise performs goes out of
@@ -110,246 +123,425 @@ def optimise_rgb(np.ndarray[UINT8DTYPE_t, ndim=2] mask,
     return new_img
 
 
+# optimise_gray2 and optimise_rgb2 compute a FIR and IIR version of the box
+# blur filter of optimise_gray and optimise_rgb incrementally: per column, the
+# sums of the (masked) pixels in the window rows are kept, and per row, the
+# sums over the window columns.
+#
+# The IIR part of a pixel only depends on the rows above it, so all pixels of
+# a row can be computed at the same time. The image is split in chunks
+# (bands) of columns, every chunk keeping its own column sums for its columns
+# plus n_size columns on either side. All rows are computed in one parallel
+# region, every thread walking the rows of its chunks; since the IIR sums of
+# a chunk take the previous row of the neighbouring chunks, the threads wait
+# for each other after every row.
+#
+# optimise_fg_bg_gray2 and optimise_fg_bg_rgb2 compute the foreground (with
+# mask) and the background (with the inverse of mask) in the same pass over
+# the rows, with the column sums of both kept side by side.
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-@cython.warn.undeclared(True)
-def optimise_gray2(np.ndarray[UINT8DTYPE_t, ndim=2] mask,
-        np.ndarray[UINT8DTYPE_t, ndim=2] img, int width, int height, int n_size):
-    cdef np.ndarray[UINT8DTYPE_t, ndim=2] new_img
-    cdef int x, y
-    cdef int val_count, val, ys, ye, xs, xe, xx, yy
-    cdef int ifysc, ifyec, iiysc, iiyec, ifxsc, ifxec, iixsc, iixec
-    cdef int inc_fir_px_val, inc_fir_px_mask
-    cdef int inc_iir_px_val
-
-    # This function computes a FIR and IIR version of the box blur filter incrementally
-    # As seen above
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_fir_val = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_fir_mask = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_iir_val = np.zeros([width], dtype=INTDTYPE)
-
-    # incremental cursors that track y-dimension FIR filter window borders
-    ifysc = 0
-    ifyec = 0
-
-    # incremental cursors that track y-dimension IIR filter window borders
-    iiysc = 0
-    iiyec = 0
-
-    new_img = np.copy(img)
-    for y in range(0, height):
-        #print('loop y')
-        ys = max(0, y - n_size)
-        ye = min(height, y + n_size)
-        # Update y-dimension FIR window
-        while ifysc < ys:
-            for x in range(0, width):
-                if mask[ifysc, x]:
-                    inc_fir_val[x] -= img[ifysc, x]
-                    inc_fir_mask[x] -= 1
-            ifysc += 1
-        while ifyec < ye:
-            for x in range(0, width):
-                if mask[ifyec, x]:
-                    inc_fir_val[x] += img[ifyec, x]
-                    inc_fir_mask[x] += 1
-            ifyec += 1
-        while iiysc < ys:
-            for x in range(0, width):
-                inc_iir_val[x] -= new_img[iiysc, x]
-            iiysc += 1
-        while iiyec < y:
-            for x in range(0, width):
-                inc_iir_val[x] += new_img[iiyec, x]
-            iiyec += 1
-
-        # incremental cursors that track x-dimension FIR filter window borders
-        ifxsc = 0
-        ifxec = 0
-
-        # incremental cursors that track x-dimension IIR filter window borders
-        iixsc = 0
-        iixec = 0
-
-        # incremental FIR value/mask
-        inc_fir_px_val = 0
-        inc_fir_px_mask = 0
-
-        # incremental IIR value
-        inc_iir_px_val = 0
-
-        for x in range(0, width):
+cdef void _optimise_chunk(const unsigned char *mask, const unsigned char *img,
+                          unsigned char *new_img, int64_t *fir_val,
+                          int64_t *fir_mask, int64_t *iir_val, int width,
+                          int height, int channels, int n_size, int start_y,
+                          int y, int chunk_start, int chunk_end,
+                          bint invert) noexcept nogil:
+    # Pixels are optimised where mask is not set (or where it is set, if
+    # invert is set)
+    cdef int x, j, c, row, ys, xs, val_count
+    cdef int64_t index, new_index
+    # Columns that the pixels in the chunk depend on
+    cdef int ext_start = max(0, chunk_start - n_size)
+    cdef int ext_end = min(width, chunk_end + n_size)
+    cdef int64_t px_val[4]
+    cdef int64_t iir_px_val[4]
+    cdef int64_t px_mask
+
+    # Update the column sums from the window of row y-1 to the one of row y
+    if y == start_y:
+        for j in range(0, (ext_end - ext_start) * channels):
+            fir_val[j] = 0
+            iir_val[j] = 0
+        for j in range(0, ext_end - ext_start):
+            fir_mask[j] = 0
+
+        for row in range(max(0, y - n_size), min(height, y + n_size)):
+            for j in range(ext_start, ext_end):
+                index = <int64_t>row * width + j
+                if (mask[index] != 0) != invert:
+                    fir_mask[j - ext_start] += 1
+                    for c in range(channels):
+                        fir_val[(j - ext_start) * channels + c] += img[index * channels + c]
+        for row in range(max(0, y - n_size), y):
+            for j in range(ext_start, ext_end):
+                new_index = <int64_t>row * width + j
+                for c in range(channels):
+                    iir_val[(j - ext_start) * channels + c] += new_img[new_index * channels + c]
+    else:
+        row = y - n_size - 1
+        if row >= 0:
+            for j in range(ext_start, ext_end):
+                index = <int64_t>row * width + j
+                new_index = <int64_t>row * width + j
+                if (mask[index] != 0) != invert:
+                    fir_mask[j - ext_start] -= 1
+                    for c in range(channels):
+                        fir_val[(j - ext_start) * channels + c] -= img[index * channels + c]
+                for c in range(channels):
+                    iir_val[(j - ext_start) * channels + c] -= new_img[new_index * channels + c]
+        row = y + n_size - 1
+        if row < height:
+            for j in range(ext_start, ext_end):
+                index = <int64_t>row * width + j
+                if (mask[index] != 0) != invert:
+                    fir_mask[j - ext_start] += 1
+                    for c in range(channels):
+                        fir_val[(j - ext_start) * channels + c] += img[index * channels + c]
+        row = y - 1
+        for j in range(ext_start, ext_end):
+            new_index = <int64_t>row * width + j
+            for c in range(channels):
+                iir_val[(j - ext_start) * channels + c] += new_img[new_index * channels + c]
+
+    # Sums over the FIR window [xs, xe) and the IIR window [xs, x) of the
+    # first pixel of the chunk
+    px_mask = 0
+    for c in range(channels):
+        px_val[c] = 0
+        iir_px_val[c] = 0
+    for j in range(max(0, chunk_start - n_size), min(width, chunk_start + n_size)):
+        px_mask += fir_mask[j - ext_start]
+        for c in range(channels):
+            px_val[c] += fir_val[(j - ext_start) * channels + c]
+    for j in range(max(0, chunk_start - n_size), chunk_start):
+        for c in range(channels):
+            iir_px_val[c] += iir_val[(j - ext_start) * channels + c]
+
+    ys = max(0, y - n_size)
+    for x in range(chunk_start, chunk_end):
+        if x > chunk_start:
+            j = x + n_size - 1
+            if j < width:
+                px_mask += fir_mask[j - ext_start]
+                for c in range(channels):
+                    px_val[c] += fir_val[(j - ext_start) * channels + c]
+            j = x - n_size - 1
+            if j >= 0:
+                px_mask -= fir_mask[j - ext_start]
+                for c in range(channels):
+                    px_val[c] -= fir_val[(j - ext_start) * channels + c]
+                    iir_px_val[c] -= iir_val[(j - ext_start) * channels + c]
+            j = x - 1
+            for c in range(channels):
+                iir_px_val[c] += iir_val[(j - ext_start) * channels + c]
+
+        index = <int64_t>y * width + x
+        if (mask[index] != 0) == invert:
+            new_index = <int64_t>y * width + x
             xs = max(0, x - n_size)
-            xe = min(width, x + n_size)
-
-            # Update x-dimension FIR window
-            while ifxsc < xs:
-                inc_fir_px_val -= inc_fir_val[ifxsc]
-                inc_fir_px_mask -= inc_fir_mask[ifxsc]
-                ifxsc += 1
-            while ifxec < xe:
-                inc_fir_px_val += inc_fir_val[ifxec]
-                inc_fir_px_mask += inc_fir_mask[ifxec]
-                ifxec += 1
-            while iixsc < xs:
-                inc_iir_px_val -= inc_iir_val[iixsc]
-                iixsc += 1
-            while iixec < x:
-                inc_iir_px_val += inc_iir_val[iixec]
-                iixec += 1
-
-            if not mask[y, x]:
-                val_count = 0
-                val = 0
-
-                iir_window_size = (y - ys) * (x - xs)
-
-                val = inc_fir_px_val + inc_iir_px_val
-                val_count = inc_fir_px_mask + iir_window_size
+            val_count = <int>px_mask + (y - ys) * (x - xs)
 
+            for c in range(channels):
                 if val_count > 0:
-                    new_img[y, x] = val / val_count
+                    new_img[new_index * channels + c] = <int>((px_val[c] + iir_px_val[c]) / val_count)
                 else:
-                    new_img[y, x] = 0
-            #else:
-            #    new_img[y, x] = img[y, x]
+                    new_img[new_index * channels + c] = 0
 
-    return new_img
 
-
-#@cython.boundscheck(False)
-#@cython.wraparound(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
 @cython.cdivision(True)
-@cython.warn.undeclared(True)
-def optimise_rgb2(np.ndarray[UINT8DTYPE_t, ndim=2] mask,
-        np.ndarray[UINT8DTYPE_t, ndim=3] img, int width, int height, int n_size):
-    cdef np.ndarray[UINT8DTYPE_t, ndim=3] new_img
-    cdef int x, y
-    cdef int val_count, ys, ye, xs, xe, xx, yy
-    cdef int r, g, b
-    cdef int ifysc, ifyec, iiysc, iiyec, ifxsc, ifxec, iixsc, iixec
-    cdef int inc_fir_px_r, inc_fir_px_g, inc_fir_px_b, inc_fir_px_mask
-    cdef int inc_iir_px_r, inc_iir_px_g, inc_iir_px_b
-
-    # This function computes a FIR and IIR version of the box blur filter incrementally
-    # As seen above
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_fir_r = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_fir_g = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_fir_b = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_iir_r = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_iir_g = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_iir_b = np.zeros([width], dtype=INTDTYPE)
-    cdef np.ndarray[INTDTYPE_t, ndim=1] inc_fir_mask = np.zeros([width], dtype=INTDTYPE)
-
-    # incremental cursors that track y-dimension FIR filter window borders
-    ifysc = 0
-    ifyec = 0
-
-    # incremental cursors that track y-dimension IIR filter window borders
-    iiysc = 0
-    iiyec = 0
-
-    new_img = np.copy(img)
-    for y in range(0, height):
-        ys = max(0, y - n_size)
-        ye = min(height, y + n_size)
-        # Update y-dimension FIR window
-        while ifysc < ys:
-            for x in range(0, width):
-                if mask[ifysc, x]:
-                    inc_fir_r[x] -= img[ifysc, x, 0]
-                    inc_fir_g[x] -= img[ifysc, x, 1]
-                    inc_fir_b[x] -= img[ifysc, x, 2]
-                    inc_fir_mask[x] -= 1
-            ifysc += 1
-        while ifyec < ye:
-            for x in range(0, width):
-                if mask[ifyec, x]:
-                    inc_fir_r[x] += img[ifyec, x, 0]
-                    inc_fir_g[x] += img[ifyec, x, 1]
-                    inc_fir_b[x] += img[ifyec, x, 2]
-                    inc_fir_mask[x] += 1
-            ifyec += 1
-        while iiysc < ys:
-            for x in range(0, width):
-                inc_iir_r[x] -= new_img[iiysc, x, 0]
-                inc_iir_g[x] -= new_img[iiysc, x, 1]
-                inc_iir_b[x] -= new_img[iiysc, x, 2]
-            iiysc += 1
-        while iiyec < y:
-            for x in range(0, width):
-                inc_iir_r[x] += new_img[iiyec, x, 0]
-                inc_iir_g[x] += new_img[iiyec, x, 1]
-                inc_iir_b[x] += new_img[iiyec, x, 2]
-            iiyec += 1
-
-        # incremental cursors that track x-dimension FIR filter window borders
-        ifxsc = 0
-        ifxec = 0
-
-        # incremental cursors that track x-dimension IIR filter window borders
-        iixsc = 0
-        iixec = 0
-
-        # incremental FIR value/mask
-        inc_fir_px_r = 0
-        inc_fir_px_g = 0
-        inc_fir_px_b = 0
-        inc_fir_px_mask = 0
-
-        # incremental IIR value
-        inc_iir_px_r = 0
-        inc_iir_px_g = 0
-        inc_iir_px_b = 0
-
-        for x in range(0, width):
-            xs = max(0, x - n_size)
-            xe = min(width, x + n_size)
-
-            # Update x-dimension FIR window
-            while ifxsc < xs:
-                inc_fir_px_r -= inc_fir_r[ifxsc]
-                inc_fir_px_g -= inc_fir_g[ifxsc]
-                inc_fir_px_b -= inc_fir_b[ifxsc]
-                inc_fir_px_mask -= inc_fir_mask[ifxsc]
-                ifxsc += 1
-            while ifxec < xe:
-                inc_fir_px_r += inc_fir_r[ifxec]
-                inc_fir_px_g += inc_fir_g[ifxec]
-                inc_fir_px_b += inc_fir_b[ifxec]
-                inc_fir_px_mask += inc_fir_mask[ifxec]
-                ifxec += 1
-            while iixsc < xs:
-                inc_iir_px_r -= inc_iir_r[iixsc]
-                inc_iir_px_g -= inc_iir_g[iixsc]
-                inc_iir_px_b -= inc_iir_b[iixsc]
-                iixsc += 1
-            while iixec < x:
-                inc_iir_px_r += inc_iir_r[iixec]
-                inc_iir_px_g += inc_iir_g[iixec]
-                inc_iir_px_b += inc_iir_b[iixec]
-                iixec += 1
-
-            if not mask[y, x]:
-                val_count = 0
-
-                iir_window_size = (y - ys) * (x - xs)
-
-                b = inc_fir_px_b + inc_iir_px_b
-                g = inc_fir_px_g + inc_iir_px_g
-                r = inc_fir_px_r + inc_iir_px_r
-                val_count = inc_fir_px_mask + iir_window_size
-
-                if val_count > 0:
-                    new_img[y, x, 0] = r / val_count
-                    new_img[y, x, 1] = g / val_count
-                    new_img[y, x, 2] = b / val_count
+cdef void _downsample_masked_rows(const unsigned char *mask,
+                                  const unsigned char *img,
+                                  unsigned char *out_img, int *out_kept,
+                                  int64_t *acc, int width, int height,
+                                  int channels, int factor, bint invert,
+                                  int out_start, int out_end) noexcept nogil:
+    # Averages the pixels where mask is set (or not, if invert) of the blocks
+    # in block rows [out_start, out_end), with acc holding the sums of a block
+    # row
+    cdef int x, y, c, out_x, out_y, kept, x_end
+    cdef int out_width = (width + factor - 1) // factor
+    cdef int64_t out_index
+    cdef const unsigned char *row_mask
+    cdef const unsigned char *row_img
+    cdef int64_t *block_acc
+
+    for out_y in range(out_start, out_end):
+        for x in range(out_width * channels):
+            acc[x] = 0
+        for out_x in range(out_width):
+            out_kept[<int64_t>out_y * out_width + out_x] = 0
+
+        for y in range(out_y * factor, min(height, (out_y + 1) * factor)):
+            row_mask = mask + <int64_t>y * width
+            row_img = img + <int64_t>y * width * channels
+            for out_x in range(out_width):
+                block_acc = acc + out_x * channels
+                kept = 0
+                x_end = min(width, (out_x + 1) * factor)
+                for x in range(out_x * factor, x_end):
+                    if (row_mask[x] != 0) == invert:
+                        continue
+                    kept += 1
+                    for c in range(channels):
+                        block_acc[c] += row_img[x * channels + c]
+                out_kept[<int64_t>out_y * out_width + out_x] += kept
+
+        for out_x in range(out_width):
+            out_index = <int64_t>out_y * out_width + out_x
+            kept = out_kept[out_index]
+            for c in range(channels):
+                if kept == 0:
+                    out_img[out_index * channels + c] = 0
                 else:
-                    new_img[y, x, 0] = 0
-                    new_img[y, x, 1] = 0
-                    new_img[y, x, 2] = 0
-            #else:
-            #    new_img[y, x] = img[y, x]
+                    out_img[out_index * channels + c] = <unsigned char>(
+                            (acc[out_x * channels + c] + kept // 2) // kept)
+
+
+cdef object _check_arrays(mask, img, int width, int height, int channels):
+    mask = np.ascontiguousarray(mask)
+    if mask.dtype == np.bool_:
+        mask = mask.view(np.uint8)
+    if mask.shape[0] != height or mask.shape[1] != width:
+        raise ValueError('mask should be of size width * height')
+    if img.size != <Py_ssize_t>width * height * channels:
+        raise ValueError('img should be of size width * height')
+    return mask
+
+
+cdef object _optimise2(mask, img, int width, int height, int channels,
+                       int n_size, int start_y, int threads):
+    cdef int chunk, chunks, chunk_width, ext_width, y, thread, team
+    cdef int64_t *fir_val
+    cdef int64_t *fir_mask
+    cdef int64_t *iir_val
+
+    mask = _check_arrays(mask, img, width, height, channels)
+    new_img = np.array(img, dtype=UINT8DTYPE, order='C', copy=True)
+
+    cdef const unsigned char[:, ::1] mask_view = mask
+    cdef const unsigned char[::1] img_view = \
+            np.ascontiguousarray(img, dtype=UINT8DTYPE).reshape(-1)
+    cdef unsigned char[::1] new_img_view = new_img.reshape(-1)
+
+    if width <= 0 or height <= 0 or start_y >= height:
+        return new_img
+
+    chunks = max(1, min(threads, width))
+    chunk_width = (width + chunks - 1) // chunks
+    chunks = (width + chunk_width - 1) // chunk_width
+    ext_width = chunk_width + 2 * n_size
+
+    fir_val = <int64_t *>malloc(chunks * ext_width * channels * sizeof(int64_t))
+    fir_mask = <int64_t *>malloc(chunks * ext_width * sizeof(int64_t))
+    iir_val = <int64_t *>malloc(chunks * ext_width * channels * sizeof(int64_t))
+    if fir_val == NULL or fir_mask == NULL or iir_val == NULL:
+        free(fir_val)
+        free(fir_mask)
+        free(iir_val)
+        raise MemoryError()
+
+    with nogil, parallel(num_threads=chunks):
+        # There might be fewer threads than chunks
+        thread = threadid()
+        team = openmp.omp_get_num_threads()
+        for y in range(max(0, start_y), height):
+            chunk = thread
+            while chunk < chunks:
+                _optimise_chunk(&mask_view[0, 0], &img_view[0],
+                                &new_img_view[0],
+                                fir_val + chunk * ext_width * channels,
+                                fir_mask + chunk * ext_width,
+                                iir_val + chunk * ext_width * channels,
+                                width, height, channels, n_size,
+                                max(0, start_y), y, chunk * chunk_width,
+                                min(width, (chunk + 1) * chunk_width),
+                                False)
+                chunk = chunk + team
+            optimiser_barrier()
+
+    free(fir_val)
+    free(fir_mask)
+    free(iir_val)
 
     return new_img
+
+
+cdef object _optimise_fg_bg2(mask, img, int width, int height, int channels,
+                             int fg_n_size, int bg_n_size, int threads):
+    cdef int chunk, chunks, chunk_width, fg_ext_width, bg_ext_width, y
+    cdef int thread, team
+    cdef int64_t *buf
+    cdef int64_t *fg_sums
+    cdef int64_t *bg_sums
+
+    mask = _check_arrays(mask, img, width, height, channels)
+    img = np.ascontiguousarray(img, dtype=UINT8DTYPE)
+
+    fg = np.array(img, order='C', copy=True)
+    bg = np.array(img, order='C', copy=True)
+
+    cdef const unsigned char[:, ::1] mask_view = mask
+    cdef const unsigned char[::1] img_view = img.reshape(-1)
+    cdef unsigned char[::1] fg_view = fg.reshape(-1)
+    cdef unsigned char[::1] bg_view = bg.reshape(-1)
+
+    if width <= 0 or height <= 0:
+        return fg, bg
+
+    chunks = max(1, min(threads, width))
+    chunk_width = (width + chunks - 1) // chunks
+    chunks = (width + chunk_width - 1) // chunk_width
+    fg_ext_width = chunk_width + 2 * fg_n_size
+    bg_ext_width = chunk_width + 2 * bg_n_size
+
+    # Per chunk: FIR value, FIR mask and IIR value sums of the foreground,
+    # then of the background
+    buf = <int64_t *>malloc(chunks * (fg_ext_width + bg_ext_width) *
+                            (2 * channels + 1) * sizeof(int64_t))
+    if buf == NULL:
+        raise MemoryError()
+
+    with nogil, parallel(num_threads=chunks):
+        thread = threadid()
+        team = openmp.omp_get_num_threads()
+        for y in range(height):
+            chunk = thread
+            while chunk < chunks:
+                fg_sums = buf + chunk * (fg_ext_width + bg_ext_width) * \
+                        (2 * channels + 1)
+                bg_sums = fg_sums + fg_ext_width * (2 * channels + 1)
+                _optimise_chunk(&mask_view[0, 0], &img_view[0], &fg_view[0],
+                                fg_sums, fg_sums + fg_ext_width * channels,
+                                fg_sums + fg_ext_width * (channels + 1),
+                                width, height, channels, fg_n_size, 0, y,
+                                chunk * chunk_width,
+                                min(width, (chunk + 1) * chunk_width),
+                                False)
+                _optimise_chunk(&mask_view[0, 0], &img_view[0], &bg_view[0],
+                                bg_sums, bg_sums + bg_ext_width * channels,
+                                bg_sums + bg_ext_width * (channels + 1),
+                                width, height, channels, bg_n_size, 0, y,
+                                chunk * chunk_width,
+                                min(width, (chunk + 1) * chunk_width),
+                                True)
+                chunk = chunk + team
+            optimiser_barrier()
+
+    free(buf)
+
+    return fg, bg
+
+
+def optimise_gray2(mask, img, int width, int height, int n_size,
+                   int start_y=0, int threads=1):
+    """
+    Optimise the grayscale image img (height x width) where mask is not set,
+    using the pixels in a neighbourhood of n_size where mask is set, and the
+    optimised pixels above and to the left.
+
+    Rows before start_y are taken to be optimised already (img holds the
+    optimised pixels there), which allows for optimising an image in
+    horizontal strips.
+
+    threads is the amount of threads to optimise the image with.
+
+    Returns the optimised image.
+    """
+    return _optimise2(mask, img, width, height, 1, n_size, start_y, threads)
+
+
+def optimise_rgb2(mask, img, int width, int height, int n_size,
+                  int start_y=0, int threads=1):
+    """
+    Same as optimise_gray2, for RGB images (height x width x 3).
+    """
+    return _optimise2(mask, img, width, height, 3, n_size, start_y, threads)
+
+
+def optimise_fg_bg_gray2(mask, img, int width, int height, int fg_n_size,
+                         int bg_n_size, int threads=1):
+    """
+    Optimise the grayscale image img (height x width) into a foreground and a
+    background image in one pass: the foreground is
+    optimise_gray2(mask, img, width, height, fg_n_size) and the background is
+    optimise_gray2(~mask, img, width, height, bg_n_size), without creating
+    the inverse of mask.
+
+    threads is the amount of threads to optimise the image with.
+
+    Returns a tuple (foreground, background).
+    """
+    return _optimise_fg_bg2(mask, img, width, height, 1, fg_n_size,
+                            bg_n_size, threads)
+
+
+def optimise_fg_bg_rgb2(mask, img, int width, int height, int fg_n_size,
+                        int bg_n_size, int threads=1):
+    """
+    Same as optimise_fg_bg_gray2, for RGB images (height x width x 3).
+    """
+    return _optimise_fg_bg2(mask, img, width, height, 3, fg_n_size,
+                            bg_n_size, threads)
+
+
+def downsample_masked(mask, img, int width, int height, int factor,
+                      bint invert=False, int threads=1):
+    """
+    Downsample the grayscale (height x width) or RGB (height x width x 3)
+    image img by factor, averaging only the pixels where mask is set (or not
+    set, if invert) in every block of factor x factor pixels (the blocks on
+    the right and bottom edges can be smaller).
+
+    threads is the amount of threads to downsample the image with.
+
+    Returns a tuple of the downsampled image and the amount of averaged
+    pixels per block (an array of np.intc). Blocks without such pixels are
+    0 in the downsampled image.
+    """
+    cdef int channels, chunk, chunks, chunk_height, out_width, out_height
+    cdef int64_t *acc
+
+    channels = 1 if img.ndim == 2 else img.shape[2]
+    mask = _check_arrays(mask, img, width, height, channels)
+    img = np.ascontiguousarray(img, dtype=UINT8DTYPE)
+    if factor < 1:
+        raise ValueError('factor should be at least 1')
+
+    out_width = (width + factor - 1) // factor
+    out_height = (height + factor - 1) // factor
+    out_img = np.empty((out_height, out_width) + img.shape[2:],
+                       dtype=UINT8DTYPE)
+    out_kept = np.empty((out_height, out_width), dtype=np.intc)
+    if width <= 0 or height <= 0:
+        return out_img, out_kept
+
+    cdef const unsigned char[:, ::1] mask_view = mask
+    cdef const unsigned char[::1] img_view = img.reshape(-1)
+    cdef unsigned char[::1] out_img_view = out_img.reshape(-1)
+    cdef int[::1] out_kept_view = out_kept.reshape(-1)
+
+    chunks = max(1, min(threads, out_height))
+    chunk_height = (out_height + chunks - 1) // chunks
+    chunks = (out_height + chunk_height - 1) // chunk_height
+
+    acc = <int64_t *>malloc(chunks * out_width * channels * sizeof(int64_t))
+    if acc == NULL:
+        raise MemoryError()
+
+    for chunk in prange(chunks, nogil=True, num_threads=chunks,
+                        schedule='static'):
+        _downsample_masked_rows(&mask_view[0, 0], &img_view[0],
+                                &out_img_view[0], &out_kept_view[0],
+                                acc + chunk * out_width * channels, width,
+                                height, channels, factor, invert,
+                                chunk * chunk_height,
+                                min(out_height, (chunk + 1) * chunk_height))
+
+    free(acc)
+
+    return out_img, out_kept
@@ -0,0 +1,356 @@
+# Removal of speckles (small connected components) from masks.
+#
+# The mask is scanned row by row for runs of pixels of the same value, and the
+# runs are joined into connected components with union-find (a run joins the
+# components of the runs in the row above that it touches). Components that
+# are smaller than the area threshold at their location are then removed by
+# flipping their runs.
+#
+# This works on bool masks (one byte per pixel) and on bit-packed masks (the
+# most significant bit first, like np.packbits and PIL '1' images), in place.
+#
+# License: AGPL-v3
+
+import numpy as np
+cimport cython
+from libc.stdint cimport int64_t, uint8_t
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memset
+
+
+cdef struct Components:
+    # Runs, row by row: [start, end) and the component they belong to
+    int *run_start
+    int *run_end
+    int *run_label
+    int64_t runs
+    int64_t run_capacity
+    # Index of the first run of every row, and of the end of the last row
+    int64_t *row_first
+    # Union-find forest of the components; the root of a component is its
+    # first (top, left most) run's label
+    int *parent
+    int64_t *area
+    int *pos_x
+    int *pos_y
+    bint *border
+    int labels
+    int label_capacity
+
+
+cdef inline bint _pixel(const uint8_t *row, bint packed, int x) noexcept nogil:
+    if packed:
+        return (row[x >> 3] >> (7 - (x & 7))) & 1
+    return row[x] != 0
+
+
+cdef void _set_run(uint8_t *row, bint packed, int start, int end,
+                   bint value) noexcept nogil:
+    cdef int x
+    if not packed:
+        memset(row + start, value, end - start)
+        return
+    for x in range(start, end):
+        if value:
+            row[x >> 3] |= 0x80 >> (x & 7)
+        else:
+            row[x >> 3] &= ~(0x80 >> (x & 7))
+
+
+cdef int _add_run(Components *c, int start, int end) noexcept nogil:
+    cdef int64_t capacity
+    cdef void *p
+    if c.runs == c.run_capacity:
+        capacity = c.run_capacity * 2
+        p = realloc(c.run_start, capacity * sizeof(int))
+        if p == NULL:
+            return -1
+        c.run_start = <int *>p
+        p = realloc(c.run_end, capacity * sizeof(int))
+        if p == NULL:
+            return -1
+        c.run_end = <int *>p
+        p = realloc(c.run_label, capacity * sizeof(int))
+        if p == NULL:
+            return -1
+        c.run_label = <int *>p
+        c.run_capacity = capacity
+    c.run_start[c.runs] = start
+    c.run_end[c.runs] = end
+    c.run_label[c.runs] = -1
+    c.runs += 1
+    return 0
+
+
+cdef int _new_label(Components *c, int x, int y, bint border) noexcept nogil:
+    cdef int capacity
+    cdef void *p
+    if c.labels == c.label_capacity:
+        capacity = c.label_capacity * 2
+        p = realloc(c.parent, capacity * sizeof(int))
+        if p == NULL:
+            return -1
+        c.parent = <int *>p
+        p = realloc(c.area, capacity * sizeof(int64_t))
+        if p == NULL:
+            return -1
+        c.area = <int64_t *>p
+        p = realloc(c.pos_x, capacity * sizeof(int))
+        if p == NULL:
+            return -1
+        c.pos_x = <int *>p
+        p = realloc(c.pos_y, capacity * sizeof(int))
+        if p == NULL:
+            return -1
+        c.pos_y = <int *>p
+        p = realloc(c.border, capacity * sizeof(bint))
+        if p == NULL:
+            return -1
+        c.border = <bint *>p
+        c.label_capacity = capacity
+    c.parent[c.labels] = c.labels
+    c.area[c.labels] = 0
+    c.pos_x[c.labels] = x
+    c.pos_y[c.labels] = y
+    c.border[c.labels] = border
+    c.labels += 1
+    return c.labels - 1
+
+
+cdef inline int _find(int *parent, int label) noexcept nogil:
+    cdef int root = label, next_label
+    while parent[root] != root:
+        root = parent[root]
+    # Path compression
+    while parent[label] != root:
+        next_label = parent[label]
+        parent[label] = root
+        label = next_label
+    return root
+
+
+cdef inline int _union(Components *c, int a, int b) noexcept nogil:
+    a = _find(c.parent, a)
+    b = _find(c.parent, b)
+    if a == b:
+        return a
+    if b < a:
+        a, b = b, a
+    c.parent[b] = a
+    c.area[a] += c.area[b]
+    c.border[a] = c.border[a] or c.border[b]
+    return a
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _label(Components *c, const uint8_t *mask, bint packed,
+                int64_t stride, int width, int height, bint value,
+                bint diagonal) noexcept nogil:
+    # Finds the runs of pixels with value value and joins them into
+    # components, 8-connected if diagonal, else 4-connected. Returns -1 if out
+    # of memory.
+    cdef int x, y, start, label, reach
+    cdef int64_t r, p, prev_first, prev_last
+    cdef const uint8_t *row
+
+    reach = 1 if diagonal else 0
+    c.runs = 0
+    c.labels = 0
+
+    for y in range(height):
+        row = mask + y * stride
+        c.row_first[y] = c.runs
+
+        x = 0
+        while x < width:
+            if packed and (x & 7) == 0 and x + 8 <= width and \
+                    row[x >> 3] == (0 if value else 0xff):
+                # Skip whole bytes without pixels of value
+                x += 8
+                continue
+            if _pixel(row, packed, x) != value:
+                x += 1
+                continue
+            start = x
+            while x < width and _pixel(row, packed, x) == value:
+                x += 1
+            if _add_run(c, start, x) < 0:
+                return -1
+
+        # Join the runs of this row with the ones they touch in the row above
+        prev_first = c.row_first[y - 1] if y > 0 else c.runs
+        prev_last = c.row_first[y]
+        p = prev_first
+        for r in range(c.row_first[y], c.runs):
+            start = c.run_start[r]
+            # Skip the runs above that end before this one starts
+            while p < prev_last and c.run_end[p] + reach <= start:
+                p += 1
+            label = -1
+            while p < prev_last and c.run_start[p] < c.run_end[r] + reach:
+                if label < 0:
+                    label = _find(c.parent, c.run_label[p])
+                else:
+                    label = _union(c, label, c.run_label[p])
+                if c.run_end[p] > c.run_end[r]:
+                    # This run above may touch the next run in this row too
+                    break
+                p += 1
+            if label < 0:
+                label = _new_label(c, start, y,
+                                   y == 0 or y == height - 1 or start == 0 or
+                                   c.run_end[r] == width)
+                if label < 0:
+                    return -1
+            elif y == height - 1 or start == 0 or c.run_end[r] == width:
+                c.border[label] = True
+            c.run_label[r] = label
+            c.area[label] += c.run_end[r] - start
+
+    c.row_first[height] = c.runs
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int64_t _flip_small(Components *c, uint8_t *mask, bint packed,
+                         int64_t stride, int height, bint value,
+                         const int *areas, int cells_x, int cell_size,
+                         bint keep_border) noexcept nogil:
+    # Flips the runs of the components that are smaller than the area
+    # threshold of the cell of their first pixel (and that do not touch the
+    # border of the mask, if keep_border). Returns the amount of flipped
+    # components.
+    cdef int y, label, threshold
+    cdef int64_t r, flipped = 0
+
+    # Decide per component, marking the ones to flip with a negative area
+    for label in range(c.labels):
+        if c.parent[label] != label:
+            continue
+        threshold = areas[(c.pos_y[label] // cell_size) * cells_x +
+                          c.pos_x[label] // cell_size]
+        if c.area[label] < threshold and not \
+                (keep_border and c.border[label]):
+            c.area[label] = -1
+            flipped += 1
+
+    for y in range(height):
+        for r in range(c.row_first[y], c.row_first[y + 1]):
+            label = _find(c.parent, c.run_label[r])
+            if c.area[label] < 0:
+                _set_run(mask + y * stride, packed, c.run_start[r],
+                         c.run_end[r], not value)
+
+    return flipped
+
+
+cdef void _free_components(Components *c) noexcept nogil:
+    free(c.run_start)
+    free(c.run_end)
+    free(c.run_label)
+    free(c.row_first)
+    free(c.parent)
+    free(c.area)
+    free(c.pos_x)
+    free(c.pos_y)
+    free(c.border)
+
+
+def remove_speckles(mask, areas, int cell_size, width=None,
+                    bint fill_holes=True):
+    """
+    Remove speckles from mask, in place: the (8-connected) components of set
+    pixels that have fewer pixels than their area threshold. If fill_holes is
+    set, the holes in what remains, the (4-connected) components of unset
+    pixels that have fewer pixels than their area threshold and do not touch
+    the border of the mask, are filled as well.
+
+    Args:
+
+    * mask (numpy.array): The mask, a 2D bool (or uint8) array, or, if width
+      is given, a 2D uint8 array of bit-packed rows, with the most
+      significant bit first (like np.packbits and PIL '1' images)
+    * areas (numpy.array): 2D array of the area thresholds of the cells of
+      cell_size by cell_size pixels of the mask. A component gets the
+      threshold of the cell of its top (left most) pixel.
+    * cell_size (int): Size of the cells of areas, in pixels
+    * width (int): The amount of pixels per row of a bit-packed mask
+    * fill_holes (bool): Whether to fill small holes as well
+
+    Returns a tuple of the amount of removed components and filled holes
+    """
+    cdef uint8_t[:, ::1] mask_view
+    cdef const int[:, ::1] areas_view
+    cdef Components c
+    cdef int mask_width, height, cells_x, ret = 0
+    cdef bint packed = width is not None
+    cdef int64_t stride, removed = 0, filled = 0
+
+    if mask.ndim != 2:
+        raise ValueError('mask should be a 2D array')
+    if mask.dtype == np.bool_:
+        mask = mask.view(np.uint8)
+    mask_view = mask
+    height = mask.shape[0]
+    stride = mask.shape[1]
+    if packed:
+        mask_width = width
+        if (mask_width + 7) // 8 > stride:
+            raise ValueError('Packed rows too short for width %d' % width)
+    else:
+        mask_width = stride
+
+    if cell_size <= 0:
+        raise ValueError('cell_size should be positive')
+    areas = np.ascontiguousarray(areas, dtype=np.intc)
+    areas_view = areas
+    if areas.shape[0] * cell_size < height or \
+            areas.shape[1] * cell_size < mask_width:
+        raise ValueError('areas do not cover the mask')
+    cells_x = areas.shape[1]
+
+    if height == 0 or mask_width == 0:
+        return 0, 0
+
+    memset(&c, 0, sizeof(Components))
+    c.run_capacity = 1024
+    c.label_capacity = 1024
+    c.run_start = <int *>malloc(c.run_capacity * sizeof(int))
+    c.run_end = <int *>malloc(c.run_capacity * sizeof(int))
+    c.run_label = <int *>malloc(c.run_capacity * sizeof(int))
+    c.row_first = <int64_t *>malloc((height + 1) * sizeof(int64_t))
+    c.parent = <int *>malloc(c.label_capacity * sizeof(int))
+    c.area = <int64_t *>malloc(c.label_capacity * sizeof(int64_t))
+    c.pos_x = <int *>malloc(c.label_capacity * sizeof(int))
+    c.pos_y = <int *>malloc(c.label_capacity * sizeof(int))
+    c.border = <bint *>malloc(c.label_capacity * sizeof(bint))
+    if c.run_start == NULL or c.run_end == NULL or c.run_label == NULL or \
+            c.row_first == NULL or c.parent == NULL or c.area == NULL or \
+            c.pos_x == NULL or c.pos_y == NULL or c.border == NULL:
+        _free_components(&c)
+        raise MemoryError()
+
+    with nogil:
+        ret = _label(&c, &mask_view[0, 0], packed, stride, mask_width, height,
+                     True, True)
+        if ret == 0:
+            removed = _flip_small(&c, &mask_view[0, 0], packed, stride,
+                                  height, True, &areas_view[0, 0], cells_x,
+                                  cell_size, False)
+        if ret == 0 and fill_holes:
+            ret = _label(&c, &mask_view[0, 0], packed, stride, mask_width,
+                         height, False, False)
+            if ret == 0:
+                filled = _flip_small(&c, &mask_view[0, 0], packed, stride,
+                                     height, False, &areas_view[0, 0],
+                                     cells_x, cell_size, True)
+
+    _free_components(&c)
+    if ret != 0:
+        raise MemoryError()
+
+    return removed, filled
@@ -2,4 +2,10 @@ from . import pdfrenderer
 from . import mrc
 from . import scandata
 from . import pagenumbers
+from . import scratch
+from . import checkpoint
+from . import segmentcache
+from . import spool
+from . import passthrough
+from . import imageprobe
 from . import recode
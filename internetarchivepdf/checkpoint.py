@@ -0,0 +1,165 @@
+"""
+Checkpoints for resumable recodes.
+
+A checkpoint directory holds the encoded images of every page that has been
+compressed, so that a recode that crashed or was killed can be resumed
+without compressing those pages again. The directory contains:
+
+* ``manifest.json``: the key of the recode (a hash of the inputs and the
+  parameters, see checkpoint_key)
+* ``<page>.json``: the sizes and errors of a finished page, written last
+* ``<page>_mask``, ``<page>_fg``, ``<page>_bg``: the encoded images of a page
+"""
+
+import os
+import re
+import json
+import hashlib
+from os.path import join
+
+
+MANIFEST_NAME = 'manifest.json'
+
+# Names of the files of a page (and their temporary files, see _write_file)
+PAGE_FILE_RE = re.compile(r'^(\d{6})(\.json|_mask|_fg|_bg)(\.tmp)?$')
+
+
+def file_identity(path):
+    """
+    Returns a (cheap) identity of a file for use in checkpoint_key: its
+    absolute path, size and modification time. None if path is None.
+    """
+    if path is None:
+        return None
+
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+
+def checkpoint_key(params):
+    """
+    Returns the key (str) for a recode with params, a dict of JSON
+    serialisable values that describe the inputs (see file_identity) and all
+    the parameters that affect the compressed pages.
+    """
+    data = json.dumps(params, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def _write_file(path, data):
+    # Write to a temporary file first, so that a page is never half written
+    tmp_path = path + '.tmp'
+    fp = open(tmp_path, 'wb+')
+    fp.write(data)
+    fp.close()
+    os.replace(tmp_path, path)
+
+
+def _read_file(path):
+    fp = open(path, 'rb')
+    data = fp.read()
+    fp.close()
+    return data
+
+
+class Checkpoint(object):
+    """
+    Checkpoint directory of a recode, see the module documentation.
+
+    If resume is set and the manifest in the directory has the same key, the
+    pages in the directory are used. Otherwise the directory is cleared and
+    started anew. Only page files are ever removed, and a directory that is
+    not empty but has no manifest is refused (ValueError), since it is not a
+    checkpoint directory.
+    """
+
+    def __init__(self, path, key, resume=False):
+        """
+        Args:
+
+        * path (str): Checkpoint directory, created if it does not exist
+        * key (str): Key of the recode, as returned by checkpoint_key
+        * resume (bool): Whether to use the pages already in the directory
+        """
+        self.path = path
+        self.key = key
+        self.pages = set()
+
+        os.makedirs(path, exist_ok=True)
+
+        manifest = None
+        manifest_path = join(path, MANIFEST_NAME)
+        if not os.path.exists(manifest_path) and os.listdir(path):
+            raise ValueError('Not a checkpoint directory (no %s and not '
+                             'empty): %s' % (MANIFEST_NAME, path))
+        if os.path.exists(manifest_path):
+            try:
+                manifest = json.loads(_read_file(manifest_path))
+            except ValueError:
+                manifest = None
+
+        if resume and manifest is not None and manifest.get('key') == key:
+            for name in os.listdir(path):
+                m = PAGE_FILE_RE.match(name)
+                if m is not None and m.group(2) == '.json' and \
+                        m.group(3) is None:
+                    self.pages.add(int(m.group(1)))
+        else:
+            self.clear()
+            _write_file(manifest_path,
+                        json.dumps({'key': key}).encode('utf-8'))
+
+    def clear(self):
+        """
+        Removes all pages from the checkpoint directory. Other files are left
+        alone.
+        """
+        for name in os.listdir(self.path):
+            if PAGE_FILE_RE.match(name) is not None:
+                os.remove(join(self.path, name))
+        self.pages = set()
+
+    def _page_path(self, idx, name):
+        return join(self.path, '%.6d%s' % (idx, name))
+
+    def has_page(self, idx):
+        """
+        Returns whether page idx is in the checkpoint.
+        """
+        return idx in self.pages
+
+    def load_page(self, idx):
+        """
+        Returns page idx as a dict like the ones returned by
+        internetarchivepdf.recode.create_mrc_page (with empty timing data).
+        """
+        meta = json.loads(_read_file(self._page_path(idx, '.json')))
+
+        page_data = {'timing_data': [], 'errors': set(meta['errors'])}
+        for key in ('mask', 'fg', 'bg'):
+            size = meta[key + '_size']
+            page_data[key + '_size'] = tuple(size) if size is not None else None
+            if meta['has_' + key]:
+                page_data[key] = _read_file(self._page_path(idx, '_' + key))
+            else:
+                page_data[key] = None
+
+        return page_data
+
+    def save_page(self, idx, page_data):
+        """
+        Stores page idx, a dict as returned by
+        internetarchivepdf.recode.create_mrc_page.
+        """
+        meta = {'errors': sorted(page_data['errors'])}
+        for key in ('mask', 'fg', 'bg'):
+            size = page_data[key + '_size']
+            meta[key + '_size'] = list(size) if size is not None else None
+            meta['has_' + key] = page_data[key] is not None
+            if page_data[key] is not None:
+                _write_file(self._page_path(idx, '_' + key), page_data[key])
+
+        # The page only counts as done once this is written
+        _write_file(self._page_path(idx, '.json'),
+                    json.dumps(meta).encode('utf-8'))
+        self.pages.add(idx)
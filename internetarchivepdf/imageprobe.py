@@ -0,0 +1,273 @@
+"""
+Image dimension probe.
+
+Reads the size of an image from its header, without decoding it (and
+without reading the whole file, as Pillow does for JPEG2000 images): the box
+structure of JP2/JPX files (the image header box, or the SIZ marker of the
+codestream if the image header box is missing or broken), raw JPEG2000
+codestreams, PNG, JPEG and TIFF. Other formats are opened with Pillow, which
+only reads their header.
+
+The results are cached per file, so that all passes over the images of a book
+can ask for their size again.
+"""
+
+import os
+import struct
+from collections import namedtuple
+
+from PIL import Image
+
+
+JP2_SIGNATURE = b'\x00\x00\x00\x0cjP  \r\n\x87\n'
+J2K_SIGNATURE = b'\xff\x4f\xff\x51'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+JPEG_SIGNATURE = b'\xff\xd8'
+TIFF_SIGNATURES = (b'II*\x00', b'MM\x00*')
+
+# JPEG start of frame markers (all but DHT, JPG and DAC), which contain the
+# image size
+JPEG_SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+# JPEG markers without a length
+JPEG_STANDALONE_MARKERS = set(range(0xd0, 0xda)) | {0x01, 0xff}
+
+TIFF_TAG_IMAGE_WIDTH = 256
+TIFF_TAG_IMAGE_LENGTH = 257
+TIFF_TYPE_SHORT = 3
+TIFF_TYPE_LONG = 4
+
+# Maximum amount of (JP2) boxes, (JPEG) segments or (TIFF) tags to look at
+MAX_ITEMS = 1024
+# Amount of bytes to read at once when looking for the next JPEG marker
+CHUNK_SIZE = 4096
+
+
+ImageProbe = namedtuple('ImageProbe', ('format', 'size', 'header_valid'))
+ImageProbe.__doc__ = """
+Result of probe_image: the format ('JPEG2000', 'PNG', 'JPEG', 'TIFF' or as
+reported by Pillow), the size (width, height) and, for JP2/JPX files,
+whether the size came from a valid image header box (if not, it came from the
+codestream).
+"""
+
+_cache = {}
+
+
+def _read(fd, offset, length):
+    fd.seek(offset)
+    data = fd.read(length)
+    if len(data) != length:
+        raise ValueError('Unexpected end of file')
+    return data
+
+
+def _j2k_size(fd, offset):
+    # Reads the size from the SIZ marker of the codestream at offset
+    siz = _read(fd, offset, 24)
+    if siz[:4] != J2K_SIGNATURE:
+        raise ValueError('No SIZ marker in JPEG2000 codestream')
+    xsiz, ysiz, xosiz, yosiz = struct.unpack('>IIII', siz[8:24])
+    if xsiz <= xosiz or ysiz <= yosiz:
+        raise ValueError('Invalid JPEG2000 codestream size')
+    return xsiz - xosiz, ysiz - yosiz
+
+
+def _jp2_boxes(fd, offset, end):
+    # Yields the (type, offset of the contents, end) of the boxes from offset
+    # to end (None for the end of the file)
+    for _ in range(MAX_ITEMS):
+        if end is not None and offset + 8 > end:
+            return
+        fd.seek(offset)
+        header = fd.read(8)
+        if len(header) < 8:
+            return
+        length, box_type = struct.unpack('>I4s', header)
+        contents = offset + 8
+        if length == 1:
+            length, = struct.unpack('>Q', _read(fd, contents, 8))
+            contents += 8
+        if length == 0:
+            box_end = end
+        elif length < contents - offset:
+            raise ValueError('Invalid JP2 box length')
+        else:
+            box_end = offset + length
+
+        yield box_type, contents, box_end
+
+        if box_end is None:
+            return
+        offset = box_end
+
+
+def probe_jpeg2000(fd):
+    """
+    Returns the size (width, height) of the JP2/JPX file or JPEG2000
+    codestream fd, and whether it came from a valid image header box (False
+    for codestreams, and for files where the codestream was used instead).
+    """
+    if _read(fd, 0, 4) == J2K_SIGNATURE:
+        return _j2k_size(fd, 0), False
+
+    codestream = None
+    for box_type, contents, end in _jp2_boxes(fd, 0, None):
+        if box_type == b'jp2h':
+            for sub_type, sub_contents, _ in _jp2_boxes(fd, contents, end):
+                if sub_type != b'ihdr':
+                    continue
+                height, width = struct.unpack('>II',
+                                              _read(fd, sub_contents, 8))
+                if width > 0 and height > 0:
+                    return (width, height), True
+                break
+        elif box_type == b'jp2c':
+            codestream = contents
+            break
+
+    if codestream is None:
+        raise ValueError('No image header or codestream in JP2 file')
+    return _j2k_size(fd, codestream), False
+
+
+def probe_png(fd):
+    """
+    Returns the size (width, height) of the PNG file fd.
+    """
+    header = _read(fd, 8, 16)
+    if header[4:8] != b'IHDR':
+        raise ValueError('No IHDR chunk in PNG file')
+    return struct.unpack('>II', header[8:16])
+
+
+def _jpeg_next_marker(fd, offset):
+    # Returns the offset of the first 0xFF byte from offset
+    for _ in range(MAX_ITEMS):
+        fd.seek(offset)
+        chunk = fd.read(CHUNK_SIZE)
+        if not chunk:
+            raise ValueError('Unexpected end of file')
+        idx = chunk.find(b'\xff')
+        if idx >= 0:
+            return offset + idx
+        offset += len(chunk)
+
+    raise ValueError('No JPEG marker')
+
+
+def probe_jpeg(fd):
+    """
+    Returns the size (width, height) of the JPEG file fd. Stray bytes between
+    segments are skipped, like Pillow does.
+    """
+    offset = 2
+    for _ in range(MAX_ITEMS):
+        marker = _read(fd, offset, 2)
+        if marker[0] != 0xff:
+            offset = _jpeg_next_marker(fd, offset)
+            continue
+        if marker[1] == 0xff:
+            # Fill byte
+            offset += 1
+            continue
+        if marker[1] in JPEG_STANDALONE_MARKERS:
+            offset += 2
+            continue
+
+        length, = struct.unpack('>H', _read(fd, offset + 2, 2))
+        if marker[1] in JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', _read(fd, offset + 5, 4))
+            if width == 0 or height == 0:
+                # The height can be defined by a DNL marker, rarely used
+                raise ValueError('No size in JPEG frame header')
+            return width, height
+        if marker[1] == 0xda:
+            raise ValueError('No JPEG frame header before scan')
+        offset += 2 + length
+
+    raise ValueError('No JPEG frame header')
+
+
+def probe_tiff(fd):
+    """
+    Returns the size (width, height) of the (first image of the) TIFF file
+    fd.
+    """
+    header = _read(fd, 0, 8)
+    endian = '<' if header[:2] == b'II' else '>'
+    ifd, = struct.unpack(endian + 'I', header[4:8])
+    count, = struct.unpack(endian + 'H', _read(fd, ifd, 2))
+
+    size = {}
+    entries = _read(fd, ifd + 2, 12 * min(count, MAX_ITEMS))
+    for idx in range(min(count, MAX_ITEMS)):
+        tag, typ, _, value = struct.unpack(endian + 'HHI4s',
+                                           entries[idx * 12:idx * 12 + 12])
+        if tag not in (TIFF_TAG_IMAGE_WIDTH, TIFF_TAG_IMAGE_LENGTH):
+            continue
+        if typ == TIFF_TYPE_SHORT:
+            size[tag], = struct.unpack(endian + 'H', value[:2])
+        elif typ == TIFF_TYPE_LONG:
+            size[tag], = struct.unpack(endian + 'I', value)
+
+    if TIFF_TAG_IMAGE_WIDTH not in size or TIFF_TAG_IMAGE_LENGTH not in size:
+        raise ValueError('No image size in TIFF file')
+    return size[TIFF_TAG_IMAGE_WIDTH], size[TIFF_TAG_IMAGE_LENGTH]
+
+
+def probe_image(path):
+    """
+    Probe the size of the image file at path from its header (see the module
+    documentation). Results are cached per file (path, modification time and
+    file size).
+
+    Args:
+
+    * path (str): Path to the image file
+
+    Returns an ImageProbe. Raises ValueError if the size cannot be read.
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key in _cache:
+        return _cache[key]
+
+    with open(path, 'rb') as fd:
+        signature = fd.read(12)
+        header_valid = True
+        try:
+            if signature == JP2_SIGNATURE or \
+                    signature.startswith(J2K_SIGNATURE):
+                image_format = 'JPEG2000'
+                size, header_valid = probe_jpeg2000(fd)
+            elif signature.startswith(PNG_SIGNATURE):
+                image_format = 'PNG'
+                size = probe_png(fd)
+            elif signature.startswith(JPEG_SIGNATURE):
+                image_format = 'JPEG'
+                size = probe_jpeg(fd)
+            elif signature[:4] in TIFF_SIGNATURES:
+                image_format = 'TIFF'
+                size = probe_tiff(fd)
+            else:
+                image_format = None
+        except struct.error:
+            raise ValueError('Invalid image header in %s' % path)
+
+    if image_format is None:
+        # Pillow only reads the header until the image is loaded
+        img = Image.open(path)
+        image_format = img.format
+        size = img.size
+        img.close()
+
+    probe = ImageProbe(image_format, tuple(size), header_valid)
+    _cache[key] = probe
+    return probe
+
+
+def clear_cache():
+    """
+    Forget the probed images.
+    """
+    _cache.clear()
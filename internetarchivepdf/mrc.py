@@ -1,30 +1,36 @@
 # Author: Merlijn Boris Wolf Wajer <merlijn@archive.org>
 
 import sys
-from os import close, remove
+from io import BytesIO
 
 from glob import glob
-from tempfile import mkstemp
 import subprocess
 from time import time
+from concurrent.futures import ThreadPoolExecutor
+from shutil import which
 
 import warnings
 
-from PIL import Image, ImageEnhance, ImageOps
+from PIL import Image, ImageEnhance, ImageOps, features
 from skimage.filters import threshold_local, threshold_otsu, threshold_sauvola
-from skimage.restoration import denoise_tv_bregman, estimate_sigma
+from skimage.restoration import estimate_sigma
 
 from scipy import ndimage
 import numpy as np
 
-from optimiser import optimise_gray, optimise_rgb, optimise_gray2, optimise_rgb2
+from optimiser import optimise_gray, optimise_rgb, optimise_gray2, optimise_rgb2, \
+        optimise_fg_bg_gray2, optimise_fg_bg_rgb2, downsample_masked
 from sauvola import binarise_sauvola
+from hocrmask import threshold_words
+from noise import wavelet_sigma, laplacian_sigma
+from speckle import remove_speckles
 
 import fitz
 
 fitz.TOOLS.set_icc(True) # For good measure, not required
 
 from internetarchivepdf.const import (RECODE_RUNTIME_WARNING_TOO_SMALL_TO_DOWNSAMPLE,)
+from internetarchivepdf.scratch import scratch_path, memory_file, read_file
 
 
 """
@@ -36,6 +42,273 @@ OPJ_COMPRESS = 'opj_compress'
 OPJ_DECOMPRESS = 'opj_decompress'
 
 
+def kdu_num_threads(threads):
+    """
+    Returns the -num_threads argument for kdu_compress/kdu_expand for the
+    given amount of threads; 0 makes Kakadu run in the calling thread only.
+    """
+    if threads is None or threads <= 1:
+        return '0'
+    return str(threads)
+
+
+JPEG2000_CODEC_KAKADU = 'kakadu'
+JPEG2000_CODEC_OPENJPEG = 'openjpeg'
+JPEG2000_CODEC_PILLOW = 'pillow'
+
+# OpenJPEG does not know about Kakadu slopes, so it uses fixed compression
+# settings per layer: (quality_mode, quality_layer), where 'rates' is a
+# compression ratio and 'dB' a PSNR.
+OPENJPEG_LAYER_QUALITY = {
+    'bg': ('rates', 400),
+    'fg': ('dB', 25),
+}
+
+
+class JPEG2000Codec(object):
+    """
+    A JPEG2000 encoder and decoder. Subclasses implement encode and decode;
+    use get_jpeg2000_codec to get a codec by name.
+    """
+    name = None
+    # External tools this codec needs in $PATH
+    tools = ()
+
+    def available(self):
+        """
+        Returns whether all the tools this codec needs can be found.
+        """
+        return all(which(tool) for tool in self.tools)
+
+    def encode(self, np_img, layer, slope, threads=None, tmp_dir=None):
+        """
+        Encode an image to JPEG2000.
+
+        Args:
+
+        * np_img (numpy.array): Image array
+        * layer (str): MRC layer of the image, 'fg' or 'bg'
+        * slope (int): Compression parameter(s), WIP
+        * threads (int): Amount of threads the encoder may use (default is one)
+        * tmp_dir (str): path the temporary directory to write images to, if
+          they cannot be kept in memory
+
+        Returns the JPEG2000 image (bytes)
+        """
+        raise NotImplementedError()
+
+    def decode(self, path, reduce=0, tmp_dir=None):
+        """
+        Decode a JPEG2000 image.
+
+        Args:
+
+        * path (str): Path to the JPEG2000 image
+        * reduce (int): Amount of resolution levels to discard while decoding
+        * tmp_dir (str): path the temporary directory to write images to, if
+          they cannot be kept in memory
+
+        Returns the decoded PIL.Image
+        """
+        raise NotImplementedError()
+
+
+class KakaduCodec(JPEG2000Codec):
+    """
+    Encodes and decodes using kdu_compress and kdu_expand.
+    """
+    name = JPEG2000_CODEC_KAKADU
+    tools = (KDU_COMPRESS, KDU_EXPAND)
+
+    def encode(self, np_img, layer, slope, threads=None, tmp_dir=None):
+        # TODO: check if kakadu supports .tif
+        with scratch_path(prefix=layer, suffix='.tiff', tmp_dir=tmp_dir) as img_tiff, \
+             scratch_path(prefix=layer, suffix='.jp2', tmp_dir=tmp_dir) as img_jp2:
+            Image.fromarray(np_img).save(img_tiff)
+
+            subprocess.check_call([KDU_COMPRESS,
+                '-num_threads', kdu_num_threads(threads),
+                '-i', img_tiff, '-o', img_jp2,
+                '-slope', str(slope),
+                ], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+            return read_file(img_jp2)
+
+    def decode(self, path, reduce=0, tmp_dir=None):
+        args = [KDU_EXPAND, '-i', path]
+        if reduce:
+            args += ['-reduce', str(reduce)]
+
+        with scratch_path(prefix='in', suffix='.tiff', tmp_dir=tmp_dir) as img_tiff:
+            subprocess.check_call(args + ['-o', img_tiff],
+                    stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+            image = Image.open(img_tiff)
+            image.load()
+
+        return image
+
+
+class OpenJPEGCodec(JPEG2000Codec):
+    """
+    Encodes and decodes using opj_compress and opj_decompress. The
+    compression settings are fixed per layer, see OPENJPEG_LAYER_QUALITY.
+    """
+    name = JPEG2000_CODEC_OPENJPEG
+    tools = (OPJ_COMPRESS, OPJ_DECOMPRESS)
+
+    def encode(self, np_img, layer, slope, threads=None, tmp_dir=None):
+        quality_mode, quality = OPENJPEG_LAYER_QUALITY[layer]
+        quality_arg = '-r' if quality_mode == 'rates' else '-q'
+
+        with scratch_path(prefix=layer, suffix='.pnm', tmp_dir=tmp_dir) as img_pnm, \
+             scratch_path(prefix=layer, suffix='.jp2', tmp_dir=tmp_dir) as img_jp2:
+            Image.fromarray(np_img).save(img_pnm)
+
+            subprocess.check_call([OPJ_COMPRESS,
+                '-threads', str(threads or 1),
+                '-i', img_pnm, '-o', img_jp2,
+                quality_arg, str(quality),
+                ], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+            return read_file(img_jp2)
+
+    def decode(self, path, reduce=0, tmp_dir=None):
+        args = [OPJ_DECOMPRESS, '-i', path]
+        if reduce:
+            args += ['-r', str(reduce)]
+
+        with scratch_path(prefix='in', suffix='.pnm', tmp_dir=tmp_dir) as img_pnm:
+            subprocess.check_call(args + ['-o', img_pnm],
+                    stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+            image = Image.open(img_pnm)
+            image.load()
+
+        return image
+
+
+def load_jpeg2000(open_image, reduce=0):
+    """
+    Load a JPEG2000 image with Pillow, discarding reduce resolution levels.
+
+    Pillow rounds the size of the reduced image to the nearest pixel, while
+    OpenJPEG rounds it up, so for some odd image sizes the reduced decode
+    fails with an OSError. The image is then decoded at full resolution
+    instead.
+
+    Args:
+
+    * open_image (function): Returns the image (PIL.Image, not loaded yet),
+      called again for the full resolution decode
+    * reduce (int): Amount of resolution levels to discard
+
+    Returns the loaded PIL.Image.
+    """
+    image = open_image()
+    if reduce:
+        image.reduce = reduce
+        try:
+            image.load()
+            return image
+        except OSError:
+            image.close()
+            image = open_image()
+
+    image.load()
+    return image
+
+
+class PillowCodec(JPEG2000Codec):
+    """
+    Encodes and decodes in-process, using the OpenJPEG bindings of Pillow.
+    This avoids starting a process and writing an intermediate image for every
+    call. The compression settings are the ones of OpenJPEGCodec. Pillow
+    does not expose the OpenJPEG thread count, so threads is ignored.
+    """
+    name = JPEG2000_CODEC_PILLOW
+
+    def available(self):
+        return features.check('jpg_2000')
+
+    def encode(self, np_img, layer, slope, threads=None, tmp_dir=None):
+        quality_mode, quality = OPENJPEG_LAYER_QUALITY[layer]
+
+        fd = BytesIO()
+        Image.fromarray(np_img).save(fd, format='JPEG2000',
+                quality_mode=quality_mode, quality_layers=[quality])
+        data = fd.getvalue()
+        fd.close()
+
+        return data
+
+    def decode(self, path, reduce=0, tmp_dir=None):
+        return load_jpeg2000(lambda: Image.open(path), reduce=reduce)
+
+
+JPEG2000_CODECS = {
+    JPEG2000_CODEC_KAKADU: KakaduCodec(),
+    JPEG2000_CODEC_OPENJPEG: OpenJPEGCodec(),
+    JPEG2000_CODEC_PILLOW: PillowCodec(),
+}
+
+
+def get_jpeg2000_codec(name=None, use_kdu=True):
+    """
+    Returns the JPEG2000Codec called name. If name is None, this is Kakadu or
+    OpenJPEG, depending on use_kdu.
+    """
+    if name is None:
+        name = JPEG2000_CODEC_KAKADU if use_kdu else JPEG2000_CODEC_OPENJPEG
+
+    try:
+        return JPEG2000_CODECS[name]
+    except KeyError:
+        raise ValueError('Unknown JPEG2000 codec: %s' % name)
+
+
+# Window size of the Sauvola thresholding in threshold_image3
+SAUVOLA_WINDOW_SIZE = 51
+
+# Block size of the local thresholding in threshold_image (and of the words in
+# the hOCR mask)
+LOCAL_THRESHOLD_BLOCK_SIZE = 9
+
+# Neighbourhood sizes of the foreground and background optimisation
+FOREGROUND_OPTIMISE_SIZE = 3
+BACKGROUND_OPTIMISE_SIZE = 10
+
+
+# Noise estimators of estimate_noise: 'wavelet' computes exactly what
+# mean_estimate_sigma computes, only faster, 'laplacian' is faster still, but
+# its estimates differ somewhat (see the noise module)
+NOISE_ESTIMATOR_WAVELET = 'wavelet'
+NOISE_ESTIMATOR_LAPLACIAN = 'laplacian'
+NOISE_ESTIMATORS = (NOISE_ESTIMATOR_WAVELET, NOISE_ESTIMATOR_LAPLACIAN)
+
+# Images with a higher noise estimate are blurred before they are
+# thresholded, and thresholded images (masks) with a higher noise estimate
+# are denoised. The thresholds of the laplacian estimator are calibrated with
+# tools/noise-calibration to make the same decisions as the wavelet
+# estimator. For images they do; for masks (where the wavelet estimate is
+# rather erratic) they mostly do, which is why masks default to the wavelet
+# estimator.
+BLUR_NOISE_THRESHOLD = {
+    NOISE_ESTIMATOR_WAVELET: 1.0,
+    NOISE_ESTIMATOR_LAPLACIAN: 0.96,
+}
+DENOISE_NOISE_THRESHOLD = {
+    NOISE_ESTIMATOR_WAVELET: 0.1,
+    NOISE_ESTIMATOR_LAPLACIAN: 0.17,
+}
+
+# Denoising a mask removes the connected components (and fills the holes)
+# smaller than (SPECKLE_SIZE * text height)^2 pixels, where the text height is
+# taken from the hOCR words per cell of SPECKLE_CELL_SIZE pixels, see
+# speckle_areas. Pages without words use DEFAULT_SPECKLE_AREA.
+SPECKLE_SIZE = 0.08
+SPECKLE_CELL_SIZE = 128
+DEFAULT_SPECKLE_AREA = 4
+
+
 # skimage throws useless UserWarnings in various functions
 def mean_estimate_sigma(arr):
     with warnings.catch_warnings():
@@ -43,7 +316,28 @@ def mean_estimate_sigma(arr):
         return np.mean(estimate_sigma(arr))
 
 
-def threshold_image(img, rev=False, otsu=False, block_size=9):
+def estimate_noise(arr, estimator=None, threads=None):
+    """
+    Estimate the noise standard deviation of a grayscale image or mask
+
+    Args:
+
+    * arr (numpy.array): Image or mask to estimate the noise of
+    * estimator (str): One of NOISE_ESTIMATORS, default is
+      NOISE_ESTIMATOR_WAVELET
+    * threads (int): Amount of threads to use
+
+    Returns the estimate (float), which is NaN for completely flat images
+    """
+    if estimator is None or estimator == NOISE_ESTIMATOR_WAVELET:
+        return wavelet_sigma(arr, threads or 1)
+    elif estimator == NOISE_ESTIMATOR_LAPLACIAN:
+        return laplacian_sigma(arr, threads or 1)
+    raise ValueError('Unknown noise estimator: %s' % estimator)
+
+
+def threshold_image(img, rev=False, otsu=False,
+                    block_size=LOCAL_THRESHOLD_BLOCK_SIZE):
     """
     Apply adaptive (local) thresholding, filtering out background noise to make
     the text more readable. 
@@ -80,33 +374,78 @@ def threshold_image2(np_image):
     return local & otsu
 
 
-def threshold_image3(img):
-    window_size = 51
+def threshold_image3(img, window_size=SAUVOLA_WINDOW_SIZE, threads=None):
+    """
+    Apply Sauvola thresholding to the grayscale (uint8) image img, using
+    threads threads (default is one).
+
+    Returns the thresholded np image array, True where img is foreground
+    """
     #window_size = 21
 
     h, w = img.shape
-    out_img = np.ndarray(img.shape, dtype=np.bool)
-    out_img = np.reshape(out_img, w*h)
-    in_img = np.reshape(img, w*h)
+    out_img = np.empty((h, w), dtype=bool)
 
-    binarise_sauvola(in_img, out_img, w, h, window_size, window_size, 0.3, 128)
-    out_img = np.reshape(out_img, (h, w))
-    # TODO: optimise this, we can do it in binarise_sauvola
-    out_img = np.invert(out_img)
+    # The flat views share their memory with img and out_img
+    in_img = np.ascontiguousarray(img).reshape(w*h)
+    binarise_sauvola(in_img, out_img.reshape(w*h).view(np.uint8), w, h,
+                     window_size, window_size, 0.3, 128, invert=True,
+                     threads=threads or 1)
 
     return out_img
 
 
-def denoise_bregman(binary_img):
-    thresf = np.array(binary_img, dtype=np.float32)
-    #denoise = denoise_tv_bregman(thresf, weight=0.25)
-    denoise = denoise_tv_bregman(thresf, weight=1.)
+def speckle_areas(shape, word_boxes, cell_size=SPECKLE_CELL_SIZE):
+    """
+    Compute the speckle area thresholds of a mask from the heights of the
+    words on it: every cell of cell_size by cell_size pixels gets the
+    threshold of the smallest word that overlaps it, other cells the one of
+    the median word height.
 
-    #denoise = denoise > 0.6
-    denoise = denoise > 0.4  # XXX: 0.4?
-    denoise = np.array(denoise, dtype=np.bool)
+    Args:
 
-    return denoise
+    * shape (tuple): Shape (height, width) of the mask
+    * word_boxes (list): Word boxes (left, top, right, bottom) on the mask
+    * cell_size (int): Size of the cells, in pixels
+
+    Returns a 2D numpy array of the area thresholds of the cells
+    """
+    height, width = shape
+    cells = ((height + cell_size - 1) // cell_size,
+             (width + cell_size - 1) // cell_size)
+    if not word_boxes:
+        return np.full(cells, DEFAULT_SPECKLE_AREA, dtype=np.intc)
+
+    text_heights = np.full(cells, np.inf)
+    for left, top, right, bottom in word_boxes:
+        cell_heights = text_heights[top // cell_size:
+                                    (bottom - 1) // cell_size + 1,
+                                    left // cell_size:
+                                    (right - 1) // cell_size + 1]
+        np.minimum(cell_heights, bottom - top, out=cell_heights)
+    text_heights[np.isinf(text_heights)] = \
+            np.median([bottom - top for _, top, _, bottom in word_boxes])
+
+    return np.round((SPECKLE_SIZE * text_heights) ** 2).astype(np.intc)
+
+
+def denoise_speckles(mask_arr, word_boxes=None):
+    """
+    Denoise the (bool) mask mask_arr in place, by removing speckles and
+    filling small holes, relative to the size of the text around them (see
+    speckle_areas).
+
+    Args:
+
+    * mask_arr (numpy.array): Mask to denoise
+    * word_boxes (list): hOCR word boxes (left, top, right, bottom) on the
+      mask
+
+    Returns the mask
+    """
+    areas = speckle_areas(mask_arr.shape, word_boxes)
+    remove_speckles(mask_arr, areas, SPECKLE_CELL_SIZE)
+    return mask_arr
 
 # TODO: Rename, can be either foreground or background
 def partial_blur(mask, img, sigma=5, mode=None):
@@ -186,97 +525,100 @@ def partial_boxblur(mask, fg, size=5, mode=None):
     return newfg
 
 
-def create_hocr_mask(img, mask_arr, hocr_word_data, downsample=None, timing_data=None):
+def gaussian_weights(sigma, truncate=4.0):
+    """
+    Returns the weights of the 1D gaussian filter that
+    scipy.ndimage.gaussian_filter uses for sigma, as a numpy array.
+    """
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    phi_x = np.exp(-0.5 / (sigma * sigma) * x ** 2)
+    return phi_x / phi_x.sum()
+
+
+def hocr_word_boxes(hocr_word_data):
+    """
+    Returns the boxes (left, top, right, bottom) of the words in
+    hocr_word_data (as returned by hocr_page_to_word_data) that have text, as
+    (n, 4) numpy array. This is all create_hocr_mask needs of a page, in a
+    fraction of the memory of the word data.
+    """
+    boxes = [word['bbox'] for paragraphs in hocr_word_data
+             for lines in paragraphs['lines'] for word in lines['words']
+             if word['text'].strip()]
+    return np.array(boxes, dtype=np.float64).reshape((len(boxes), 4))
+
+
+def create_hocr_mask(img, mask_arr, hocr_word_data, downsample=None,
+                     timing_data=None, threads=None):
+    """
+    Threshold the words in hocr_word_data into mask_arr (modified in place).
+    hocr_word_data is the word data of the page, or the boxes of its words
+    (see hocr_word_boxes).
+
+    Every word is thresholded like threshold_image2 does. If the result is
+    noisy, the inverted word is thresholded as well, and the polarity that
+    looks most like text is picked. This happens for all words at once, in
+    the compiled hocrmask.threshold_words, using threads threads (default is
+    one).
+
+    Returns the list of the word boxes (left, top, right, bottom) in the
+    mask.
+    """
     image_width, image_height = img.size
     np_img = np.array(img)
 
     t = time()
-    for paragraphs in hocr_word_data:
-        for lines in paragraphs['lines']:
-            for word in lines['words']:
-                if not word['text'].strip():
-                    continue
-
-                if downsample is not None:
-                    left, top, right, bottom = [int(x/downsample) for x in word['bbox']]
-                    # This can happen if we downsample and round to int
-                    if left == right or top == bottom:
-                        continue
-
-                    np_wordimg = np_img[top:bottom,left:right]
-                else:
-                    left, top, right, bottom = [int(x) for x in word['bbox']]
-                    np_wordimg = np_img[top:bottom,left:right]
-
-                if (left >= right) or (top >= bottom):
-                    print('Invalid bounding box: (%d, %d, %d, %d)' % (left, top, right, bottom), file=sys.stderr)
-                    continue
-
-                if (left < 0) or (right > image_width) or (top < 0) or (bottom > image_height):
-                    print('Invalid bounding box outside image: (%d, %d, %d, %d)' % (left, top, right, bottom), file=sys.stderr)
-                    continue
-
-                thres = threshold_image2(np_wordimg)
-
-                sigma_est = mean_estimate_sigma(thres)
-                ones = np.count_nonzero(thres)
-
-                if sigma_est > 0.1:
-                    # Invert. (TODO: we should do this in a more efficient
-                    # manner)
-                    thres_i = threshold_image2(np.invert(np_wordimg))
-                    sigma_est_i = mean_estimate_sigma(thres_i)
-                    ones_i = np.count_nonzero(thres_i)
-
-                    if sigma_est < sigma_est_i:
-                        pass
-                    elif sigma_est_i < sigma_est and ones_i < ones:
-                        ones_i = np.count_nonzero(thres_i)
-
-                        # Find what is closer to the center of the bounding box
-                        ww, hh = thres.shape
-                        center_x = ww/2
-                        center_y = hh/2
-
-                        thres_sum = 0.
-                        thres_i_sum = 0.
-
-                        # TODO: This can be done way more efficiently in numpy
-                        for x in range(ww):
-                            for y in range(hh):
-                                if thres[x, y]:
-                                    thres_sum += ((center_x-x)**2+(center_y-y)**2)**0.5
-                                if thres_i[x, y]:
-                                    thres_i_sum += ((center_x-y)**2+(center_y-y)**2)**0.5
-
-                        if ones > 0:
-                            thres_sum /= ones
-                        if ones_i > 0:
-                            thres_i_sum /= ones_i
-
-                        if thres_sum < thres_i_sum:
-                            pass
-                        elif thres_i_sum > thres_sum:
-                            thres = thres_i
-                        else:
-                            # Won't really ever happen, but ok
-                            thres = thres_i | thres
-
-                mask_arr[top:bottom, left:right] = thres
+    if not isinstance(hocr_word_data, np.ndarray):
+        hocr_word_data = hocr_word_boxes(hocr_word_data)
+
+    boxes = []
+    for bbox in hocr_word_data.tolist():
+        if downsample is not None:
+            left, top, right, bottom = [int(x/downsample) for x in bbox]
+            # This can happen if we downsample and round to int
+            if left == right or top == bottom:
+                continue
+        else:
+            left, top, right, bottom = [int(x) for x in bbox]
+
+        if (left >= right) or (top >= bottom):
+            print('Invalid bounding box: (%d, %d, %d, %d)' % (left, top, right, bottom), file=sys.stderr)
+            continue
+
+        if (left < 0) or (right > image_width) or (top < 0) or (bottom > image_height):
+            print('Invalid bounding box outside image: (%d, %d, %d, %d)' % (left, top, right, bottom), file=sys.stderr)
+            continue
+
+        boxes.append((left, top, right, bottom))
+
+    if boxes:
+        # The word thresholds are written to a uint8 view of mask_arr
+        threshold_words(np.ascontiguousarray(np_img),
+                        mask_arr.view(np.uint8),
+                        np.array(boxes, dtype=np.intc),
+                        gaussian_weights((LOCAL_THRESHOLD_BLOCK_SIZE - 1) / 6.0),
+                        threads=threads or 1)
 
     if timing_data is not None:
         timing_data.append(('hocr_mask_gen', time() - t))
 
+    return boxes
 
-def create_threshold_mask(mask_arr, imgf, denoise_mask=None, timing_data=None):
+
+def create_threshold_mask(mask_arr, imgf, denoise_mask=None, timing_data=None,
+                          threads=None, noise_estimator=None,
+                          mask_noise_estimator=None, word_boxes=None):
     # We don't apply any of these blurs to the hOCR mask, we want that as
     # sharp as possible.
+    noise_estimator = noise_estimator or NOISE_ESTIMATOR_WAVELET
+    mask_noise_estimator = mask_noise_estimator or NOISE_ESTIMATOR_WAVELET
 
     t = time()
-    sigma_est = mean_estimate_sigma(imgf)
+    sigma_est = estimate_noise(imgf, noise_estimator, threads)
     if timing_data is not None:
         timing_data.append(('est_1', time() - t))
-    if sigma_est > 1.0:
+    if sigma_est > BLUR_NOISE_THRESHOLD[noise_estimator]:
         t = time()
         imgf = ndimage.filters.gaussian_filter(imgf, sigma=sigma_est*0.1)
         if timing_data is not None:
@@ -293,26 +635,247 @@ def create_threshold_mask(mask_arr, imgf, denoise_mask=None, timing_data=None):
 
     t = time()
     #thres_arr = threshold_image3(np.array(imgf, dtype=np.uint8))
-    thres_arr = threshold_image3(imgf.astype(np.uint8))
+    thres_arr = threshold_image3(imgf.astype(np.uint8), threads=threads)
     if timing_data is not None:
         timing_data.append(('threshold', time() - t))
 
     if denoise_mask is not None and denoise_mask:
         t = time()
-        sigma_est = mean_estimate_sigma(thres_arr)
+        sigma_est = estimate_noise(thres_arr, mask_noise_estimator, threads)
         if timing_data is not None:
             timing_data.append(('est_3', time() - t))
 
-        if sigma_est > 0.1:
+        if sigma_est > DENOISE_NOISE_THRESHOLD[mask_noise_estimator]:
             t = time()
-            thres_arr = denoise_bregman(thres_arr)
+            denoise_speckles(thres_arr, word_boxes)
             if timing_data is not None:
                 timing_data.append(('denoise', time() - t))
 
+    mask_arr |= thres_arr
 
-    thres_inv = thres_arr ^ np.ones(thres_arr.shape, dtype=bool)
 
-    mask_arr |= thres_arr
+def create_threshold_mask_strips(mask_arr, grayimg, strip_height,
+                                 denoise_mask=None, timing_data=None,
+                                 threads=None, noise_estimator=None,
+                                 mask_noise_estimator=None, word_boxes=None):
+    """
+    Same as create_threshold_mask, but blurs and thresholds the image in
+    horizontal strips of strip_height rows, so that only a strip of the image
+    is kept in memory as floating point data. Every strip is extended with
+    enough rows of the image above and below (the halo) for the blur and the
+    Sauvola window to see the same pixels as they would on the full image, so
+    the resulting mask is the same. The thresholded strips are added to
+    mask_arr right away, unless the mask is to be denoised, which needs the
+    thresholded image as a whole.
+
+    Args:
+
+    * mask_arr (numpy.array): Mask to add the thresholded image to
+    * grayimg (PIL.Image): Grayscale image to threshold
+    * strip_height (int): Amount of rows per strip
+    * denoise_mask (bool): Whether to denoise the mask if it is deemed too
+      noisy
+    * timing_data: Optional timing data to log individual timing data to.
+    * threads (int): Amount of threads to threshold a strip with
+    * noise_estimator (str): Noise estimator (see estimate_noise) for the
+      decision to blur the image
+    * mask_noise_estimator (str): Noise estimator for the decision to denoise
+      the mask
+    * word_boxes (list): hOCR word boxes (left, top, right, bottom), to
+      denoise the mask relative to the size of the text
+    """
+    width, height = grayimg.size
+    noise_estimator = noise_estimator or NOISE_ESTIMATOR_WAVELET
+    mask_noise_estimator = mask_noise_estimator or NOISE_ESTIMATOR_WAVELET
+
+    # The noise estimate is a global property of the image. The wavelet
+    # estimator transforms the image in single precision, as for the float32
+    # image in create_threshold_mask, without converting the whole image.
+    t = time()
+    if noise_estimator == NOISE_ESTIMATOR_WAVELET:
+        sigma_est = wavelet_sigma(np.asarray(grayimg), threads or 1,
+                                  single=True)
+    else:
+        sigma_est = estimate_noise(np.asarray(grayimg), noise_estimator,
+                                   threads)
+    if timing_data is not None:
+        timing_data.append(('est_1', time() - t))
+
+    blur_sigma = None
+    halo = SAUVOLA_WINDOW_SIZE // 2 + 1
+    if sigma_est > BLUR_NOISE_THRESHOLD[noise_estimator]:
+        blur_sigma = sigma_est*0.1
+        # Radius of the gaussian kernel, see scipy.ndimage.gaussian_filter1d
+        halo += int(4.0 * blur_sigma + 0.5)
+
+    denoise = denoise_mask is not None and denoise_mask
+    thres_arr = np.zeros(mask_arr.shape, dtype=bool) if denoise else mask_arr
+    blur_time = 0.
+    threshold_time = 0.
+    for top in range(0, height, strip_height):
+        bottom = min(height, top + strip_height)
+        halo_top = max(0, top - halo)
+        halo_bottom = min(height, bottom + halo)
+
+        imgf = np.array(grayimg.crop((0, halo_top, width, halo_bottom)),
+                        dtype=np.float32)
+        if blur_sigma is not None:
+            t = time()
+            imgf = ndimage.filters.gaussian_filter(imgf, sigma=blur_sigma)
+            blur_time += time() - t
+
+        t = time()
+        strip_thres = threshold_image3(imgf.astype(np.uint8), threads=threads)
+        thres_arr[top:bottom] |= strip_thres[top-halo_top:bottom-halo_top]
+        threshold_time += time() - t
+
+    if timing_data is not None:
+        if blur_sigma is not None:
+            timing_data.append(('blur_1', blur_time))
+        timing_data.append(('threshold', threshold_time))
+
+    # Denoising is not a local operation, so it is done on the full mask
+    if denoise:
+        t = time()
+        sigma_est = estimate_noise(thres_arr, mask_noise_estimator, threads)
+        if timing_data is not None:
+            timing_data.append(('est_3', time() - t))
+
+        if sigma_est > DENOISE_NOISE_THRESHOLD[mask_noise_estimator]:
+            t = time()
+            denoise_speckles(thres_arr, word_boxes)
+            if timing_data is not None:
+                timing_data.append(('denoise', time() - t))
+
+        mask_arr |= thres_arr
+
+
+def optimise_image_strips(mask_arr, image, n_size, strip_height,
+                          invert_mask=False, threads=None):
+    """
+    Optimise image like optimise_gray2 and optimise_rgb2 do, in horizontal
+    strips of strip_height rows, giving the same result as optimising the full
+    image at once.
+
+    The optimisation of a pixel depends on the optimised pixels above it, so
+    the strips are optimised from top to bottom, and the already optimised
+    rows above every strip are passed along (and skipped, see start_y of
+    optimise_gray2).
+
+    Args:
+
+    * mask_arr (numpy.array): Mask of the pixels to keep
+    * image (PIL.Image): Image to optimise, grayscale or RGB
+    * n_size (int): Neighbourhood size of the optimisation
+    * strip_height (int): Amount of rows per strip
+    * invert_mask (bool): Whether to keep the pixels not in mask_arr instead
+    * threads (int): Amount of threads to optimise a strip with
+
+    Returns the optimised image as numpy array
+    """
+    width, height = image.size
+    if image.mode == 'L':
+        out_arr = np.empty((height, width), dtype=np.uint8)
+    else:
+        out_arr = np.empty((height, width, 3), dtype=np.uint8)
+
+    for top in range(0, height, strip_height):
+        bottom = min(height, top + strip_height)
+        halo_top = max(0, top - n_size)
+        halo_bottom = min(height, bottom + n_size)
+
+        strip_arr = np.array(image.crop((0, halo_top, width, halo_bottom)))
+        strip_arr[:top-halo_top] = out_arr[halo_top:top]
+        strip_mask = mask_arr[halo_top:halo_bottom]
+        if invert_mask:
+            strip_mask = ~strip_mask
+
+        if image.mode == 'L':
+            strip_arr = optimise_gray2(strip_mask, strip_arr, width,
+                                       halo_bottom - halo_top, n_size,
+                                       top - halo_top, threads or 1)
+        else:
+            strip_arr = optimise_rgb2(strip_mask, strip_arr, width,
+                                      halo_bottom - halo_top, n_size,
+                                      top - halo_top, threads or 1)
+        out_arr[top:bottom] = strip_arr[top-halo_top:bottom-halo_top]
+
+    return out_arr
+
+
+def optimise_background_downsampled(mask_arr, image, n_size, factor,
+                                    strip_height=None, threads=None):
+    """
+    Compute the background of image (like optimise_gray2 and optimise_rgb2
+    with the inverse of mask_arr) at a resolution reduced by factor, without
+    optimising the full resolution image.
+
+    The image is downsampled first, averaging the background pixels of every
+    block of factor x factor pixels. Blocks that are all background are kept,
+    the others are optimised at the reduced resolution (with a neighbourhood
+    of n_size full resolution pixels), and then blocks that are partially
+    background are mixed with the average of their background pixels, in
+    proportion to the area that is background. This approximates optimising
+    the full resolution image and then downsampling it.
+
+    Args:
+
+    * mask_arr (numpy.array): Mask of the foreground pixels
+    * image (PIL.Image): Image to compute the background of, grayscale or RGB
+    * n_size (int): Neighbourhood size of the optimisation
+    * factor (int): Factor to downsample by; the blocks on the right and
+      bottom edges can be smaller
+    * strip_height (int): If set, downsample the image in horizontal strips of
+      (about) this many rows, so that the full resolution image is never in
+      memory as numpy array
+    * threads (int): Amount of threads to use
+
+    Returns the background as numpy array
+    """
+    width, height = image.size
+
+    if strip_height is None:
+        means, kept = downsample_masked(mask_arr, np.array(image), width,
+                                        height, factor, invert=True,
+                                        threads=threads or 1)
+    else:
+        # Strips of whole blocks
+        strip_height = max(1, strip_height // factor) * factor
+        strips = []
+        for top in range(0, height, strip_height):
+            bottom = min(height, top + strip_height)
+            strips.append(downsample_masked(mask_arr[top:bottom],
+                    np.array(image.crop((0, top, width, bottom))), width,
+                    bottom - top, factor, invert=True, threads=threads or 1))
+        means = np.concatenate([strip[0] for strip in strips])
+        kept = np.concatenate([strip[1] for strip in strips])
+        strips = None
+
+    out_height, out_width = kept.shape
+    block_widths = np.minimum(factor, width - np.arange(out_width) * factor)
+    block_heights = np.minimum(factor, height - np.arange(out_height) * factor)
+    counts = np.outer(block_heights, block_widths).astype(np.intc)
+
+    small_n_size = max(1, (n_size + factor - 1) // factor)
+    if image.mode == 'L':
+        background = optimise_gray2(kept == counts, means, out_width,
+                                    out_height, small_n_size, 0, threads or 1)
+    else:
+        background = optimise_rgb2(kept == counts, means, out_width,
+                                   out_height, small_n_size, 0, threads or 1)
+
+    # Mix in the background pixels of partially background blocks
+    partial = np.nonzero((kept > 0) & (kept < counts))
+    kept = kept[partial]
+    counts = counts[partial]
+    if image.mode != 'L':
+        kept = kept[:, np.newaxis]
+        counts = counts[:, np.newaxis]
+    background[partial] = (kept * means[partial].astype(np.intc) +
+                           (counts - kept) * background[partial] +
+                           counts // 2) // counts
+
+    return background
 
 
 # TODO: Reduce amount of memory active at one given point (keep less images in
@@ -321,7 +884,11 @@ def create_mrc_hocr_components(image, hocr_word_data,
                                downsample=None,
                                bg_downsample=None,
                                denoise_mask=None, timing_data=None,
-                               errors=None):
+                               errors=None, strip_height=None,
+                               segment_threads=None,
+                               fast_bg_downsample=False,
+                               noise_estimator=None,
+                               mask_noise_estimator=None):
     """
     Create the MRC components: mask, foreground and background
 
@@ -331,10 +898,28 @@ def create_mrc_hocr_components(image, hocr_word_data,
     * hocr_word_data: OCR data about found text on the page
     * downsample (int): factor by which the OCR data is to be downsampled
     * bg_downsample (int): if the background image should be downscaled
-    * denoise_mask (bool): Whether to denoise the image if it is deemed too
-      noisy
+    * denoise_mask (bool): Whether to denoise the mask (remove speckles
+      that are small compared to the hOCR words, see denoise_speckles) if it
+      is deemed too noisy
     * timing_data: Optional timing data to log individual timing data to.
     * errors: Optional argument (of type set) with encountered runtime errors
+    * strip_height (int): If set, threshold and optimise the image in
+      horizontal strips of this many rows, which bounds the memory needed for
+      very large images. The components are the same as without strips.
+    * segment_threads (int): Amount of threads to use for the (hOCR word and
+      Sauvola) thresholding and the foreground and background optimisation
+      of the image
+    * fast_bg_downsample (bool): Compute the background at the resolution
+      reduced by bg_downsample (see optimise_background_downsampled), instead
+      of optimising the full resolution background and resizing it
+      afterwards. This is faster and uses less memory, but the background is
+      slightly different.
+    * noise_estimator (str): Noise estimator (see estimate_noise) for the
+      decision to blur the image before thresholding it, default is
+      NOISE_ESTIMATOR_WAVELET
+    * mask_noise_estimator (str): Noise estimator for the decision to denoise
+      the thresholded image (with denoise_mask), default is
+      NOISE_ESTIMATOR_WAVELET
 
     Returns a tuple of the components, as numpy arrays: (mask, foreground,
     background)
@@ -349,50 +934,121 @@ def create_mrc_hocr_components(image, hocr_word_data,
     mask_arr = np.array(Image.new('1', image.size))
 
     # Modifies mask_arr in place
-    create_hocr_mask(grayimg, mask_arr, hocr_word_data, downsample=downsample,
-                     timing_data=timing_data)
-
-    grayimgf = np.array(grayimg, dtype=np.float32)
+    word_boxes = create_hocr_mask(grayimg, mask_arr, hocr_word_data,
+                                  downsample=downsample,
+                                  timing_data=timing_data,
+                                  threads=segment_threads)
 
     MIX_THRESHOLD = True
-    if MIX_THRESHOLD:
+    if MIX_THRESHOLD and strip_height is not None:
+        # Modifies mask_arr in place
+        create_threshold_mask_strips(mask_arr, grayimg, strip_height,
+                denoise_mask=denoise_mask, timing_data=timing_data,
+                threads=segment_threads, noise_estimator=noise_estimator,
+                mask_noise_estimator=mask_noise_estimator,
+                word_boxes=word_boxes)
+    elif MIX_THRESHOLD:
+        grayimgf = np.array(grayimg, dtype=np.float32)
         # Modifies mask_arr in place
         #mask_arr = np.zeros(mask_arr.shape, dtype=np.bool) # XXX: this nukes the hocr threshold
         create_threshold_mask(mask_arr, grayimgf, denoise_mask=denoise_mask,
-                timing_data=timing_data)
+                timing_data=timing_data, threads=segment_threads,
+                noise_estimator=noise_estimator,
+                mask_noise_estimator=mask_noise_estimator,
+                word_boxes=word_boxes)
+        grayimgf = None
+    grayimg = None
     yield mask_arr
 
-    image_arr = np.array(image)
-
-    t = time()
-    # Take foreground pixels and optimise the image by making the surrounding
-    # pixels like the foreground, allowing for more optimal compression (and
-    # higher quality foreground pixels as a result)
     width_, height_ = image.size
-    if image.mode == 'L':
-        foreground_arr = optimise_gray2(mask_arr, image_arr, width_, height_, 3)
-    else:
-        foreground_arr = optimise_rgb2(mask_arr, image_arr, width_, height_, 3)
-    if timing_data is not None:
-        # The name fg_partial_blur is kept for backwards compatibility
-        timing_data.append(('fg_partial_blur', time() - t))
-    yield foreground_arr
-    foreground_arr = None
+    # Compute the background at the downsampled resolution right away, if
+    # requested and possible
+    reduced_bg = fast_bg_downsample and bg_downsample is not None and \
+            int(width_ / bg_downsample) > 0 and \
+            int(height_ / bg_downsample) > 0
 
-    mask_inv = mask_arr ^ np.ones(mask_arr.shape, dtype=bool)
+    if strip_height is not None:
+        t = time()
+        # Take foreground pixels and optimise the image by making the
+        # surrounding pixels like the foreground, allowing for more optimal
+        # compression (and higher quality foreground pixels as a result)
+        foreground_arr = optimise_image_strips(mask_arr, image,
+                FOREGROUND_OPTIMISE_SIZE, strip_height,
+                threads=segment_threads)
+        if timing_data is not None:
+            # The name fg_partial_blur is kept for backwards compatibility
+            timing_data.append(('fg_partial_blur', time() - t))
+        yield foreground_arr
+        foreground_arr = None
 
-    t = time()
-    # Take background pixels and optimise the image by placing them where the
-    # foreground pixels are thought to be, this has the effect of reducing
-    # compression artifacts (thus improving quality) and at the same time making
-    # the image easier to compress (smaller file size)
-    if image.mode == 'L':
-        background_arr = optimise_gray2(mask_inv, image_arr, width_, height_, 10)
+        t = time()
+        # Take background pixels and optimise the image by placing them where
+        # the foreground pixels are thought to be, this has the effect of
+        # reducing compression artifacts (thus improving quality) and at the
+        # same time making the image easier to compress (smaller file size)
+        if reduced_bg:
+            background_arr = optimise_background_downsampled(mask_arr, image,
+                    BACKGROUND_OPTIMISE_SIZE, bg_downsample,
+                    strip_height=strip_height, threads=segment_threads)
+        else:
+            background_arr = optimise_image_strips(mask_arr, image,
+                    BACKGROUND_OPTIMISE_SIZE, strip_height, invert_mask=True,
+                    threads=segment_threads)
+        if timing_data is not None:
+            # The name bg_partial_blur is kept for backwards compatibility
+            timing_data.append(('bg_partial_blur', time() - t))
+    elif reduced_bg:
+        t = time()
+        image_arr = np.array(image)
+        if image.mode == 'L':
+            foreground_arr = optimise_gray2(mask_arr, image_arr, width_,
+                    height_, FOREGROUND_OPTIMISE_SIZE, 0,
+                    segment_threads or 1)
+        else:
+            foreground_arr = optimise_rgb2(mask_arr, image_arr, width_,
+                    height_, FOREGROUND_OPTIMISE_SIZE, 0,
+                    segment_threads or 1)
+        image_arr = None
+        if timing_data is not None:
+            timing_data.append(('fg_partial_blur', time() - t))
+        yield foreground_arr
+        foreground_arr = None
+
+        t = time()
+        background_arr = optimise_background_downsampled(mask_arr, image,
+                BACKGROUND_OPTIMISE_SIZE, bg_downsample,
+                threads=segment_threads)
+        if timing_data is not None:
+            timing_data.append(('bg_partial_blur', time() - t))
     else:
-        background_arr = optimise_rgb2(mask_inv, image_arr, width_, height_, 10)
-    if timing_data is not None:
-        # The name bg_partial_blur is kept for backwards compatibility
-        timing_data.append(('bg_partial_blur', time() - t))
+        t = time()
+        # Optimise the foreground (make the pixels surrounding the foreground
+        # pixels like the foreground) and the background (place background
+        # pixels where the foreground pixels are thought to be) in one pass
+        # over the image
+        image_arr = np.array(image)
+        if image.mode == 'L':
+            foreground_arr, background_arr = optimise_fg_bg_gray2(mask_arr,
+                    image_arr, width_, height_, FOREGROUND_OPTIMISE_SIZE,
+                    BACKGROUND_OPTIMISE_SIZE, threads=segment_threads or 1)
+        else:
+            foreground_arr, background_arr = optimise_fg_bg_rgb2(mask_arr,
+                    image_arr, width_, height_, FOREGROUND_OPTIMISE_SIZE,
+                    BACKGROUND_OPTIMISE_SIZE, threads=segment_threads or 1)
+        image_arr = None
+        if timing_data is not None:
+            # Both layers are optimised in one pass; report half of the time
+            # under each of the fg_partial_blur and bg_partial_blur names
+            # that the other paths (and the timing reports) use
+            t = (time() - t) / 2
+            timing_data.append(('fg_partial_blur', t))
+            timing_data.append(('bg_partial_blur', t))
+        yield foreground_arr
+        foreground_arr = None
+
+    if reduced_bg:
+        yield background_arr
+        return
 
     if bg_downsample is not None:
         t = time()
@@ -421,40 +1077,37 @@ def encode_mrc_mask(np_mask, tmp_dir=None, jbig2=True, timing_data=None):
     Args:
 
     * np_mask (numpy.array): Mask image array
-    * tmp_dir (str): path the temporary directory to write images to
+    * tmp_dir (str): path the temporary directory to write images to, if they
+      cannot be kept in memory
     * jbig2 (bool): Whether to encode to JBIG2 or PNG
     * timing_data (optional): Add time information to timing_data structure
 
-    Returns a tuple: (str, str) where the first entry is the jbig2
-    path, if any, the second is the png path.
+    Returns a tuple: (bytes, bytes) where the first entry is the jbig2
+    encoded mask, if any, the second is the png encoded mask.
     """
     t = time()
     mask = Image.fromarray(np_mask)
 
-    fd, mask_img_png = mkstemp(prefix='mask', suffix='.png', dir=tmp_dir)
-    close(fd)
-    if jbig2:
-        fd, mask_img_jbig2 = mkstemp(prefix='mask', suffix='.jbig2', dir=tmp_dir)
-        close(fd)
-
-    mask.save(mask_img_png, compress_level=0)
+    fd = BytesIO()
+    mask.save(fd, format='PNG', compress_level=0)
+    mask_png = fd.getvalue()
+    fd.close()
 
+    mask_jbig2 = None
     if jbig2:
-        out = subprocess.check_output(['jbig2', mask_img_png])
-        fp= open(mask_img_jbig2, 'wb+')
-        fp.write(out)
-        fp.close()
+        with memory_file(mask_png, prefix='mask', suffix='.png',
+                         tmp_dir=tmp_dir) as (mask_png_path, pass_fds):
+            mask_jbig2 = subprocess.check_output(['jbig2', mask_png_path],
+                                                 pass_fds=pass_fds)
 
     if timing_data is not None:
         timing_data.append(('mask_jbig2', time()-t))
 
-    if jbig2:
-        return mask_img_jbig2, mask_img_png
-    else:
-        return None, mask_img_png
+    return mask_jbig2, mask_png
 
 
-def encode_mrc_background(np_bg, bg_slope, tmp_dir=None, use_kdu=True, timing_data=None):
+def encode_mrc_background(np_bg, bg_slope, tmp_dir=None, use_kdu=True,
+                          timing_data=None, threads=None, codec=None):
     """
     Encode background image as JPEG2000, with the provided compression settings
     and JPEG2000 encoder.
@@ -463,50 +1116,27 @@ def encode_mrc_background(np_bg, bg_slope, tmp_dir=None, use_kdu=True, timing_da
 
     * np_bg (numpy.array): Background image array
     * bg_slope (int): Compression parameter(s), WIP
-    * tmp_dir (str): path the temporary directory to write images to
+    * tmp_dir (str): path the temporary directory to write images to, if they
+      cannot be kept in memory
     * use_kdu (bool): Whether to encode using Kakadu or OpenJPEG2000
     * timing_data (optional): Add time information to timing_data structure
+    * threads (int): Amount of threads the encoder may use (default is one)
+    * codec (str): Name of the JPEG2000 codec to use, overrides use_kdu
 
-    Returns the filepath to the JPEG2000 background image
+    Returns the JPEG2000 background image (bytes)
     """
     t = time()
-    # Create background
-    if use_kdu:
-        # TODO: check if kakadu supports .tif
-        fd, bg_img_tiff = mkstemp(prefix='bg', suffix='.tiff', dir=tmp_dir)
-    else:
-        fd, bg_img_tiff = mkstemp(prefix='bg', suffix='.pnm', dir=tmp_dir)
-    close(fd)
-    fd, bg_img_jp2 = mkstemp(prefix='bg', suffix='.jp2', dir=tmp_dir)
-    close(fd)
-    remove(bg_img_jp2) # XXX: Kakadu doesn't want the file to exist, so what are
-                       # we even doing
-
-    bg_img = Image.fromarray(np_bg)
-    bg_img.save(bg_img_tiff)
-
-    if use_kdu:
-        subprocess.check_call([KDU_COMPRESS,
-            '-num_threads', '0',
-            '-i', bg_img_tiff, '-o', bg_img_jp2,
-            '-slope', str(bg_slope),
-            ], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-    else:
-        subprocess.check_call([OPJ_COMPRESS,
-            '-i', bg_img_tiff, '-o', bg_img_jp2,
-            '-threads', '1',
-            # Use constant reduction rate here (not psnr)
-            '-r', '400',
-            ], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-    remove(bg_img_tiff)
+    bg_jp2 = get_jpeg2000_codec(codec, use_kdu=use_kdu).encode(np_bg, 'bg',
+            bg_slope, threads=threads, tmp_dir=tmp_dir)
 
     if timing_data is not None:
         timing_data.append(('bg_jp2', time()-t))
 
-    return bg_img_jp2
+    return bg_jp2
 
 
-def encode_mrc_foreground(np_fg, fg_slope, tmp_dir=None, use_kdu=True, timing_data=None):
+def encode_mrc_foreground(np_fg, fg_slope, tmp_dir=None, use_kdu=True,
+                          timing_data=None, threads=None, codec=None):
     """
     Encode foreground image as JPEG2000, with the provided compression settings
     and JPEG2000 encoder.
@@ -515,66 +1145,101 @@ def encode_mrc_foreground(np_fg, fg_slope, tmp_dir=None, use_kdu=True, timing_da
 
     * np_bg (numpy.array): Foreground image array
     * bg_slope (int): Compression parameter(s), WIP
-    * tmp_dir (str): path the temporary directory to write images to
+    * tmp_dir (str): path the temporary directory to write images to, if they
+      cannot be kept in memory
     * use_kdu (bool): Whether to encode using Kakadu or OpenJPEG2000
     * timing_data (optional): Add time information to timing_data structure
+    * threads (int): Amount of threads the encoder may use (default is one)
+    * codec (str): Name of the JPEG2000 codec to use, overrides use_kdu
 
-    Returns the filepath to the JPEG2000 foreground image
+    Returns the JPEG2000 foreground image (bytes)
     """
     t = time()
-    # Create foreground
-    if use_kdu:
-        # TODO: check if kakadu supports .tif
-        fd, fg_img_tiff = mkstemp(prefix='fg', suffix='.tiff', dir=tmp_dir)
-    else:
-        fd, fg_img_tiff = mkstemp(prefix='fg', suffix='.pnm', dir=tmp_dir)
-
-    close(fd)
-    fd, fg_img_jp2 = mkstemp(prefix='fg', suffix='.jp2', dir=tmp_dir)
-    close(fd)
-    remove(fg_img_jp2) # XXX: Kakadu doesn't want the file to exist, so what are
-                       # we even doing
-
-    fg_img = Image.fromarray(np_fg)
-    fg_img.save(fg_img_tiff)
-
-    if use_kdu:
-        subprocess.check_call([KDU_COMPRESS,
-            '-num_threads', '0',
-            '-i', fg_img_tiff, '-o', fg_img_jp2,
-            '-slope', str(fg_slope),
-            ], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-    else:
-        subprocess.check_call([OPJ_COMPRESS,
-            '-threads', '1',
-            '-i', fg_img_tiff, '-o', fg_img_jp2,
-            # Use PSNR here
-            '-q', '25',
-            ], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-    remove(fg_img_tiff)
+    fg_jp2 = get_jpeg2000_codec(codec, use_kdu=use_kdu).encode(np_fg, 'fg',
+            fg_slope, threads=threads, tmp_dir=tmp_dir)
 
     if timing_data is not None:
         timing_data.append(('fg_jp2', time()-t))
 
-    return fg_img_jp2
+    return fg_jp2
 
 
 def encode_mrc_images(mrc_gen, bg_slope=None, fg_slope=None,
-                      tmp_dir=None, jbig2=True, timing_data=None, use_kdu=True):
-    mask_img_jbig2, mask_img_png = encode_mrc_mask(next(mrc_gen), tmp_dir=tmp_dir, jbig2=jbig2,
-            timing_data=timing_data)
-
-    np_fg = next(mrc_gen)
-    fg_img_jp2 = encode_mrc_foreground(np_fg, fg_slope, tmp_dir=tmp_dir,
-                                       use_kdu=use_kdu, timing_data=timing_data)
-    fg_h, fg_w = np_fg.shape[0:2]
-    np_fg = None
-
-    np_bg = next(mrc_gen)
-    bg_img_jp2 = encode_mrc_background(np_bg, bg_slope, tmp_dir=tmp_dir,
-                                       use_kdu=use_kdu, timing_data=timing_data)
-    bg_h, bg_w = np_bg.shape[0:2]
-    np_bg = None
+                      tmp_dir=None, jbig2=True, timing_data=None, use_kdu=True,
+                      threads=None, fg_codec=None, bg_codec=None):
+    """
+    Encode the mask, foreground and background as yielded by mrc_gen.
+
+    If threads is provided, the three encoders run at the same time: each of
+    them is started as soon as its image is yielded by mrc_gen, so encoding
+    also overlaps with the creation of the next image. threads is the total
+    thread budget: at most that many encoders run at the same time, and what
+    is left of the budget is handed to the JPEG2000 encoders (-num_threads /
+    -threads).
+
+    Args:
+
+    * mrc_gen: generator yielding the mask, foreground and background
+    * bg_slope (int): Compression parameter(s) for the background
+    * fg_slope (int): Compression parameter(s) for the foreground
+    * tmp_dir (str): path the temporary directory to write images to, if they
+      cannot be kept in memory
+    * jbig2 (bool): Whether to encode the mask to JBIG2 or PNG
+    * timing_data (optional): Add time information to timing_data structure
+    * use_kdu (bool): Whether to encode using Kakadu or OpenJPEG2000
+    * threads (int): Thread budget, default is to encode the images one after
+      the other
+    * fg_codec (str): Name of the JPEG2000 codec for the foreground, overrides
+      use_kdu
+    * bg_codec (str): Name of the JPEG2000 codec for the background, overrides
+      use_kdu
+
+    Returns a tuple: (mask, bg, (bg_w, bg_h), fg, (fg_w, fg_h)) where mask, bg
+    and fg are the encoded images (bytes)
+    """
+    if threads is None:
+        mask_img_jbig2, mask_img_png = encode_mrc_mask(next(mrc_gen), tmp_dir=tmp_dir, jbig2=jbig2,
+                timing_data=timing_data)
+
+        np_fg = next(mrc_gen)
+        fg_img_jp2 = encode_mrc_foreground(np_fg, fg_slope, tmp_dir=tmp_dir,
+                                           use_kdu=use_kdu, timing_data=timing_data,
+                                           codec=fg_codec)
+        fg_h, fg_w = np_fg.shape[0:2]
+        np_fg = None
+
+        np_bg = next(mrc_gen)
+        bg_img_jp2 = encode_mrc_background(np_bg, bg_slope, tmp_dir=tmp_dir,
+                                           use_kdu=use_kdu, timing_data=timing_data,
+                                           codec=bg_codec)
+        bg_h, bg_w = np_bg.shape[0:2]
+        np_bg = None
+    else:
+        encoder_threads = max(1, threads // 3)
+
+        with ThreadPoolExecutor(max_workers=min(3, max(1, threads))) as executor:
+            mask_future = executor.submit(encode_mrc_mask, next(mrc_gen),
+                    tmp_dir=tmp_dir, jbig2=jbig2, timing_data=timing_data)
+
+            np_fg = next(mrc_gen)
+            fg_future = executor.submit(encode_mrc_foreground, np_fg,
+                    fg_slope, tmp_dir=tmp_dir, use_kdu=use_kdu,
+                    timing_data=timing_data, threads=encoder_threads,
+                    codec=fg_codec)
+            fg_h, fg_w = np_fg.shape[0:2]
+            np_fg = None
+
+            np_bg = next(mrc_gen)
+            bg_future = executor.submit(encode_mrc_background, np_bg,
+                    bg_slope, tmp_dir=tmp_dir, use_kdu=use_kdu,
+                    timing_data=timing_data, threads=encoder_threads,
+                    codec=bg_codec)
+            bg_h, bg_w = np_bg.shape[0:2]
+            np_bg = None
+
+            mask_img_jbig2, mask_img_png = mask_future.result()
+            fg_img_jp2 = fg_future.result()
+            bg_img_jp2 = bg_future.result()
 
     # XXX: probably don't need this
     try:
@@ -582,9 +1247,6 @@ def encode_mrc_images(mrc_gen, bg_slope=None, fg_slope=None,
     except StopIteration:
         pass
 
-    if jbig2:
-        remove(mask_img_png)
-
     if jbig2:
         return mask_img_jbig2, bg_img_jp2, (bg_w, bg_h), fg_img_jp2, (fg_w, fg_h)
     else:
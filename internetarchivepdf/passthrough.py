@@ -0,0 +1,216 @@
+"""
+Image passthrough: copy the images of the pages of an input PDF, or JPEG2000
+image files, to the output PDF without decoding them.
+
+page_image_index finds the image that every page draws in one pass over the
+input PDF, and copy_object copies an image with its raw (still compressed)
+stream and its image dictionary, and the objects it references (like a soft
+mask or an ICC colour space), into the output PDF, as long as it can do so
+faithfully. embed_jpeg2000 embeds a
+JPEG2000 file as it is. The raw streams are kept in an
+internetarchivepdf.spool.ImageSpool, so the output PDF has to be saved with
+ImageSpool.save.
+"""
+
+import re
+
+from internetarchivepdf.spool import object_references, replace_references
+
+
+# Names of XObjects drawn by a content stream, and the XObjects of a resource
+# dictionary
+DO_RE = re.compile(rb'/([^\s/\[\]()<>{}%]+)\s*Do\b')
+XOBJECT_RE = re.compile(r'/([^\s/\[\]()<>{}%]+)\s*(\d+)\s+\d+\s+R')
+
+# Maximum depth of the page tree to look up inherited resources in
+MAX_PAGE_TREE_DEPTH = 32
+
+# Maximum amount of objects to copy for one image (the image, its soft mask,
+# colour space and so on)
+MAX_COPY_OBJECTS = 64
+
+# Types of objects that an image should not reference, as copying them would
+# copy (part of) the document structure
+DOCUMENT_TYPES = {'/Catalog', '/Pages', '/Page'}
+
+
+def _parse_xobjects(doc, xref, key, cache):
+    # Returns the XObject dictionary at key of object xref as a dict of name
+    # to xref, caching it if it is a separate object
+    typ, value = doc.xref_get_key(xref, key)
+    if typ == 'xref':
+        xobjects_xref = int(value.split()[0])
+        if xobjects_xref in cache:
+            return cache[xobjects_xref]
+        value = doc.xref_object(xobjects_xref, compressed=True)
+    elif typ != 'dict':
+        return {}
+
+    xobjects = {name: int(x) for name, x in XOBJECT_RE.findall(value)}
+    if typ == 'xref':
+        cache[xobjects_xref] = xobjects
+    return xobjects
+
+
+def page_xobjects(doc, page, cache=None):
+    """
+    Returns the XObject resources of page (inherited from the page tree if
+    the page does not have any itself) as a dict of name to xref.
+
+    If cache (a dict) is given, resource and XObject dictionaries that are
+    separate objects, which are often shared by all pages, are only parsed
+    once.
+    """
+    if cache is None:
+        cache = {}
+
+    prefix = ''
+    for _ in range(MAX_PAGE_TREE_DEPTH):
+        typ, value = doc.xref_get_key(page.xref, prefix + 'Resources')
+        if typ != 'null':
+            break
+        if doc.xref_get_key(page.xref, prefix + 'Parent')[0] == 'null':
+            return {}
+        prefix += 'Parent/'
+    else:
+        return {}
+
+    if typ != 'xref':
+        return _parse_xobjects(doc, page.xref, prefix + 'Resources/XObject',
+                               cache)
+
+    resources_xref = int(value.split()[0])
+    if resources_xref not in cache:
+        cache[resources_xref] = _parse_xobjects(doc, resources_xref,
+                                                'XObject', cache)
+    return cache[resources_xref]
+
+
+def page_image_index(doc):
+    """
+    Build an index of the images the pages of doc draw, in one pass over the
+    document.
+
+    The image of a page is the first image XObject its content stream draws,
+    so pages that share one resource dictionary with the images of all pages
+    (which fitz then lists for every page) still get their own image. Pages
+    that do not draw an image themselves (only through forms, for example)
+    get the first image fitz lists for them.
+
+    Args:
+
+    * doc (fitz.Document): Input document
+
+    Returns a list with the image xref of every page (None for pages without
+    images).
+    """
+    index = []
+    cache = {}
+
+    for page in doc:
+        xobjects = page_xobjects(doc, page, cache=cache)
+
+        image_xref = None
+        for name in DO_RE.findall(page.read_contents()):
+            xref = xobjects.get(name.decode('latin-1'))
+            if xref is not None and \
+                    doc.xref_get_key(xref, 'Subtype') == ('name', '/Image'):
+                image_xref = xref
+                break
+
+        if image_xref is None:
+            images = page.getImageList()
+            if images:
+                image_xref = images[0][0]
+
+        index.append(image_xref)
+
+    return index
+
+
+def copy_object(from_pdf, to_pdf, xref, spool, xref_map):
+    """
+    Copy object xref of from_pdf, and all objects it references, to to_pdf
+    without decoding anything: the dictionaries are copied as they are (with
+    the references changed to the copies), the streams are copied raw into
+    spool.
+
+    Args:
+
+    * from_pdf (fitz.Document): Input document
+    * to_pdf (fitz.Document): Output document
+    * xref (int): Object of from_pdf to copy
+    * spool (internetarchivepdf.spool.ImageSpool): Spool for the raw streams
+    * xref_map (dict): Objects of from_pdf that were already copied (xref to
+      xref in to_pdf), so that shared objects are only copied once. Updated
+      with the newly copied objects.
+
+    Returns the xref of the copy in to_pdf. Raises ValueError, without
+    changing to_pdf, if the object cannot be copied faithfully: if it is not
+    a stream, or it references missing objects, objects of the document
+    structure (like pages), or too many objects. The image then has to be
+    inserted some other way, like with fitz.Page.insert_image.
+    """
+    todo = [xref]
+    objects = {}
+    while todo:
+        from_xref = todo.pop()
+        if from_xref in xref_map or from_xref in objects:
+            continue
+        if not 0 < from_xref < from_pdf.xref_length():
+            raise ValueError('Reference to missing object %d' % from_xref)
+        if len(objects) >= MAX_COPY_OBJECTS:
+            raise ValueError('Object %d references too many objects' % xref)
+
+        source = from_pdf.xref_object(from_xref, compressed=True)
+        if source.strip() == 'null':
+            raise ValueError('Reference to missing object %d' % from_xref)
+        typ, value = from_pdf.xref_get_key(from_xref, 'Type')
+        if typ == 'name' and value in DOCUMENT_TYPES:
+            raise ValueError('Reference to %s object %d' % (value, from_xref))
+
+        data = from_pdf.xref_stream_raw(from_xref)
+        if from_xref == xref and data is None:
+            raise ValueError('Object %d is not a stream' % xref)
+
+        objects[from_xref] = source, data
+        todo.extend(ref for ref, _ in object_references(source))
+
+    for from_xref in objects:
+        xref_map[from_xref] = to_pdf.get_new_xref()
+
+    for from_xref, (source, data) in objects.items():
+        source = replace_references(
+                source, lambda ref, gen: '%d 0 R' % xref_map[ref])
+
+        if data is None:
+            to_pdf.update_object(xref_map[from_xref], source)
+        else:
+            spool.add_stream(to_pdf, xref_map[from_xref], source, data)
+
+    return xref_map[xref]
+
+
+def embed_jpeg2000(to_pdf, path, size, spool):
+    """
+    Embed the JPEG2000 file at path in to_pdf as an image (JPXDecode) without
+    decoding it. The image has no /ColorSpace, so the colour specification of
+    the file itself is used.
+
+    Args:
+
+    * to_pdf (fitz.Document): Output document
+    * path (str): Path to the JP2 (or JPX) file
+    * size (tuple): Width and height of the image, from the JP2 header
+    * spool (internetarchivepdf.spool.ImageSpool): Spool for the raw stream
+
+    Returns the xref of the image in to_pdf.
+    """
+    with open(path, 'rb') as fd:
+        data = fd.read()
+
+    xref = to_pdf.get_new_xref()
+    spool.add_stream(to_pdf, xref, '<</Type/XObject/Subtype/Image'
+                     '/Width %d/Height %d/Filter/JPXDecode>>' % tuple(size),
+                     data)
+    return xref
@@ -12,6 +12,7 @@
 
 import pkg_resources
 
+import io
 from math import atan, atan2, cos, sin
 import numpy as np
 import zlib
@@ -32,16 +33,32 @@ SOFTWARE = 'Archive.org hOCR to PDF renderer (based on Tesseract)'
 
 class TessPDFRenderer(object):
 
-    def __init__(self, textonly=True, image_list=None, render_text_lines=False):
+    def __init__(self, textonly=True, image_list=None, render_text_lines=False,
+                 fp=None, batched=True):
+        """
+        Args:
+
+        * fp: File-like object to write the PDF to as it is rendered. Default
+          is an io.BytesIO, in which case the PDF is available as _data.
+        * batched (bool): Whether to create the text objects of a page with
+          GetPDFTextObjectsBatched (default) or GetPDFTextObjects
+        """
         self.textonly = textonly
         self.render_text_lines = render_text_lines
+        self.batched = batched
 
         self._obj = 0
         self._offsets = [0]
 
         self._pages = []
 
-        self._data = b''
+        if fp is None:
+            fp = io.BytesIO()
+        self._fp = fp
+
+    @property
+    def _data(self):
+        return self._fp.getvalue()
 
     def AppendPDFObjectDIY(self, object_size):
         self._offsets.append(object_size + self._offsets[-1])
@@ -52,10 +69,10 @@ class TessPDFRenderer(object):
         self.AppendString(data)
 
     def AppendString(self, s):
-        self._data += s
+        self._fp.write(s)
 
     def AppendData(self, s):
-        self._data += s
+        self._fp.write(s)
 
     def GetPDFTextObjects(self, word_data, width, height, ppi, hocr_ppi=None):
         # Stub values
@@ -205,6 +222,215 @@ class TessPDFRenderer(object):
 
         return pdf_str
 
+    def GetPDFTextObjectsBatched(self, word_data, width, height, ppi, hocr_ppi=None):
+        """
+        Creates the same text objects as GetPDFTextObjects (the output is
+        byte-identical), but computes the baselines, positions, matrices and
+        stretches of all the words of the page at once with numpy, and formats
+        all the operators of the page in one go.
+        """
+        header = (b'q ' + floatbytes(prec(width), prec=3) + b' 0 0 ' +
+                  floatbytes(prec(height), prec=3) + b' 0 0 cm')
+        if not self.textonly:
+            header += b' /Im1 Do'
+        header += b' Q\n'
+
+        if self.render_text_lines:
+            begin_text = 'BT\n0 Tr'
+        else:
+            begin_text = 'BT\n3 Tr'
+
+        # First pass: flatten the words of the paragraphs that have text, and
+        # follow the control flow of GetPDFTextObjects to find out which
+        # writing direction every word uses, and whether it starts a new text
+        # matrix (Tm) or is placed relative to the previous word (Td).
+        line_boxes = []
+        line_baselines = []
+        word_boxes = []
+        word_lines = []
+        word_rtl = []
+        word_dirs = []
+        word_tm = []
+        word_fontsizes = []
+        word_hex = []
+        word_chars = []
+        # Amount of words of every line, per paragraph
+        layout = []
+
+        old_writing_direction = WRITING_DIRECTION_LEFT_TO_RIGHT
+        for paragraph in word_data:
+            texts = [word['text'] or '' for line in paragraph['lines']
+                                        for word in line['words']]
+            if ''.join(texts).strip() == '':
+                continue
+
+            new_block = True
+            paragraph_layout = []
+            for line in paragraph['lines']:
+                words = line['words']
+                paragraph_layout.append(len(words))
+                if not words:
+                    continue
+
+                line_idx = len(line_boxes)
+                line_boxes.append(line['bbox'])
+                line_baselines.append(line['baseline'])
+
+                first_word_of_line = True
+                for word in words:
+                    if first_word_of_line:
+                        writing_direction = word['writing_direction']
+                        if writing_direction == WRITING_DIRECTION_UNSPECIFIED:
+                            writing_direction = WRITING_DIRECTION_LEFT_TO_RIGHT
+
+                    if (writing_direction != old_writing_direction) or new_block:
+                        word_tm.append(True)
+                        new_block = False
+                    else:
+                        word_tm.append(False)
+                        first_word_of_line = False
+                    old_writing_direction = writing_direction
+
+                    hex_text, chars = Utf16beHex(word['text'] or '')
+
+                    word_boxes.append(word['bbox'])
+                    word_lines.append(line_idx)
+                    word_rtl.append(writing_direction ==
+                                    WRITING_DIRECTION_RIGHT_TO_LEFT)
+                    word_dirs.append(writing_direction)
+                    word_fontsizes.append(word['fontsize'])
+                    word_hex.append(hex_text)
+                    word_chars.append(chars + 1) # Trailing space
+
+            layout.append(paragraph_layout)
+
+        if not word_boxes:
+            return header
+
+        # Baselines of the lines (ClipBaseline)
+        line_boxes = np.array(line_boxes, dtype=np.float64)
+        line_baselines = np.array(line_baselines, dtype=np.float64)
+        x1 = line_boxes[:, 0]
+        x2 = line_boxes[:, 2]
+        y1 = line_boxes[:, 3] + line_baselines[:, 1]
+        y2 = y1 + line_baselines[:, 0] * (x2 - x1)
+        rise = np.abs(y2 - y1) * 72
+        run = np.abs(x2 - x1) * 72
+        flatten = (rise < 2 * ppi) & (2 * ppi < run)
+        middle = (y1 + y2) / 2
+        line_x1, line_x2 = x1, x2
+        line_y1 = np.where(flatten, middle, y1)
+        line_y2 = np.where(flatten, middle, y2)
+
+        # Word positions and lengths (GetWordBaseline)
+        word_boxes = np.array(word_boxes, dtype=np.float64)
+        word_lines = np.array(word_lines, dtype=np.intp)
+        word_rtl = np.array(word_rtl, dtype=bool)
+        word_x1 = np.where(word_rtl, word_boxes[:, 2], word_boxes[:, 0])
+        word_y1 = np.where(word_rtl, word_boxes[:, 3], word_boxes[:, 1])
+        word_x2 = np.where(word_rtl, word_boxes[:, 0], word_boxes[:, 2])
+        word_y2 = np.where(word_rtl, word_boxes[:, 1], word_boxes[:, 3])
+
+        lx1 = line_x1[word_lines]
+        ly1 = line_y1[word_lines]
+        lx2 = line_x2[word_lines]
+        ly2 = line_y2[word_lines]
+        ldx = lx2 - lx1
+        ldy = ly2 - ly1
+        l2 = ldx * ldx + ldy * ldy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = ((word_x1 - lx2) * ldx + (word_y1 - ly2) * ldy) / l2
+        x = np.where(l2 == 0, lx1, lx2 + t * ldx)
+        y = np.where(l2 == 0, ly1, ly2 + t * ldy)
+
+        # Python's ** rather than np.sqrt, to get the exact same results
+        word_length = np.array([v ** 0.5 for v in (
+            (word_x2 - word_x1) * (word_x2 - word_x1) +
+            (word_y2 - word_y1) * (word_y2 - word_y1)).tolist()],
+            dtype=np.float64)
+        word_length = word_length * 72.0 / ppi
+        x = x * 72 / ppi
+        y = height - (y * 72.0 / ppi)
+
+        # Text matrices of the words that start one (AffineMatrix); the other
+        # words use the matrix of the last word that started one.
+        word_tm = np.array(word_tm, dtype=bool)
+        tm_idx = np.flatnonzero(word_tm)
+        matrices = np.array([AffineMatrix(word_dirs[i],
+                                 *[float(v[word_lines[i]]) for v in
+                                   (line_x1, line_y1, line_x2, line_y2)])
+                             for i in tm_idx.tolist()], dtype=np.float64)
+        word_matrix = matrices[np.cumsum(word_tm) - 1]
+        dx = x - np.concatenate(([0.], x[:-1]))
+        dy = y - np.concatenate(([0.], y[:-1]))
+        td_x = prec_array(dx * word_matrix[:, 0] + dy * word_matrix[:, 1])
+        td_y = prec_array(dx * word_matrix[:, 2] + dy * word_matrix[:, 3])
+        tm_values = prec_array(np.column_stack((matrices, x[tm_idx],
+                                                y[tm_idx])))
+
+        # Font sizes, falling back to the line height
+        line_heights = np.abs(line_y2 - line_y1).tolist()
+        word_lines = word_lines.tolist()
+        kDefaultFontsize = 8;
+        for i, fontsize in enumerate(word_fontsizes):
+            if fontsize <= 0:
+                fontsize = line_heights[word_lines[i]]
+                if fontsize <= 0:
+                    fontsize = kDefaultFontsize
+                word_fontsizes[i] = fontsize
+
+        h_stretch = K_CHAR_WIDTH * prec_array(100.0 * word_length /
+                (np.array(word_fontsizes, dtype=np.float64) *
+                 np.array(word_chars, dtype=np.float64)))
+        has_length = (word_length > 0).tolist()
+
+        # Second pass: create the format string and its values for the page
+        fmt = []
+        values = []
+        word_tm = word_tm.tolist()
+        td_x = td_x.tolist()
+        td_y = td_y.tolist()
+        tm_values = tm_values.tolist()
+        h_stretch = h_stretch.tolist()
+
+        i = 0
+        tm_i = 0
+        for paragraph_layout in layout:
+            fmt.append(begin_text)
+            old_fontsize = 0
+
+            for line_words in paragraph_layout:
+                for _ in range(line_words):
+                    if word_tm[i]:
+                        fmt.append(' %.8f %.8f %.8f %.8f %.8f %.8f Tm ')
+                        values.extend(tm_values[tm_i])
+                        tm_i += 1
+                    else:
+                        fmt.append(' %.8f %.8f Td ')
+                        values.append(td_x[i])
+                        values.append(td_y[i])
+
+                    fontsize = word_fontsizes[i]
+                    if fontsize != old_fontsize:
+                        fmt.append('/f-0-0 %s Tf ')
+                        values.append(str(fontsize))
+                        old_fontsize = fontsize
+
+                    if has_length[i]:
+                        fmt.append('%.8f Tz [ <%s0020> ] TJ')
+                        values.append(h_stretch[i])
+                        values.append(word_hex[i])
+
+                    i += 1
+
+                # Last word in the line
+                fmt.append(' \n')
+
+            # Last line the block
+            fmt.append('ET\n')
+
+        return header + (''.join(fmt) % tuple(values)).encode('ascii')
+
     def BeginDocumentHandler(self):
         self.AppendPDFObject(b'%PDF-1.5\n%\xDE\xAD\xBE\xEB\n');
         self.AppendPDFObject(b'1 0 obj\n'
@@ -387,6 +613,29 @@ class TessPDFRenderer(object):
         self.AppendString(stream)
 
     def AddImageHandler(self, word_data, width, height, ppi, hocr_ppi=None):
+        contents = self.GetPageContents(word_data, width, height, ppi,
+                                        hocr_ppi=hocr_ppi)
+        return self.AddPageHandler(contents, width, height)
+
+    def GetPageContents(self, word_data, width, height, ppi, hocr_ppi=None):
+        """
+        Returns the compressed content stream of a page. This does not depend
+        on the state of the document, so pages can be created in parallel and
+        added with AddPageHandler afterwards.
+        """
+        if self.batched:
+            pdftext = self.GetPDFTextObjectsBatched(word_data, width, height,
+                                                    ppi, hocr_ppi=hocr_ppi)
+        else:
+            pdftext = self.GetPDFTextObjects(word_data, width, height, ppi,
+                                             hocr_ppi=hocr_ppi)
+        return zlib.compress(pdftext)
+
+    def AddPageHandler(self, comp_pdftext, width, height):
+        """
+        Adds a page with the content stream comp_pdftext, as returned by
+        GetPageContents.
+        """
         xobject = bytes()
         stream = bytes()
 
@@ -411,8 +660,6 @@ class TessPDFRenderer(object):
         self._pages.append(self._obj)
         self.AppendPDFObject(stream)
 
-        pdftext = self.GetPDFTextObjects(word_data, width, height, ppi, hocr_ppi=hocr_ppi)
-        comp_pdftext = zlib.compress(pdftext)
         stream = bytes()
 
         stream += (
@@ -450,6 +697,17 @@ def prec(x):
     return a
 
 
+def prec_array(x):
+    """
+    prec for numpy arrays, with the exact same results.
+    """
+    kPrecision = 1000.0
+    a = np.rint(x * kPrecision) / kPrecision
+    # Also turns -0 into 0
+    a[a == 0] = 0.
+    return a
+
+
 def dist2(x1, y1, x2, y2):
     return (x2 - x1) * (x2 - x1) + (y2 - y1) * (y2 - y1)
 
@@ -540,6 +798,19 @@ def CodepointToUtf16be(code):
     return True, res.encode('ascii')
 
 
+def Utf16beHex(text):
+    """
+    Returns the UTF-16BE hex string (as CodepointToUtf16be would create for
+    every character) of text, and the amount of characters in it. Invalid
+    codepoints (lone surrogates) are dropped.
+    """
+    try:
+        return text.encode('utf-16-be').hex().upper(), len(text)
+    except UnicodeEncodeError:
+        text = ''.join(c for c in text if not 0xD800 <= ord(c) <= 0xDFFF)
+        return text.encode('utf-16-be').hex().upper(), len(text)
+
+
 def floatbytes(v, prec=8):
     fmt_str = '{:.%df}' % prec
     return fmt_str.format(v).encode('ascii')
@@ -3,36 +3,45 @@ import pkg_resources
 import sys
 import os
 import subprocess
-from os import remove
 from time import time
 from datetime import datetime
-from tempfile import mkstemp
 from os.path import join
 import shutil
 import json
 from glob import glob
-from math import ceil
+from math import ceil, floor
+from functools import partial
+from collections import deque
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import queue
 from xml.sax.saxutils import escape as xmlescape
 import re
 import io
 
 
 from PIL import Image
-from PIL import Jpeg2KImagePlugin
 from skimage.color import rgb2hsv
 import numpy as np
 import fitz
 
 from hocr.parse import (hocr_page_iterator, hocr_page_to_word_data,
         hocr_page_get_dimensions, hocr_page_get_scan_res)
-from internetarchivepdf.mrc import KDU_EXPAND, OPJ_DECOMPRESS, \
-        create_mrc_hocr_components, \
+from internetarchivepdf.mrc import JPEG2000_CODEC_KAKADU, \
+        JPEG2000_CODEC_OPENJPEG, get_jpeg2000_codec, \
+        create_mrc_hocr_components, hocr_word_boxes, load_jpeg2000, \
         encode_mrc_images, encode_mrc_mask
 from internetarchivepdf.pdfrenderer import TessPDFRenderer
 from internetarchivepdf.pagenumbers import parse_series, series_to_pdf
-from internetarchivepdf.scandata import scandata_xml_get_skip_pages, \
-        scandata_xml_get_page_numbers, scandata_xml_get_dpi_per_page, \
-        scandata_xml_get_document_dpi
+from internetarchivepdf.scandata import ScanData
+from internetarchivepdf.checkpoint import Checkpoint, checkpoint_key, \
+        file_identity
+from internetarchivepdf.segmentcache import SegmentationCache
+from internetarchivepdf.spool import ImageSpool
+from internetarchivepdf.passthrough import page_image_index, copy_object, \
+        embed_jpeg2000
+from internetarchivepdf.imageprobe import probe_image
 from internetarchivepdf.const import (VERSION, PRODUCER,
         IMAGE_MODE_PASSTHROUGH, IMAGE_MODE_PIXMAP, IMAGE_MODE_MRC,
         RECODE_RUNTIME_WARNING_INVALID_PAGE_SIZE,
@@ -117,19 +126,135 @@ def special_gray_convert(imd):
     return np.array(l * 255, dtype=np.uint8)
 
 
+def hocr_page_data(hocr_file):
+    """
+    Parse an hOCR file page by page, in a streaming manner.
+
+    Args:
+
+    * hocr_file (str): Path to the hOCR file
+
+    Yields a tuple ((width, height), (x_res, y_res), word_data) for every
+    page, where word_data is as returned by hocr_page_to_word_data, without
+    any font scaling (see scale_word_data).
+    """
+    for hocr_page in hocr_page_iterator(hocr_file):
+        yield (hocr_page_get_dimensions(hocr_page),
+               hocr_page_get_scan_res(hocr_page),
+               hocr_page_to_word_data(hocr_page))
+
+
+def scale_word_data(word_data, scaler):
+    """
+    Returns a copy of word_data (as yielded by hocr_page_data) with the font
+    sizes scaled by scaler, the same as passing scaler to
+    hocr_page_to_word_data. Only the words are copied, the paragraphs and
+    lines are rebuilt around them.
+    """
+    if scaler == 1:
+        return word_data
+
+    scaled = []
+    for paragraph in word_data:
+        lines = []
+        for line in paragraph['lines']:
+            words = []
+            for word in line['words']:
+                word = dict(word)
+                word['fontsize'] *= scaler
+                words.append(word)
+
+            line = dict(line)
+            line['words'] = words
+            lines.append(line)
+
+        paragraph = dict(paragraph)
+        paragraph['lines'] = lines
+        scaled.append(paragraph)
+
+    return scaled
+
+
+def image_file_size(imgfile, input_codec=None, tmp_dir=None, errors=None):
+    """
+    Returns the size (width, height) of the image in imgfile, as read from
+    its header (see internetarchivepdf.imageprobe.probe_image, which caches
+    it).
+
+    JPEG2000 images with a broken header get their size from the codestream
+    instead, and are only decoded if that fails too. Other images that the
+    header parser does not understand are opened with Pillow.
+
+    Args:
+
+    * imgfile (str): Path to the image file
+    * input_codec (str): JPEG2000 codec to decode JPEG2000 images with if
+      neither their header nor their codestream can be parsed
+    * tmp_dir (str): Temporary directory for the JPEG2000 codec
+    * errors (set): Set to add runtime warnings to
+    """
+    jpeg2000 = imgfile.endswith('.jp2') or imgfile.endswith('.jpx')
+
+    try:
+        probe = probe_image(imgfile)
+    except (ValueError, OSError):
+        probe = None
+
+    if probe is None and not jpeg2000:
+        # Pillow only reads the header until the image is loaded
+        img = Image.open(imgfile)
+        size = img.size
+        img.close()
+        return size
+
+    if jpeg2000 and (probe is None or not probe.header_valid):
+        if errors is not None:
+            errors.add(RECODE_RUNTIME_WARNING_INVALID_JP2_HEADERS)
+
+    if probe is None:
+        img = get_jpeg2000_codec(input_codec).decode(imgfile, tmp_dir=tmp_dir)
+        size = img.size
+        del img
+        return size
+
+    return probe.size
+
+
 def create_tess_textonly_pdf(hocr_file, save_path, in_pdf=None,
         image_files=None, dpi=None, skip_pages=None, dpi_pages=None,
         reporter=None,
         verbose=False, stop_after=None,
         render_text_lines=False,
         tmp_dir=None,
+        input_codec=None,
+        hocr_pages=None,
+        workers=None,
         errors=None):
-    hocr_iter = hocr_page_iterator(hocr_file)
+    """
+    Create the text-only PDF from the hOCR file, with the page sizes of the
+    images (or in_pdf). The PDF is written to save_path as it is created;
+    save_path is either a path or a file-like object (e.g. io.BytesIO).
 
-    render = TessPDFRenderer(render_text_lines=render_text_lines)
-    render.BeginDocumentHandler()
+    skip_pages (a set of hOCR page indexes) and dpi_pages (the DPI of every
+    page that is not skipped) are typically taken from a ScanData.
+
+    hocr_pages is an optional iterable over the parsed hOCR pages, as yielded
+    by hocr_page_data, to be used instead of parsing hocr_file.
+
+    If workers is larger than one, the content streams of the pages are
+    created and compressed in a pool of worker processes; only the
+    assignment of object numbers and offsets is done in this process.
+    """
+    if hocr_pages is None:
+        hocr_pages = hocr_page_data(hocr_file)
+
+    if isinstance(save_path, str):
+        fp = open(save_path, 'wb+')
+    else:
+        fp = save_path
 
-    skipped_pages = 0
+    render = TessPDFRenderer(render_text_lines=render_text_lines, fp=fp)
+    render.BeginDocumentHandler()
 
     last_time = time()
     reporting_page_count = 0
@@ -137,132 +262,119 @@ def create_tess_textonly_pdf(hocr_file, save_path, in_pdf=None,
     if verbose:
         print('Starting page generation at', datetime.utcnow().isoformat())
 
-    for idx, hocr_page in enumerate(hocr_iter):
-        w, h = hocr_page_get_dimensions(hocr_page)
-        hocr_dpi = hocr_page_get_scan_res(hocr_page)
-        # If scan_res is not found in hOCR, it returns (None, None)
-        hocr_dpi = hocr_dpi[1]
-
-        if skip_pages is not None and idx in skip_pages:
-            if verbose:
-                print('Skipping page %d' % idx)
-            skipped_pages += 1
-            continue
-
-        if stop_after is not None and (idx - skipped_pages) >= stop_after:
-            break
-
-        if in_pdf is not None:
-            page = in_pdf[idx - skipped_pages]
-            width = page.rect.width
-            height = page.rect.height
-
-            scaler = page.rect.width / w
-            ppi = 72 / scaler
-        elif image_files is not None:
-            # Do not subtract skipped pages here
-            imgfile = image_files[idx]
-
-            if imgfile.endswith('.jp2'):
-                # Pillow reads the entire file for JPEG2000 images - just to get
-                # the image size!
-                fd = open(imgfile, 'rb')
-                try:
-                    size, mode, mimetype = Jpeg2KImagePlugin._parse_jp2_header(fd)
-                except Exception:
-                    # JP2 lacks some info and PIL doesn't like it (Image.open
-                    # will not work, so use kdu_expand to create a tiff)
-                    if errors is not None:
-                        errors.add(RECODE_RUNTIME_WARNING_INVALID_JP2_HEADERS)
-
-                    fd2, tiff_in = mkstemp(prefix='in', suffix='.tiff', dir=tmp_dir)
-                    os.close(fd2)
-                    os.remove(tiff_in)
-                    subprocess.check_call([KDU_EXPAND, '-i', imgfile, '-o',
-                        tiff_in], stderr=subprocess.DEVNULL,
-                        stdout=subprocess.DEVNULL)
-
-                    img = Image.open(tiff_in)
-                    size = img.size
-                    del img
-                    os.remove(tiff_in)
-                finally:
-                    fd.close()
-
-                imwidth, imheight = size
-            else:
-                img = Image.open(imgfile)
-                imwidth, imheight = img.size
-                del img
+    def page_jobs():
+        skipped_pages = 0
+        seq = 0
 
-            page_dpi = dpi
-            per_page_dpi = None
+        for idx, (dimensions, hocr_dpi, word_data) in enumerate(hocr_pages):
+            w, h = dimensions
+            # If scan_res is not found in hOCR, it returns (None, None)
+            hocr_dpi = hocr_dpi[1]
 
-            if dpi_pages is not None:
-                try:
-                    per_page_dpi = int(dpi_pages[idx - skipped_pages])
-                    page_dpi = per_page_dpi
-                except:
-                    pass  # Keep item-wide dpi if available
-
-            # Both document level dpi is not available and per-page dpi is not
-            # available, let's guesstimate
-            # Assume european A4 (8.27",11.69") and guess DPI
-            # to be one-of (72, 96, 150, 300, 600)
-            if page_dpi is None:
-                page_dpi = guess_dpi(imwidth, imheight,
-                                     expected_format=(8.27, 11.69),
-                                     round_to=(72, 96, 150, 300, 600))
-
-            page_width = imwidth / (page_dpi / 72)
-            if page_width <= PDFA_MIN_UNITS or page_width >= PDFA_MAX_UNITS:
+            if skip_pages is not None and idx in skip_pages:
                 if verbose:
-                    print('Page size invalid with current image size and dpi.')
-                    print('Image size: %d, %d. DPI: %d' % (imwidth, imheight,
-                                                           page_dpi))
-
-                # First let's try without per_page_dpi, is avail, then try to
-                # guess the page dpi, if that also fails, then set to min
-                # or max allowed size
-                if per_page_dpi is not None and dpi:
-                    if verbose:
-                        print('Trying document level dpi:', dpi)
-                    page_width = imwidth / (dpi / 72)
+                    print('Skipping page %d' % idx)
+                skipped_pages += 1
+                continue
 
-                # If that didn't work, guess
-                if page_width <= PDFA_MIN_UNITS or page_width >= PDFA_MAX_UNITS:
+            if stop_after is not None and (idx - skipped_pages) >= stop_after:
+                break
+
+            if in_pdf is not None:
+                page = in_pdf[idx - skipped_pages]
+                width = page.rect.width
+                height = page.rect.height
+
+                scaler = page.rect.width / w
+                ppi = 72 / scaler
+            elif image_files is not None:
+                # Do not subtract skipped pages here
+                imgfile = image_files[idx]
+                imwidth, imheight = image_file_size(imgfile,
+                        input_codec=input_codec, tmp_dir=tmp_dir,
+                        errors=errors)
+
+                page_dpi = dpi
+                per_page_dpi = None
+
+                if dpi_pages is not None:
+                    try:
+                        per_page_dpi = int(dpi_pages[idx - skipped_pages])
+                        page_dpi = per_page_dpi
+                    except:
+                        pass  # Keep item-wide dpi if available
+
+                # Both document level dpi is not available and per-page dpi is not
+                # available, let's guesstimate
+                # Assume european A4 (8.27",11.69") and guess DPI
+                # to be one-of (72, 96, 150, 300, 600)
+                if page_dpi is None:
                     page_dpi = guess_dpi(imwidth, imheight,
                                          expected_format=(8.27, 11.69),
                                          round_to=(72, 96, 150, 300, 600))
-                    if verbose:
-                        print('Guessing DPI:', dpi)
-                    page_width = imwidth / (page_dpi / 72)
 
-                # If even guessing fails, let's just set minimal values since
-                # this typically only happens for really tiny images
+                page_width = imwidth / (page_dpi / 72)
                 if page_width <= PDFA_MIN_UNITS or page_width >= PDFA_MAX_UNITS:
-                    page_width = PDFA_MIN_UNITS + 1
-                    page_height = PDFA_MIN_UNITS + 1
+                    if verbose:
+                        print('Page size invalid with current image size and dpi.')
+                        print('Image size: %d, %d. DPI: %d' % (imwidth, imheight,
+                                                               page_dpi))
+
+                    # First let's try without per_page_dpi, is avail, then try to
+                    # guess the page dpi, if that also fails, then set to min
+                    # or max allowed size
+                    if per_page_dpi is not None and dpi:
+                        if verbose:
+                            print('Trying document level dpi:', dpi)
+                        page_width = imwidth / (dpi / 72)
+
+                    # If that didn't work, guess
+                    if page_width <= PDFA_MIN_UNITS or page_width >= PDFA_MAX_UNITS:
+                        page_dpi = guess_dpi(imwidth, imheight,
+                                             expected_format=(8.27, 11.69),
+                                             round_to=(72, 96, 150, 300, 600))
+                        if verbose:
+                            print('Guessing DPI:', dpi)
+                        page_width = imwidth / (page_dpi / 72)
+
+                    # If even guessing fails, let's just set minimal values since
+                    # this typically only happens for really tiny images
+                    if page_width <= PDFA_MIN_UNITS or page_width >= PDFA_MAX_UNITS:
+                        page_width = PDFA_MIN_UNITS + 1
+                        page_height = PDFA_MIN_UNITS + 1
+
+                    # Add warning/error
+                    if errors is not None:
+                        errors.add(RECODE_RUNTIME_WARNING_INVALID_PAGE_SIZE)
 
-                # Add warning/error
-                if errors is not None:
-                    errors.add(RECODE_RUNTIME_WARNING_INVALID_PAGE_SIZE)
+                scaler = page_width / imwidth
 
-            scaler = page_width / imwidth
+                ppi = 72. / scaler
 
-            ppi = 72. / scaler
+                width = page_width
+                height = imheight * scaler
 
-            width = page_width
-            height = imheight * scaler
+            font_scaler = 1
+            if hocr_dpi is not None:
+                font_scaler = hocr_dpi / ppi
+            else:
+                font_scaler = 72. / ppi
 
-        font_scaler = 1
-        if hocr_dpi is not None:
-            font_scaler = hocr_dpi / ppi
-        else:
-            font_scaler = 72. / ppi
+            word_data = scale_word_data(word_data, font_scaler)
+
+            yield seq, word_data, width, height, ppi, hocr_dpi
+            seq += 1
+
+    render_page = partial(_render_text_page_job,
+                          render_text_lines=render_text_lines)
+    if workers is not None and workers > 1:
+        pages = parallel_map_ordered(render_page, page_jobs(), workers)
+    else:
+        pages = (render_page(job)[1] for job in page_jobs())
 
-        word_data = hocr_page_to_word_data(hocr_page, font_scaler)
-        render.AddImageHandler(word_data, width, height, ppi=ppi, hocr_ppi=hocr_dpi)
+    # Only the object numbering is done here, in page order
+    for contents, width, height in pages:
+        render.AddPageHandler(contents, width, height)
 
         reporting_page_count += 1
 
@@ -282,9 +394,38 @@ def create_tess_textonly_pdf(hocr_file, save_path, in_pdf=None,
 
     render.EndDocumentHandler()
 
-    fp = open(save_path, 'wb+')
-    fp.write(render._data)
-    fp.close()
+    if isinstance(save_path, str):
+        fp.close()
+
+
+def _render_text_page_job(job, render_text_lines=False):
+    # Helper for the worker processes, job is (seq, word_data, width, height,
+    # ppi, hocr_ppi)
+    seq, word_data, width, height, ppi, hocr_ppi = job
+    render = TessPDFRenderer(render_text_lines=render_text_lines)
+    contents = render.GetPageContents(word_data, width, height, ppi,
+                                      hocr_ppi=hocr_ppi)
+    return seq, (contents, width, height)
+
+
+def keep_word_boxes(hocr_pages, kept):
+    """
+    Yields the pages of hocr_pages (as yielded by hocr_page_data), appending
+    each of them to the deque kept with only the boxes of its words (see
+    internetarchivepdf.mrc.hocr_word_boxes) instead of its word data, so that
+    the word data of a page can be dropped once it has been used.
+    """
+    for dimensions, scan_res, word_data in hocr_pages:
+        kept.append((dimensions, scan_res, hocr_word_boxes(word_data)))
+        yield dimensions, scan_res, word_data
+
+
+def drain(items):
+    """
+    Yields the items of the deque items, removing each of them from it.
+    """
+    while items:
+        yield items.popleft()
 
 
 def get_timing_summary(timing_data):
@@ -316,6 +457,545 @@ def get_timing_summary(timing_data):
 
 
 
+def reduce_levels(downsample):
+    """
+    Returns the amount of resolution levels (halvings) that a JPEG2000 decoder
+    can discard for an image that is to be downsampled by downsample, without
+    going below the downsampled resolution.
+    """
+    levels = 0
+    while 2 ** (levels + 1) <= downsample:
+        levels += 1
+    return levels
+
+
+def downsampled_size(size, downsample):
+    """
+    Returns the size (width, height) of an image of size size downsampled by
+    downsample, as PIL.Image.thumbnail computes it (keeping the aspect
+    ratio), which is how pages are downsampled when they are not decoded at
+    a reduced resolution.
+    """
+    width, height = size
+    x = max(1, floor(width / downsample))
+    y = max(1, floor(height / downsample))
+    if x >= width and y >= height:
+        return size
+
+    def round_aspect(number, key):
+        return max(min(floor(number), ceil(number), key=key), 1)
+
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect,
+                         key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+
+def draft_image(image, downsample):
+    """
+    Set up the decoder of image, which should not be loaded yet, to decode it
+    at a reduced resolution, as close to (but not below) the resolution
+    reduced by downsample as the format allows: JPEG images use DCT scaling
+    (by 1/2, 1/4 or 1/8). Other images are left alone (JPEG2000 images are
+    reduced by load_image).
+
+    Args:
+
+    * image (PIL.Image): Image opened with Image.open
+    * downsample (int): Factor the image is to be downsampled by
+    """
+    w, h = image.size
+    if image.format == 'JPEG':
+        if int(w / downsample) == 0 or int(h / downsample) == 0:
+            return
+        image.draft(image.mode, (int(w / downsample), int(h / downsample)))
+
+
+def load_image(open_image, downsample=None):
+    """
+    Open an image with open_image and load it, at a reduced resolution if
+    downsample is given and the format allows it: JPEG images use DCT scaling
+    (see draft_image), JPEG2000 images discard resolution levels (see
+    reduce_levels and internetarchivepdf.mrc.load_jpeg2000).
+
+    Args:
+
+    * open_image (function): Returns the image (PIL.Image, not loaded yet),
+      can be called more than once
+    * downsample (int): Factor the image is to be downsampled by
+
+    Returns a tuple of the loaded PIL.Image and the size (width, height) of
+    the image at full resolution.
+    """
+    image = open_image()
+    size = image.size
+    if downsample is not None and image.format == 'JPEG2000':
+        image.close()
+        return load_jpeg2000(open_image, reduce_levels(downsample)), size
+
+    if downsample is not None:
+        draft_image(image, downsample)
+    image.load()
+    return image, size
+
+
+def load_mrc_page_image(image_source, downsample=None, grayscale_pdf=False,
+        input_codec=None, tmp_dir=None, timing_data=None):
+    """
+    Load (decode) the image of a page and prepare it for MRC compression:
+    optionally convert it to grayscale and downsample it.
+
+    When downsampling, JPEG and JPEG2000 images are decoded at a reduced
+    resolution where possible (see load_image), and only what remains of the
+    downsample factor is resampled, to the same size as when the full image
+    is downsampled (see downsampled_size).
+
+    Args:
+
+    * image_source (str or bytes): Path to the image file (image stack) or the
+      image data as extracted from the input PDF
+
+    The remaining arguments are the same as the ones for insert_images_mrc.
+
+    Returns the PIL.Image of the page.
+    """
+    t = time()
+    if isinstance(image_source, bytes):
+        # TODO: Support more images and their masks, if they exist (and
+        # write them to the right place in the PDF)
+        image, size = load_image(lambda: Image.open(io.BytesIO(image_source)),
+                                 downsample)
+    else:
+        imgfile = image_source
+
+        if imgfile.endswith('.jp2') or imgfile.endswith('.jpx'):
+            codec = get_jpeg2000_codec(input_codec)
+            if downsample is not None:
+                size = image_file_size(imgfile, input_codec=input_codec,
+                                       tmp_dir=tmp_dir)
+                image = codec.decode(imgfile,
+                                     reduce=reduce_levels(downsample),
+                                     tmp_dir=tmp_dir)
+            else:
+                image = codec.decode(imgfile, tmp_dir=tmp_dir)
+        else:
+            image, size = load_image(lambda: Image.open(imgfile), downsample)
+    if timing_data is not None:
+        timing_data.append(('image_load', time()-t))
+
+    if grayscale_pdf and image.mode not in ('L', 'LA'):
+        t = time()
+        image = Image.fromarray(special_gray_convert(np.array(image)))
+        if timing_data is not None:
+            timing_data.append(('special_gray_convert', time()-t))
+
+    if downsample is not None:
+        # Resample what is left of the downsample factor. Reduced decodes
+        # round up, so this can also be a single row or column.
+        target_size = downsampled_size(size, downsample)
+        if image.size != target_size:
+            image = image.resize(target_size, resample=Image.LANCZOS)
+
+    return image
+
+
+def segment_mrc_page(image, hocr_word_data, render_hq=False, downsample=None,
+        bg_downsample=None, denoise_mask=None, strip_height=None,
+        segment_threads=None, fast_bg_downsample=False, noise_estimator=None,
+        mask_noise_estimator=None, timing_data=None, errors=None):
+    """
+    Segment the image of a page into its MRC components.
+
+    Bitonal images are not segmented, they are used as the mask as-is.
+
+    Returns a generator yielding the numpy arrays of the components: (mask,
+    foreground, background) for MRC pages, just the mask for bitonal pages.
+    """
+    if image.mode == '1':
+        return iter([np.array(image)])
+
+    return create_mrc_hocr_components(image, hocr_word_data,
+            downsample=downsample, bg_downsample=None if render_hq else
+            bg_downsample, denoise_mask=denoise_mask,
+            timing_data=timing_data, errors=errors, strip_height=strip_height,
+            segment_threads=segment_threads,
+            fast_bg_downsample=fast_bg_downsample,
+            noise_estimator=noise_estimator,
+            mask_noise_estimator=mask_noise_estimator)
+
+
+def encode_mrc_page(mrc_gen, bitonal=False, render_hq=False,
+        bg_slope=None, fg_slope=None, hq_bg_slope=None, hq_fg_slope=None,
+        jbig2=False, fg_codec=None, bg_codec=None, encode_threads=None,
+        tmp_dir=None, timing_data=None):
+    """
+    Encode the MRC components of a page, as yielded by segment_mrc_page.
+
+    Returns a dict with the encoded images and their sizes ('mask',
+    'mask_size', 'fg', 'fg_size', 'bg', 'bg_size'); 'fg' and 'bg' are None
+    for bitonal pages.
+    """
+    if bitonal:
+        np_mask = next(mrc_gen)
+        hh, ww = np_mask.shape
+        mask_jb2, mask_png = encode_mrc_mask(np_mask, tmp_dir=tmp_dir,
+                jbig2=jbig2, timing_data=timing_data)
+        np_mask = None
+
+        return {'mask': mask_jb2 if jbig2 else mask_png, 'mask_size': (ww, hh),
+                'fg': None, 'fg_size': None,
+                'bg': None, 'bg_size': None}
+
+    # TODO: maybe call the encode_mrc_{mask,foreground,background}
+    # separately from here so that we can free the arrays sooner (and even
+    # get the images separately from the create_mrc_hocr_components call)
+    mask_contents, bg_contents, bg_s, fg_contents, fg_s = encode_mrc_images(
+            mrc_gen,
+            bg_slope=hq_bg_slope if render_hq else bg_slope,
+            fg_slope=hq_fg_slope if render_hq else fg_slope,
+            tmp_dir=tmp_dir, jbig2=jbig2, timing_data=timing_data,
+            threads=encode_threads, fg_codec=fg_codec, bg_codec=bg_codec)
+
+    return {'mask': mask_contents, 'mask_size': None,
+            'fg': fg_contents, 'fg_size': fg_s,
+            'bg': bg_contents, 'bg_size': bg_s}
+
+
+def lookup_segmentation(segmentation_cache, image_source, hocr_word_data,
+        timing_data, render_hq=False, downsample=None, bg_downsample=None,
+        denoise_mask=None, grayscale_pdf=False, input_codec=None,
+        fast_bg_downsample=False, noise_estimator=None,
+        mask_noise_estimator=None):
+    """
+    Look up the segmentation of a page in segmentation_cache (a
+    internetarchivepdf.segmentcache.SegmentationCache, or None for no cache).
+    The cache key covers all the arguments that affect the output of
+    load_mrc_page_image and segment_mrc_page.
+
+    Returns (cached, store): cached is the (components, errors) of the page
+    if it is in the cache, None otherwise, and store(components, errors)
+    stores the segmentation of the page in the cache. The time both take is
+    added to timing_data.
+    """
+    if segmentation_cache is None:
+        return None, lambda components, errors: None
+
+    t = time()
+    cache_key = segmentation_cache.key(image_source, hocr_word_data, {
+        'version': VERSION,
+        'downsample': downsample,
+        'bg_downsample': None if render_hq else bg_downsample,
+        'denoise_mask': denoise_mask,
+        'grayscale_pdf': grayscale_pdf,
+        'input_codec': input_codec,
+        'fast_bg_downsample': fast_bg_downsample,
+        'noise_estimator': noise_estimator,
+        'mask_noise_estimator': mask_noise_estimator,
+    })
+    cached = segmentation_cache.get(cache_key)
+    timing_data.append(('segmentation_cache_get', time() - t))
+
+    def store(components, errors):
+        t = time()
+        segmentation_cache.put(cache_key, components, errors)
+        timing_data.append(('segmentation_cache_put', time() - t))
+
+    return cached, store
+
+
+def create_mrc_page(image_source, hocr_word_data, render_hq=False,
+        bg_slope=None, fg_slope=None, hq_bg_slope=None, hq_fg_slope=None,
+        jbig2=False, downsample=None, bg_downsample=None, denoise_mask=None,
+        grayscale_pdf=False, input_codec=None, fg_codec=None, bg_codec=None,
+        encode_threads=None, tmp_dir=None, segmentation_cache=None,
+        strip_height=None, segment_threads=None, fast_bg_downsample=False,
+        noise_estimator=None, mask_noise_estimator=None):
+    """
+    Load, segment and encode the images of a single page.
+
+    This does not touch any fitz document, so it can be run in a worker
+    process; the caller inserts the result into the PDF with
+    insert_mrc_page.
+
+    Args:
+
+    * image_source (str or bytes): Path to the image file (image stack) or the
+      image data as extracted from the input PDF
+    * hocr_word_data: OCR data about found text on the page
+    * render_hq (bool): Whether to render this page in higher quality
+    * segmentation_cache (SegmentationCache): Optional cache to take the
+      segmentation of the page from, or to store it in
+
+    The remaining arguments are the same as the ones for insert_images_mrc.
+
+    Returns a dict as returned by encode_mrc_page, with the 'timing_data' and
+    'errors' of this page added to it.
+    """
+    timing_data = []
+    errors = set()
+
+    cached, store_segmentation = lookup_segmentation(segmentation_cache,
+            image_source, hocr_word_data, timing_data, render_hq=render_hq,
+            downsample=downsample, bg_downsample=bg_downsample,
+            denoise_mask=denoise_mask, grayscale_pdf=grayscale_pdf,
+            input_codec=input_codec, fast_bg_downsample=fast_bg_downsample,
+            noise_estimator=noise_estimator,
+            mask_noise_estimator=mask_noise_estimator)
+
+    if cached is not None:
+        components, errors = cached
+        mrc_gen = iter(components)
+        bitonal = len(components) == 1
+        components = None
+    else:
+        image = load_mrc_page_image(image_source, downsample=downsample,
+                grayscale_pdf=grayscale_pdf, input_codec=input_codec,
+                tmp_dir=tmp_dir, timing_data=timing_data)
+        bitonal = image.mode == '1'
+
+        mrc_gen = segment_mrc_page(image, hocr_word_data, render_hq=render_hq,
+                downsample=downsample, bg_downsample=bg_downsample,
+                denoise_mask=denoise_mask, strip_height=strip_height,
+                segment_threads=segment_threads,
+                fast_bg_downsample=fast_bg_downsample,
+                noise_estimator=noise_estimator,
+                mask_noise_estimator=mask_noise_estimator,
+                timing_data=timing_data, errors=errors)
+        image = None
+
+        if segmentation_cache is not None:
+            components = list(mrc_gen)
+            store_segmentation(components, errors)
+            mrc_gen = iter(components)
+            components = None
+
+    page_data = encode_mrc_page(mrc_gen, bitonal=bitonal, render_hq=render_hq,
+            bg_slope=bg_slope, fg_slope=fg_slope, hq_bg_slope=hq_bg_slope,
+            hq_fg_slope=hq_fg_slope, jbig2=jbig2, fg_codec=fg_codec,
+            bg_codec=bg_codec, encode_threads=encode_threads, tmp_dir=tmp_dir,
+            timing_data=timing_data)
+
+    page_data['timing_data'] = timing_data
+    page_data['errors'] = errors
+
+    return page_data
+
+
+def insert_mrc_page(page, page_data, img_dir=None, idx=None,
+                    timing_data=None):
+    """
+    Insert the images of a page as created by create_mrc_page into a fitz
+    page.
+
+    Args:
+
+    * page (fitz.Page): Page to insert the images into
+    * page_data (dict): Page as returned by create_mrc_page
+    * img_dir (str): Optional directory to (also) write the images to
+    * idx (int): Page index, used for the filenames in img_dir
+    * timing_data (optional): Add time information to timing_data structure
+    """
+    if page_data['fg'] is None:
+        t = time()
+        ww, hh = page_data['mask_size']
+        page.insert_image(page.rect, stream=page_data['mask'],
+                width=ww, height=hh, alpha=0)
+
+        if timing_data is not None:
+            timing_data.append(('page_image_insertion', time() - t))
+        return
+
+    if img_dir is not None:
+        for name, key in (('mask.jbig2', 'mask'), ('bg.jp2', 'bg'),
+                          ('fg.jp2', 'fg')):
+            fp = open(join(img_dir, '%.6d_%s' % (idx, name)), 'wb+')
+            fp.write(page_data[key])
+            fp.close()
+
+    t = time()
+    bg_s = page_data['bg_size']
+    fg_s = page_data['fg_size']
+    # Tell PyMuPDF about width/height/alpha since it's faster this way
+    page.insert_image(page.rect, stream=page_data['bg'], mask=None,
+            overlay=False, width=bg_s[0], height=bg_s[1], alpha=0)
+
+    # Tell PyMuPDF about width/height/alpha since it's faster this way
+    page.insert_image(page.rect, stream=page_data['fg'],
+            mask=page_data['mask'], overlay=True, width=fg_s[0],
+            height=fg_s[1], alpha=0)
+
+    if timing_data is not None:
+        timing_data.append(('page_image_insertion', time() - t))
+
+
+def _create_mrc_page_job(job, **kwargs):
+    # Helper for the worker processes, job is (seq, image_source,
+    # hocr_word_data, render_hq)
+    seq, image_source, hocr_word_data, render_hq = job
+    return seq, create_mrc_page(image_source, hocr_word_data,
+                                render_hq=render_hq, **kwargs)
+
+
+def parallel_map_ordered(func, jobs, workers, max_pending=None):
+    """
+    Run func on every job in a pool of worker processes, yielding the results
+    in the order of the jobs.
+
+    Results that arrive early are kept in a reorder buffer until all the
+    results before them have been yielded. At most max_pending jobs are
+    submitted at any given time (default is twice the amount of workers), so
+    that the memory use stays bounded.
+
+    Args:
+
+    * func: Picklable function taking a job and returning (seq, result),
+      where seq is the first entry of the job (0, 1, 2, ...)
+    * jobs: Iterable of jobs
+    * workers (int): Amount of worker processes
+    * max_pending (int): Maximum amount of jobs submitted to the pool
+
+    Yields the results of func in job order.
+    """
+    if max_pending is None:
+        max_pending = workers * 2
+
+    jobs = iter(jobs)
+    reorder_buffer = {}
+    next_seq = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        exhausted = False
+
+        while True:
+            while not exhausted and len(pending) + len(reorder_buffer) < max_pending:
+                try:
+                    job = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.add(executor.submit(func, job))
+
+            if not pending and not reorder_buffer:
+                break
+
+            if pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    seq, result = future.result()
+                    reorder_buffer[seq] = result
+
+            while next_seq in reorder_buffer:
+                yield reorder_buffer.pop(next_seq)
+                next_seq += 1
+
+
+class _PipelineError(object):
+    # Passed down the pipeline in place of an item when a stage fails
+    def __init__(self, exc):
+        self.exc = exc
+
+
+_PIPELINE_DONE = object()
+
+
+def pipeline_map(stages, items, depth=1):
+    """
+    Run every item through a sequence of stages, where every stage runs in
+    its own thread, connected by bounded queues.
+
+    This allows the stages to overlap: while one item is in the second stage,
+    the next item can already be in the first stage. This works well for
+    stages that mostly wait on subprocesses, disk or code that releases the
+    GIL.
+
+    Args:
+
+    * stages (list of functions): Stages to run, each taking the result of
+      the previous stage (the first stage takes the item)
+    * items: Iterable of items, consumed in a separate thread
+    * depth (int): Size of the queues between the stages, this bounds the
+      amount of items that are in memory at any given time
+
+    Yields the result of the last stage for every item, in order. If any of
+    the stages (or the items iterable) raises an exception, it is raised
+    again here. The threads exit once the generator is exhausted, raises or is
+    closed (the consumer stopping early); items that are still in the stages
+    then are discarded.
+    """
+    queues = [queue.Queue(maxsize=depth) for _ in range(len(stages) + 1)]
+    # Set when the consumer stops, early or because of an exception
+    stop = threading.Event()
+
+    def feed():
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                queues[0].put(item)
+        except BaseException as e:
+            queues[0].put(_PipelineError(e))
+        queues[0].put(_PIPELINE_DONE)
+
+    def run_stage(stage, q_in, q_out):
+        while True:
+            item = q_in.get()
+            if item is _PIPELINE_DONE:
+                break
+            if stop.is_set():
+                # Nobody is waiting for the result anymore
+                continue
+            if not isinstance(item, _PipelineError):
+                try:
+                    item = stage(item)
+                except BaseException as e:
+                    item = _PipelineError(e)
+            q_out.put(item)
+        q_out.put(_PIPELINE_DONE)
+
+    # Daemon threads: the items iterable might block, and that should not keep
+    # the interpreter alive
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for idx, stage in enumerate(stages):
+        threads.append(threading.Thread(target=run_stage,
+            args=(stage, queues[idx], queues[idx + 1]), daemon=True))
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _PIPELINE_DONE:
+                break
+            if isinstance(item, _PipelineError):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+
+        def drain(q):
+            try:
+                while True:
+                    q.get_nowait()
+            except queue.Empty:
+                pass
+
+        # A thread can be blocked on putting an item into its (full) output
+        # queue, so drain that queue until the thread has exited. Then pass on
+        # the end of the items, which might have been drained, to the next
+        # thread.
+        for thread, q_out in zip(threads, queues):
+            while thread.is_alive():
+                drain(q_out)
+                thread.join(0.01)
+            drain(q_out)
+            q_out.put(_PIPELINE_DONE)
+
+
 def insert_images_mrc(to_pdf, hocr_file, from_pdf=None, image_files=None,
         bg_slope=None, fg_slope=None,
         skip_pages=None, img_dir=None, jbig2=False,
@@ -325,170 +1005,216 @@ def insert_images_mrc(to_pdf, hocr_file, from_pdf=None, image_files=None,
         hq_pages=None, hq_bg_slope=None, hq_fg_slope=None,
         verbose=False, tmp_dir=None, report_every=None,
         stop_after=None, grayscale_pdf=False,
-        use_openjpeg=False, errors=None):
-    hocr_iter = hocr_page_iterator(hocr_file)
+        use_openjpeg=False, workers=None, pipeline_depth=None,
+        encode_threads=None, input_codec=None, fg_codec=None, bg_codec=None,
+        hocr_pages=None, checkpoint=None, segmentation_cache=None,
+        spool=None, flush_every=None, strip_height=None,
+        segment_threads=None, fast_bg_downsample=False, noise_estimator=None,
+        mask_noise_estimator=None, errors=None):
+    """
+    Insert the MRC compressed images into to_pdf.
+
+    Pages are segmented and encoded by create_mrc_page, either in this process
+    or, if workers is larger than one, in a pool of worker processes. Either
+    way, the images are inserted into to_pdf in page order.
+
+    If pipeline_depth is set (and no workers are used), the decoding,
+    segmentation and encoding of pages happen in separate threads, so that
+    the next page is decoded and the previous page is encoded while the
+    current page is being segmented. pipeline_depth bounds the amount of pages
+    waiting between the stages.
+
+    encode_threads is the thread budget for encoding the images of a single
+    page, see encode_mrc_images.
+
+    input_codec, fg_codec and bg_codec select the JPEG2000 codec (see
+    internetarchivepdf.mrc.JPEG2000_CODECS) used to decode the input images
+    and to encode the foreground and background. They default to Kakadu, or
+    OpenJPEG if use_openjpeg is set.
+
+    hocr_pages is an optional iterable over the parsed hOCR pages, as yielded
+    by hocr_page_data (or with the boxes of the words instead of the word
+    data, see internetarchivepdf.mrc.hocr_word_boxes), to be used instead of
+    parsing hocr_file. Only the word boxes of a page are kept while it is
+    compressed.
+
+    If checkpoint (an internetarchivepdf.checkpoint.Checkpoint) is provided,
+    the pages that are in it are taken from it instead of being compressed,
+    and every newly compressed page is stored in it.
+
+    If segmentation_cache (an
+    internetarchivepdf.segmentcache.SegmentationCache) is provided, the
+    segmentation of pages is taken from it if possible, so that only the
+    encoding has to be done.
+
+    If spool (an internetarchivepdf.spool.ImageSpool) and flush_every are
+    provided, the images of every flush_every finished pages are moved out of
+    to_pdf into the spool, so that the images of the whole book are never in
+    memory at once. to_pdf must then be saved with spool.save.
+
+    strip_height makes the segmentation work on horizontal strips of that
+    many rows, see create_mrc_hocr_components. segment_threads is the
+    amount of threads used to threshold and optimise (the foreground and
+    background of) a page. fast_bg_downsample downsamples the background
+    while it is optimised, see create_mrc_hocr_components.
+
+    noise_estimator and mask_noise_estimator select the noise estimator (see
+    internetarchivepdf.mrc.NOISE_ESTIMATORS) that decides whether the page
+    image is blurred before it is thresholded, and whether the thresholded
+    image is denoised (with denoise_mask).
+    """
+    default_codec = JPEG2000_CODEC_OPENJPEG if use_openjpeg else \
+            JPEG2000_CODEC_KAKADU
+    input_codec = input_codec or default_codec
+    fg_codec = fg_codec or default_codec
+    bg_codec = bg_codec or default_codec
 
-    skipped_pages = 0
+    if hocr_pages is None:
+        hocr_pages = hocr_page_data(hocr_file)
 
     last_time = time()
     timing_data = []
     reporting_page_count = 0
+    unflushed_pages = []
 
-    downsampled = False
-
-    #for idx, page in enumerate(to_pdf):
-    for idx, hocr_page in enumerate(hocr_iter):
-        if skip_pages is not None and idx in skip_pages:
-            skipped_pages += 1
-            continue
-
-        idx = idx - skipped_pages
+    def page_jobs():
+        skipped_pages = 0
+        seq = 0
 
-        if stop_after is not None and idx >= stop_after:
-            break
+        for idx, (_, _, hocr_word_data) in enumerate(hocr_pages):
+            if skip_pages is not None and idx in skip_pages:
+                skipped_pages += 1
+                continue
 
-        page = to_pdf[idx]
+            idx = idx - skipped_pages
 
-        if from_pdf is not None:
-            # TODO: Support more images and their masks, if they exist (and
-            # write them to the right place in the PDF)
-            t = time()
+            if stop_after is not None and idx >= stop_after:
+                break
 
-            img = from_pdf[idx].getImageList()[0]
-            xref = img[0]
-            maskxref = img[1]
+            if checkpoint is not None and checkpoint.has_page(idx):
+                continue
 
-            image = from_pdf.extractImage(xref)
-            imgfd = io.BytesIO()
-            imgfd.write(image["image"])
-            image = Image.open(imgfd)
-            image.load()
-            imgfd.close()
+            if from_pdf is not None:
+                img = from_pdf[idx].getImageList()[0]
+                xref = img[0]
+                maskxref = img[1]
 
-            if timing_data is not None:
-                timing_data.append(('image_load', time()-t))
-        else:
-            t = time()
-            # Do not subtract skipped pages here
-            imgfile = image_files[idx+skipped_pages]
-
-            if imgfile.endswith('.jp2') or imgfile.endswith('.jpx'):
-                if not use_openjpeg:
-                    fd, tiff_in = mkstemp(prefix='in', suffix='.tiff', dir=tmp_dir)
-                else:
-                    fd, tiff_in = mkstemp(prefix='in', suffix='.pnm', dir=tmp_dir)
-                os.close(fd)
-                os.remove(tiff_in)
-
-                if not use_openjpeg:
-                    if downsample is not None:
-                        subprocess.check_call([KDU_EXPAND, '-i', imgfile, '-o',
-                            tiff_in, '-reduce', str(downsample-1)], stderr=subprocess.DEVNULL,
-                            stdout=subprocess.DEVNULL)
-                        downsampled = True
-                    else:
-                        subprocess.check_call([KDU_EXPAND, '-i', imgfile, '-o',
-                            tiff_in], stderr=subprocess.DEVNULL,
-                            stdout=subprocess.DEVNULL)
-                else:
-                    if downsample is not None:
-                        subprocess.check_call([OPJ_DECOMPRESS, '-r',
-                            str(downsample-1), '-i', imgfile, '-o',
-                            tiff_in], stderr=subprocess.DEVNULL,
-                            stdout=subprocess.DEVNULL)
-                    else:
-                        subprocess.check_call([OPJ_DECOMPRESS, '-i', imgfile, '-o',
-                            tiff_in], stderr=subprocess.DEVNULL,
-                            stdout=subprocess.DEVNULL)
-
-                image = Image.open(tiff_in)
-                image.load()
-                os.remove(tiff_in)
+                image_source = from_pdf.extractImage(xref)['image']
             else:
-                image = Image.open(imgfile)
-            if timing_data is not None:
-                timing_data.append(('image_load', time()-t))
-
-        if grayscale_pdf and image.mode not in ('L', 'LA'):
-            t = time()
-            image = Image.fromarray(special_gray_convert(np.array(image)))
-            if timing_data is not None:
-                timing_data.append(('special_gray_convert', time()-t))
-
-        render_hq = hq_pages[idx]
-
-        if downsample is not None and not downsampled:
-            w, h = image.size
-            image.thumbnail((w/downsample, h/downsample),
-                            resample=Image.LANCZOS, reducing_gap=None)
-            downsampled = True
-
-        hocr_word_data = hocr_page_to_word_data(hocr_page)
-
-        if image.mode == '1':
-            ww, hh = image.size
-            mask_jb2, mask_png = encode_mrc_mask(np.array(image), tmp_dir=tmp_dir,
-                    jbig2=jbig2, timing_data=timing_data)
-
-            t = time()
+                # Do not subtract skipped pages here
+                image_source = image_files[idx+skipped_pages]
+
+            if not isinstance(hocr_word_data, np.ndarray):
+                hocr_word_data = hocr_word_boxes(hocr_word_data)
+
+            yield seq, image_source, hocr_word_data, hq_pages[idx]
+            seq += 1
+
+    # The arguments that affect the segmentation (see lookup_segmentation)
+    segment_kwargs = dict(downsample=downsample, bg_downsample=bg_downsample,
+            denoise_mask=denoise_mask, grayscale_pdf=grayscale_pdf,
+            input_codec=input_codec, fast_bg_downsample=fast_bg_downsample,
+            noise_estimator=noise_estimator,
+            mask_noise_estimator=mask_noise_estimator)
+
+    page_kwargs = dict(bg_slope=bg_slope, fg_slope=fg_slope,
+            hq_bg_slope=hq_bg_slope, hq_fg_slope=hq_fg_slope,
+            jbig2=jbig2, fg_codec=fg_codec, bg_codec=bg_codec,
+            encode_threads=encode_threads, tmp_dir=tmp_dir,
+            segmentation_cache=segmentation_cache, strip_height=strip_height,
+            segment_threads=segment_threads, **segment_kwargs)
+
+    def load_stage(job):
+        seq, image_source, hocr_word_data, render_hq = job
+        timing_data = []
+
+        cached, store_segmentation = lookup_segmentation(segmentation_cache,
+                image_source, hocr_word_data, timing_data,
+                render_hq=render_hq, **segment_kwargs)
+        if cached is not None:
+            # Nothing left to load or segment
+            return cached, None, render_hq, timing_data, None
+
+        image = load_mrc_page_image(image_source, downsample=downsample,
+                grayscale_pdf=grayscale_pdf, input_codec=input_codec,
+                tmp_dir=tmp_dir, timing_data=timing_data)
+        return image, hocr_word_data, render_hq, timing_data, \
+                store_segmentation
+
+    def segment_stage(loaded):
+        image, hocr_word_data, render_hq, timing_data, \
+                store_segmentation = loaded
+        if hocr_word_data is None:
+            components, errors = image
+            return components, render_hq, timing_data, errors
+
+        errors = set()
+        # Materialise the components here, so that the segmentation happens
+        # in this stage and not in the encoding stage
+        components = list(segment_mrc_page(image, hocr_word_data,
+                render_hq=render_hq, downsample=downsample,
+                bg_downsample=bg_downsample, denoise_mask=denoise_mask,
+                strip_height=strip_height, segment_threads=segment_threads,
+                fast_bg_downsample=fast_bg_downsample,
+                noise_estimator=noise_estimator,
+                mask_noise_estimator=mask_noise_estimator,
+                timing_data=timing_data, errors=errors))
+
+        store_segmentation(components, errors)
+
+        return components, render_hq, timing_data, errors
+
+    def encode_stage(segmented):
+        components, render_hq, timing_data, errors = segmented
+        page_data = encode_mrc_page(iter(components),
+                bitonal=len(components) == 1, render_hq=render_hq,
+                bg_slope=bg_slope, fg_slope=fg_slope,
+                hq_bg_slope=hq_bg_slope, hq_fg_slope=hq_fg_slope,
+                jbig2=jbig2, fg_codec=fg_codec, bg_codec=bg_codec,
+                encode_threads=encode_threads, tmp_dir=tmp_dir,
+                timing_data=timing_data)
+        page_data['timing_data'] = timing_data
+        page_data['errors'] = errors
+        return page_data
+
+    if workers is not None and workers > 1:
+        pages = parallel_map_ordered(partial(_create_mrc_page_job,
+                                             **page_kwargs),
+                                     page_jobs(), workers)
+    elif pipeline_depth is not None:
+        pages = pipeline_map([load_stage, segment_stage, encode_stage],
+                             page_jobs(), depth=pipeline_depth)
+    else:
+        pages = (_create_mrc_page_job(job, **page_kwargs)[1]
+                 for job in page_jobs())
 
-            if jbig2:
-                mask_contents = open(mask_jb2, 'rb').read()
-                remove(mask_jb2)
-            else:
-                mask_contents = open(mask_png, 'rb').read()
+    for idx in range(to_pdf.pageCount):
+        if checkpoint is not None and checkpoint.has_page(idx):
+            page_data = checkpoint.load_page(idx)
+        else:
+            page_data = next(pages, None)
+            if page_data is None:
+                break
 
-            # We currently always return the PNG file
-            remove(mask_png)
+            if checkpoint is not None:
+                checkpoint.save_page(idx, page_data)
 
-            page.insert_image(page.rect, stream=mask_contents,
-                    width=ww, height=hh, alpha=0)
+        timing_data.extend(page_data['timing_data'])
+        if errors is not None:
+            errors |= page_data['errors']
 
-            if timing_data is not None:
-                timing_data.append(('page_image_insertion', time() - t))
+        insert_mrc_page(to_pdf[idx], page_data, img_dir=img_dir, idx=idx,
+                        timing_data=timing_data)
+        page_data = None
 
-        else:
-            mrc_gen = create_mrc_hocr_components(image, hocr_word_data,
-                    downsample=downsample, bg_downsample=None if render_hq else
-                    bg_downsample, denoise_mask=denoise_mask,
-                    timing_data=timing_data, errors=errors)
-
-
-            # TODO: keep all these files on disk, and insert them into the pager
-            # later? maybe? or just saveIncr()
-            # TODO: maybe call the encode_mrc_{mask,foreground,background}
-            # separately from here so that we can free the arrays sooner (and even
-            # get the images separately from the create_mrc_hocr_components call)
-            mask_f, bg_f, bg_s, fg_f, fg_s = encode_mrc_images(mrc_gen,
-                    bg_slope=hq_bg_slope if render_hq else bg_slope,
-                    fg_slope=hq_fg_slope if render_hq else fg_slope,
-                    tmp_dir=tmp_dir, jbig2=jbig2, timing_data=timing_data,
-                    use_kdu=not use_openjpeg)
-
-            if img_dir is not None:
-                shutil.copy(mask_f, join(img_dir, '%.6d_mask.jbig2' % idx))
-                shutil.copy(bg_f, join(img_dir, '%.6d_bg.jp2' % idx))
-                shutil.copy(fg_f, join(img_dir, '%.6d_fg.jp2' % idx))
-
-            t = time()
-            bg_contents = open(bg_f, 'rb').read()
-            # Tell PyMuPDF about width/height/alpha since it's faster this way
-            page.insert_image(page.rect, stream=bg_contents, mask=None,
-                    overlay=False, width=bg_s[0], height=bg_s[1], alpha=0)
-
-            fg_contents = open(fg_f, 'rb').read()
-            mask_contents = open(mask_f, 'rb').read()
-
-            # Tell PyMuPDF about width/height/alpha since it's faster this way
-            page.insert_image(page.rect, stream=fg_contents, mask=mask_contents,
-                    overlay=True, width=fg_s[0], height=fg_s[1], alpha=0)
-
-            # Remove leftover files
-            remove(mask_f)
-            remove(bg_f)
-            remove(fg_f)
-            if timing_data is not None:
-                timing_data.append(('page_image_insertion', time() - t))
+        if spool is not None and flush_every is not None:
+            unflushed_pages.append(idx)
+            if len(unflushed_pages) >= flush_every:
+                t = time()
+                for page_idx in unflushed_pages:
+                    spool.spool_page_images(to_pdf, to_pdf[page_idx])
+                unflushed_pages = []
+                timing_data.append(('flush_pages', time() - t))
 
         reporting_page_count += 1
 
@@ -530,25 +1256,81 @@ def insert_images_mrc(to_pdf, hocr_file, from_pdf=None, image_files=None,
         print('MRC time breakdown:', summary)
 
 
-def insert_images(from_pdf, to_pdf, mode, report_every=None, stop_after=None):
-    # TODO: This hasn't been updated, should fix this up, only MRC is tested
-    # really.
+def insert_images(from_pdf, to_pdf, mode, report_every=None, stop_after=None,
+        spool=None, image_files=None, skip_pages=None, input_codec=None,
+        tmp_dir=None, errors=None):
+    """
+    Insert the images of the pages of from_pdf, or the image files
+    image_files, under the pages of to_pdf (IMAGE_MODE_PASSTHROUGH and
+    IMAGE_MODE_PIXMAP).
+
+    The image of every page of from_pdf is looked up in an index that is built
+    once (see internetarchivepdf.passthrough.page_image_index). In passthrough
+    mode with a spool, images are inserted without decoding them: images of
+    from_pdf are copied with their raw streams (see
+    internetarchivepdf.passthrough.copy_object, images that cannot be copied
+    faithfully are extracted instead), JPEG2000 image files are embedded as
+    they are (see internetarchivepdf.passthrough.embed_jpeg2000), and to_pdf
+    must then be saved with spool.save.
+
+    Args:
+
+    * from_pdf (fitz.Document): Input document, or None for image_files
+    * to_pdf (fitz.Document): Output document
+    * mode (int): IMAGE_MODE_PASSTHROUGH or IMAGE_MODE_PIXMAP
+    * report_every (int): Print progress every this many pages
+    * stop_after (int): Stop after this page
+    * spool (internetarchivepdf.spool.ImageSpool): Spool for the raw streams
+    * image_files (list of str): Image files (image stack) of the pages,
+      including the pages in skip_pages
+    * skip_pages (set): Indexes of the image files that have no page in to_pdf
+    * input_codec, tmp_dir: Used to read the size of JPEG2000 files with
+      invalid headers, see image_file_size
+    * errors (set): Set to add runtime warnings to
+    """
     # TODO: implement img_dir here
+    if from_pdf is not None:
+        image_index = page_image_index(from_pdf)
+        xref_map = {}
+    else:
+        image_files = [imgfile for idx, imgfile in enumerate(image_files)
+                       if skip_pages is None or idx not in skip_pages]
 
     for idx, page in enumerate(to_pdf):
-        # XXX: TODO: FIXME: MEGAHACK: For some reason the _imgonly PDFs
-        # generated by us have all images on all pages according to pymupdf, so
-        # hack around that for now.
-        img = sorted(from_pdf.getPageImageList(idx))[idx]
-        #img = from_pdf.getPageImageList(idx)[0]
-
-        xref = img[0]
-        maskxref = img[1]
-        if mode == IMAGE_MODE_PASSTHROUGH:
-            image = from_pdf.extractImage(xref)
-            page.insert_image(page.rect, stream=image["image"], overlay=False)
+        if from_pdf is None:
+            imgfile = image_files[idx]
+            if mode == IMAGE_MODE_PASSTHROUGH and spool is not None and \
+                    (imgfile.endswith('.jp2') or imgfile.endswith('.jpx')):
+                size = image_file_size(imgfile, input_codec=input_codec,
+                                       tmp_dir=tmp_dir, errors=errors)
+                page.insert_image(page.rect, overlay=False,
+                                  xref=embed_jpeg2000(to_pdf, imgfile, size,
+                                                      spool))
+            elif mode == IMAGE_MODE_PASSTHROUGH:
+                page.insert_image(page.rect, filename=imgfile, overlay=False)
+            elif mode == IMAGE_MODE_PIXMAP:
+                pixmap = fitz.Pixmap(imgfile)
+                page.insert_image(page.rect, pixmap=pixmap, overlay=False)
+        elif image_index[idx] is None:
+            pass
+        elif mode == IMAGE_MODE_PASSTHROUGH:
+            xref = None
+            if spool is not None:
+                try:
+                    xref = copy_object(from_pdf, to_pdf, image_index[idx],
+                                       spool, xref_map)
+                except (ValueError, RuntimeError):
+                    # Cannot be copied as it is, extract the image instead
+                    pass
+
+            if xref is not None:
+                page.insert_image(page.rect, overlay=False, xref=xref)
+            else:
+                image = from_pdf.extractImage(image_index[idx])
+                page.insert_image(page.rect, stream=image["image"],
+                                  overlay=False)
         elif mode == IMAGE_MODE_PIXMAP:
-            pixmap = fitz.Pixmap(from_pdf, xref)
+            pixmap = fitz.Pixmap(from_pdf, image_index[idx])
             page.insert_image(page.rect, pixmap=pixmap, overlay=False)
 
         if stop_after is not None and idx >= stop_after:
@@ -591,7 +1373,14 @@ def write_pdfa(to_pdf):
 
 
 def write_page_labels(to_pdf, scandata, errors=None):
-    page_numbers = scandata_xml_get_page_numbers(scandata)
+    """
+    Write the page labels (numbering) from scandata, a ScanData or the path to
+    a scandata XML file, to to_pdf.
+    """
+    if not isinstance(scandata, ScanData):
+        scandata = ScanData(scandata)
+
+    page_numbers = scandata.page_numbers
     res, all_ok = parse_series(page_numbers)
 
     # Add warning/error
@@ -898,7 +1687,14 @@ def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
         render_text_lines=False,
         metadata_url=None, metadata_title=None, metadata_author=None,
         metadata_creator=None, metadata_language=None,
-        metadata_subject=None, metadata_creatortool=None):
+        metadata_subject=None, metadata_creatortool=None,
+        workers=None, pipeline_depth=None, encode_threads=None,
+        input_codec=None, fg_codec=None, bg_codec=None,
+        checkpoint_dir=None, resume=False,
+        segmentation_cache_dir=None, segmentation_cache_size=None,
+        flush_every=None, strip_height=None, segment_threads=None,
+        fast_bg_downsample=False, noise_estimator=None,
+        mask_noise_estimator=None):
     # TODO: document that the scandata document dpi will override the dpi arg
     # TODO: Take hq-pages and reporter arg and change format (as lib call we
     # don't want to pass that as one string, I guess?)
@@ -932,43 +1728,56 @@ def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
 
     start_time = time()
 
-    scandata_doc_dpi = None
-
     # Figure out if we have scandata, and figure out if we want to skip pages
     # based on scandata.
-    skip_pages = []
+    scandata = None
+    skip_pages = set()
     dpi_pages = None
     if scandata_file is not None:
-        skip_pages = scandata_xml_get_skip_pages(scandata_file)
-        dpi_pages = scandata_xml_get_dpi_per_page(scandata_file)
-        scandata_doc_dpi = scandata_xml_get_document_dpi(scandata_file)
+        scandata = ScanData(scandata_file)
+        skip_pages = scandata.skip_pages
+        dpi_pages = scandata.dpi_pages
 
-        if scandata_doc_dpi is not None:
+        if scandata.document_dpi is not None:
             # Let's prefer the DPI in the scandata file over the provided DPI
-            dpi = scandata_doc_dpi
+            dpi = scandata.document_dpi
 
-    # XXX: Maybe use a buffer, since the file is typically quite small
-    fd, tess_tmp_path = mkstemp(prefix='pdfrenderer', suffix='.pdf', dir=tmp_dir)
-    os.close(fd)
+    tess_pdf = io.BytesIO()
 
     if verbose:
         print('Creating text only PDF')
 
+    # The hOCR file is parsed only once. The text-only PDF has to be complete
+    # before the MRC images can be inserted, so the pages it parses are kept
+    # for the MRC pass, but only as arrays of their word boxes (the word data
+    # of a whole book can take gigabytes). The MRC pass drops them as it goes,
+    # and continues parsing where the text pass left off, if needed.
+    hocr_pages = hocr_page_data(hocr_file)
+    word_box_pages = deque()
+    text_hocr_pages = hocr_pages
+    if image_mode == IMAGE_MODE_MRC:
+        text_hocr_pages = keep_word_boxes(hocr_pages, word_box_pages)
+
     # 1. Create text-only PDF from hOCR first, but honour page sizes of in_pdf
-    create_tess_textonly_pdf(hocr_file, tess_tmp_path, in_pdf=in_pdf,
+    create_tess_textonly_pdf(hocr_file, tess_pdf, in_pdf=in_pdf,
             image_files=image_files, dpi=dpi,
             skip_pages=skip_pages, dpi_pages=dpi_pages,
             reporter=reporter,
             verbose=verbose, stop_after=stop,
             render_text_lines=render_text_lines,
             tmp_dir=tmp_dir,
+            input_codec=input_codec or (JPEG2000_CODEC_OPENJPEG if use_openjpeg
+                                        else JPEG2000_CODEC_KAKADU),
+            hocr_pages=text_hocr_pages,
+            workers=workers,
             errors=errors)
+    text_hocr_pages = None
 
     if verbose:
         print('Inserting (and compressing) images')
     # 2. Load tesseract PDF and stick images in the PDF
-    # We open the generated file but do not modify it in place
-    outdoc = fitz.open(tess_tmp_path)
+    outdoc = fitz.open(stream=tess_pdf.getvalue(), filetype='pdf')
+    tess_pdf.close()
 
     HQ_PAGES = [False for x in range(outdoc.pageCount)]
     if hq_pages is not None:
@@ -991,6 +1800,41 @@ def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
             HQ_PAGES[i] = True
 
 
+    checkpoint = None
+    if checkpoint_dir is not None and image_mode == IMAGE_MODE_MRC:
+        checkpoint = Checkpoint(checkpoint_dir, checkpoint_key({
+            'version': VERSION,
+            'from_pdf': file_identity(from_pdf),
+            'image_files': [file_identity(f) for f in image_files or []],
+            'hocr_file': file_identity(hocr_file),
+            'scandata_file': file_identity(scandata_file),
+            'dpi': dpi, 'grayscale_pdf': grayscale_pdf, 'jbig2': jbig2,
+            'stop_after': stop_after, 'use_openjpeg': use_openjpeg,
+            'bg_slope': bg_slope, 'fg_slope': fg_slope,
+            'downsample': downsample, 'bg_downsample': bg_downsample,
+            'denoise_mask': denoise_mask, 'hq_pages': hq_pages,
+            'hq_bg_slope': hq_bg_slope, 'hq_fg_slope': hq_fg_slope,
+            'input_codec': input_codec, 'fg_codec': fg_codec,
+            'bg_codec': bg_codec, 'fast_bg_downsample': fast_bg_downsample,
+            'noise_estimator': noise_estimator,
+            'mask_noise_estimator': mask_noise_estimator,
+            }), resume=resume)
+
+        if verbose:
+            print('Resuming with %d pages from checkpoint' %
+                  len(checkpoint.pages))
+
+    segmentation_cache = None
+    if segmentation_cache_dir is not None:
+        segmentation_cache = SegmentationCache(segmentation_cache_dir,
+                                               max_size=segmentation_cache_size)
+
+    spool = None
+    if (flush_every is not None and image_mode == IMAGE_MODE_MRC) or \
+            image_mode == IMAGE_MODE_PASSTHROUGH:
+        # Passthrough always needs a spool for the raw image streams
+        spool = ImageSpool(tmp_dir=tmp_dir)
+
     if verbose:
         print('Converting with image mode:', image_mode)
     if image_mode == 2:
@@ -1015,11 +1859,31 @@ def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
                           stop_after=stop,
                           grayscale_pdf=grayscale_pdf,
                           use_openjpeg=use_openjpeg,
+                          workers=workers,
+                          pipeline_depth=pipeline_depth,
+                          encode_threads=encode_threads,
+                          input_codec=input_codec,
+                          fg_codec=fg_codec,
+                          bg_codec=bg_codec,
+                          hocr_pages=chain(drain(word_box_pages), hocr_pages),
+                          checkpoint=checkpoint,
+                          segmentation_cache=segmentation_cache,
+                          spool=spool,
+                          flush_every=flush_every,
+                          strip_height=strip_height,
+                          segment_threads=segment_threads,
+                          fast_bg_downsample=fast_bg_downsample,
+                          noise_estimator=noise_estimator,
+                          mask_noise_estimator=mask_noise_estimator,
                           errors=errors)
     elif image_mode in (0, 1):
-        # TODO: Update this codepath
         insert_images(in_pdf, outdoc, mode=image_mode,
-                report_every=report_every, stop_after=stop)
+                report_every=report_every, stop_after=stop, spool=spool,
+                image_files=image_files, skip_pages=skip_pages,
+                input_codec=input_codec or (JPEG2000_CODEC_OPENJPEG
+                                            if use_openjpeg else
+                                            JPEG2000_CODEC_KAKADU),
+                tmp_dir=tmp_dir, errors=errors)
     elif image_mode == 3:
         # 3 = skip
         pass
@@ -1027,10 +1891,9 @@ def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
     # 3. Add PDF/A compliant data
     write_pdfa(outdoc)
 
-    if scandata_file is not None:
-        # XXX: we parse scandata twice now, let's not do that
+    if scandata is not None:
         # 3b. Write page labels from scandata file, if present
-        write_page_labels(outdoc, scandata_file, errors=errors)
+        write_page_labels(outdoc, scandata, errors=errors)
 
 
     lang_if_any = metadata_language[0] if metadata_language else None
@@ -1062,7 +1925,11 @@ def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
         print('Saving PDF now')
 
     t = time()
-    outdoc.save(outfile, deflate=True, pretty=True)
+    if spool is not None:
+        spool.save(outdoc, outfile)
+        spool.close()
+    else:
+        outdoc.save(outfile, deflate=True, pretty=True)
     save_time_ms = int((time() - t)*1000)
     if reporter:
         data = json.dumps({'time_to_save': {'time': save_time_ms}})
@@ -1094,8 +1961,5 @@ def recode(from_pdf=None, from_imagestack=None, dpi=None, hocr_file=None,
     if verbose:
         print('Compression ratio: %f' % (compression_ratio))
 
-    # 5. Remove leftover files
-    remove(tess_tmp_path)
-
     return {'errors': errors,
             'compression_ratio': compression_ratio}
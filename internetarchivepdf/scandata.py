@@ -1,79 +1,89 @@
-import xmltodict
-
-
-def scandata_xml_get_skip_pages(xml_file):
-    scandata = xmltodict.parse(open(xml_file, 'rb'))
-
-    skip = []
+from lxml import etree
+
+
+class ScanData(object):
+    """
+    Scandata XML file, parsed once (in a streaming manner) into the
+    information recode needs.
+
+    Attributes:
+
+    * skip_pages (set of int): indexes of the pages that are not part of the
+      access formats (addToAccessFormats is false)
+    * page_numbers (list of str): page number of every access page, None if
+      the page has no page number
+    * dpi_pages (list of int): DPI of every access page, None if the page has
+      no (valid) DPI
+    * document_dpi (int): DPI of the document, None if not present or invalid
+    """
+
+    def __init__(self, xml_file):
+        """
+        Args:
+
+        * xml_file (str): Path to the scandata XML file
+        """
+        self.skip_pages = set()
+        self.page_numbers = []
+        self.dpi_pages = []
+        self.document_dpi = None
+
+        idx = 0
+        for _, elem in etree.iterparse(xml_file, events=('end',)):
+            parent = elem.getparent()
+            if parent is None:
+                continue
 
-    for idx in range(len(scandata['book']['pageData']['page'])):
-        try:
-            add_to_access_format = scandata['book']['pageData']['page'][idx]['addToAccessFormats']
-            if add_to_access_format == 'false':
-                skip.append(idx)
-        except KeyError:
-            pass
+            if elem.tag == 'page' and parent.tag == 'pageData':
+                self._add_page(idx, elem)
+                idx += 1
 
-    return skip
+                # Free the pages that we have handled
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+            elif elem.tag == 'dpi' and parent.tag == 'bookData':
+                self.document_dpi = _parse_int(elem.text)
 
+    def _add_page(self, idx, page):
+        add_to_access_format = _child_text(page, 'addToAccessFormats')
+        if add_to_access_format == 'false':
+            self.skip_pages.add(idx)
+            return
 
-def scandata_xml_get_page_numbers(xml_file):
-    scandata = xmltodict.parse(open(xml_file, 'rb'))
+        self.page_numbers.append(_child_text(page, 'pageNumber'))
+        self.dpi_pages.append(_parse_int(_child_text(page, 'ppi')))
 
-    res = []
 
-    pages = scandata['book']['pageData']['page']
+def _child_text(elem, tag):
+    child = elem.find(tag)
+    if child is None or child.text is None:
+        return None
 
-    # If there is just one page, pages is not a list.
-    if not isinstance(pages, list):
-        pages = [pages]
-    for idx in range(len(pages)):
-        try:
-            add_to_access_format = pages[idx]['addToAccessFormats']
-            if add_to_access_format == 'false':
-                continue
-        except KeyError:
-            pass
+    return child.text.strip() or None
 
-        pno = pages[idx].get('pageNumber', None)
-        res.append(pno)
 
-    return res
+def _parse_int(s):
+    if s is None:
+        return None
 
+    try:
+        return int(s)
+    except ValueError:
+        return None
 
-def scandata_xml_get_dpi_per_page(xml_file):
-    scandata = xmltodict.parse(open(xml_file, 'rb'))
 
-    res = []
+def scandata_xml_get_skip_pages(xml_file):
+    return sorted(ScanData(xml_file).skip_pages)
 
-    pages = scandata['book']['pageData']['page']
 
-    # If there is just one page, pages is not a list.
-    if not isinstance(pages, list):
-        pages = [pages]
-    for idx in range(len(pages)):
-        try:
-            add_to_access_format = pages[idx]['addToAccessFormats']
-            if add_to_access_format == 'false':
-                continue
-        except KeyError:
-            pass
+def scandata_xml_get_page_numbers(xml_file):
+    return ScanData(xml_file).page_numbers
 
-        ppi = pages[idx].get('ppi', None)
-        res.append(ppi)
 
-    return res
+def scandata_xml_get_dpi_per_page(xml_file):
+    return ScanData(xml_file).dpi_pages
 
 
 def scandata_xml_get_document_dpi(xml_file):
-    scandata = xmltodict.parse(open(xml_file, 'rb'))
-
-    doc_ppi = scandata['book']['bookData'].get('dpi', None)
-
-    if doc_ppi is not None:
-        try:
-            doc_ppi = int(doc_ppi)
-        except (ValueError):
-            return None
-
-    return doc_ppi
+    return ScanData(xml_file).document_dpi
@@ -0,0 +1,110 @@
+"""
+Scratch I/O for the external codecs (kdu_*, opj_*, jbig2).
+
+These tools only operate on files, so we hand them files that live in memory:
+an anonymous memfd where the tool does not care about the filename, and a
+named file in /dev/shm where the tool picks the format based on the file
+extension. An explicit temporary directory takes precedence over /dev/shm,
+which can be small (64 MB by default in Docker containers) compared to the
+intermediate images of large pages. Without /dev/shm, the files are created
+in the system temporary directory.
+"""
+
+import os
+from contextlib import contextmanager
+from tempfile import mkstemp
+
+
+SHM_DIR = '/dev/shm'
+
+
+def scratch_dir(tmp_dir=None):
+    """
+    Returns the directory to create scratch files in.
+
+    Args:
+
+    * tmp_dir (str): Temporary directory given by the user, if any
+
+    Returns tmp_dir if it is given, otherwise SHM_DIR if it is available,
+    otherwise None (the system default).
+    """
+    if tmp_dir is not None:
+        return tmp_dir
+    if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK | os.X_OK):
+        return SHM_DIR
+    return None
+
+
+@contextmanager
+def scratch_path(prefix='', suffix='', tmp_dir=None):
+    """
+    Context manager that provides a path for a scratch file, for tools that
+    need a filename with a specific extension. The file does not exist when
+    the context is entered (Kakadu refuses to overwrite files) and is removed
+    when it is left, if it exists.
+
+    Args:
+
+    * prefix (str): Prefix of the filename
+    * suffix (str): Suffix (extension) of the filename
+    * tmp_dir (str): Directory to create the file in, see scratch_dir
+
+    Yields the path (str)
+    """
+    fd, path = mkstemp(prefix=prefix, suffix=suffix, dir=scratch_dir(tmp_dir))
+    os.close(fd)
+    os.remove(path)
+
+    try:
+        yield path
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@contextmanager
+def memory_file(data, prefix='', suffix='', tmp_dir=None):
+    """
+    Context manager that makes data available as a file to a subprocess,
+    without writing it to disk.
+
+    On Linux this is a memfd, which the subprocess can open through
+    /proc/self/fd, provided that the file descriptor is passed to it with the
+    pass_fds argument of the subprocess functions. Elsewhere, a scratch file
+    (see scratch_path) is used.
+
+    Args:
+
+    * data (bytes): File contents
+    * prefix (str): Prefix of the filename, if a scratch file is used
+    * suffix (str): Suffix of the filename, if a scratch file is used
+    * tmp_dir (str): Directory for the scratch file, see scratch_dir
+
+    Yields a tuple (path, pass_fds)
+    """
+    if hasattr(os, 'memfd_create') and os.path.isdir('/proc/self/fd'):
+        fd = os.memfd_create(prefix or 'scratch')
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            yield '/proc/self/fd/%d' % fd, (fd,)
+        finally:
+            os.close(fd)
+    else:
+        with scratch_path(prefix=prefix, suffix=suffix, tmp_dir=tmp_dir) as path:
+            fp = open(path, 'wb+')
+            fp.write(data)
+            fp.close()
+            yield path, ()
+
+
+def read_file(path):
+    """
+    Returns the contents of the file at path (bytes).
+    """
+    fp = open(path, 'rb')
+    data = fp.read()
+    fp.close()
+    return data
@@ -0,0 +1,161 @@
+"""
+On-disk cache of the MRC segmentation of pages.
+
+Segmenting a page (create_mrc_hocr_components) is the most expensive part of
+MRC compression, but its output does not depend on the compression settings
+(slopes, codecs) of the foreground and background. With this cache, re-encoding
+a book with different compression settings only has to encode the pages.
+
+Every entry is a compressed numpy archive with the bit-packed mask and the
+foreground and background arrays of a page. Entries are evicted least
+recently used first when the cache grows beyond its maximum size.
+"""
+
+import os
+import json
+import hashlib
+from os.path import join
+
+import numpy as np
+
+
+DEFAULT_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+
+class SegmentationCache(object):
+    """
+    Segmentation cache in directory path, holding at most max_size bytes.
+
+    The cache can be used from multiple processes at the same time: entries
+    are written atomically, and entries that disappear while they are being
+    read or evicted are treated as misses.
+    """
+
+    def __init__(self, path, max_size=None):
+        """
+        Args:
+
+        * path (str): Cache directory, created if it does not exist
+        * max_size (int): Maximum size of the cache in bytes (default is
+          DEFAULT_MAX_SIZE)
+        """
+        self.path = path
+        self.max_size = max_size if max_size is not None else DEFAULT_MAX_SIZE
+
+        os.makedirs(path, exist_ok=True)
+        # The maximum size might be smaller than the last time
+        self.evict()
+
+    def key(self, image_source, hocr_word_data, params):
+        """
+        Returns the cache key (str) for a page.
+
+        Args:
+
+        * image_source (str or bytes): Path to the image file or the image data
+        * hocr_word_data: OCR data about found text on the page, or the boxes
+          of its words (see internetarchivepdf.mrc.hocr_word_boxes)
+        * params (dict): JSON serialisable parameters that affect the
+          segmentation
+        """
+        h = hashlib.sha256()
+
+        if isinstance(image_source, bytes):
+            h.update(image_source)
+        else:
+            fp = open(image_source, 'rb')
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                h.update(chunk)
+            fp.close()
+
+        if isinstance(hocr_word_data, np.ndarray):
+            h.update(np.ascontiguousarray(hocr_word_data,
+                                          dtype=np.float64).tobytes())
+        else:
+            h.update(json.dumps(hocr_word_data,
+                                sort_keys=True).encode('utf-8'))
+        h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return join(self.path, key + '.npz')
+
+    def get(self, key):
+        """
+        Returns a tuple (components, errors) for key, or None if it is not in
+        the cache. components is a list of numpy arrays as yielded by
+        internetarchivepdf.recode.segment_mrc_page, errors the set of errors
+        encountered during the segmentation.
+        """
+        path = self._entry_path(key)
+        try:
+            with np.load(path) as entry:
+                shape = tuple(entry['mask_shape'])
+                mask = np.unpackbits(entry['mask'],
+                                     count=shape[0] * shape[1])
+                components = [mask.reshape(shape).astype(bool)]
+                if 'fg' in entry:
+                    components.append(entry['fg'])
+                    components.append(entry['bg'])
+                errors = set(entry['errors'].tolist())
+        except (OSError, KeyError, ValueError):
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return components, errors
+
+    def put(self, key, components, errors):
+        """
+        Stores the components (as yielded by segment_mrc_page) and errors of
+        a page under key, evicting the least recently used entries if the
+        cache becomes too large.
+        """
+        mask = components[0]
+        arrays = {'mask': np.packbits(mask),
+                  'mask_shape': np.array(mask.shape),
+                  'errors': np.array(sorted(errors), dtype=str)}
+        if len(components) > 1:
+            arrays['fg'] = components[1]
+            arrays['bg'] = components[2]
+
+        path = self._entry_path(key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        fp = open(tmp_path, 'wb+')
+        np.savez_compressed(fp, **arrays)
+        fp.close()
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is no larger
+        than its maximum size.
+        """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.npz'):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
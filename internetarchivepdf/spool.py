@@ -0,0 +1,312 @@
+"""
+Bounded-memory PDF output.
+
+Normally all compressed images of a book are kept in the fitz document until
+it is saved at the very end, so the memory use grows with the size of the
+book. ImageSpool moves the image streams of finished pages out of the
+document into a spool file, and writes the final PDF itself by copying the
+objects of the document and the raw image streams from the spool file, so
+that the memory use only depends on the amount of pages between flushes.
+
+The spool file can also hold raw streams that are copied from another PDF
+(see ImageSpool.add_stream), which fitz cannot store without decoding them.
+"""
+
+import re
+import zlib
+import hashlib
+from time import time
+from tempfile import TemporaryFile
+
+
+# Characters that end a number or name (white space and delimiters)
+_DELIMITERS = r'\s\[\]()<>{}/%'
+REFERENCE_RE = re.compile(r'(?<![^%s])(\d+)\s+(\d+)\s+R(?![^%s])' %
+                          (_DELIMITERS, _DELIMITERS))
+LENGTH_RE = re.compile(r'/Length\s+\d+(\s+\d+\s+R)?(?![^%s])' % _DELIMITERS)
+FILTER_RE = re.compile(r'/Filter(?![^%s])' % _DELIMITERS)
+DECODEPARMS_RE = re.compile(r'/DecodeParms\s*<<\s*>>')
+METADATA_RE = re.compile(r'/Type\s*/Metadata(?![^%s])' % _DELIMITERS)
+INFO_RE = re.compile(r'/Info\s+(\d+)\s+\d+\s+R')
+ID_RE = re.compile(r'/ID\s*(\[[^\]]*\])')
+
+# Start of a string, comment, dictionary or array, or the end of one
+_SYNTAX_RE = re.compile(r'<<|>>|[()<>\[\]%]')
+_HEX_STRING_END_RE = re.compile(r'>')
+_COMMENT_END_RE = re.compile(r'[\r\n]')
+
+COPY_SIZE = 1 << 20
+
+
+def _blank(source, top_level=False):
+    # Returns source (an object as returned by fitz.Document.xref_object)
+    # with strings and comments replaced by spaces, so that the regular
+    # expressions above only match actual tokens, at the same positions as in
+    # source. With top_level, everything nested in the outermost dictionary
+    # or array is blanked as well, so that only its own keys remain.
+    out = list(source)
+    depth = 0
+    nested_start = None
+    pos = 0
+    while True:
+        m = _SYNTAX_RE.search(source, pos)
+        if m is None:
+            break
+        token, start = m.group(), m.start()
+        end = m.end()
+
+        if token == '(':
+            # Literal string, with balanced parentheses and escapes
+            level = 0
+            end = start
+            while end < len(source):
+                c = source[end]
+                end += 1
+                if c == '\\':
+                    end += 1
+                elif c == '(':
+                    level += 1
+                elif c == ')':
+                    level -= 1
+                    if level == 0:
+                        break
+            end = min(end, len(source))
+            out[start:end] = ' ' * (end - start)
+        elif token == '<':
+            m = _HEX_STRING_END_RE.search(source, end)
+            end = m.end() if m is not None else len(source)
+            out[start:end] = ' ' * (end - start)
+        elif token == '%':
+            m = _COMMENT_END_RE.search(source, end)
+            end = m.start() if m is not None else len(source)
+            out[start:end] = ' ' * (end - start)
+        elif token in ('<<', '['):
+            depth += 1
+            if depth == 2:
+                nested_start = start
+        elif token in ('>>', ']'):
+            if depth == 2 and top_level:
+                out[nested_start:end] = ' ' * (end - nested_start)
+            depth -= 1
+
+        pos = end
+
+    return ''.join(out)
+
+
+def object_references(source):
+    """
+    Returns the references (xref, generation) in the object source (as
+    returned by fitz.Document.xref_object), not counting anything that looks
+    like a reference inside strings or comments.
+    """
+    return [(int(m.group(1)), int(m.group(2)))
+            for m in REFERENCE_RE.finditer(_blank(source))]
+
+
+def replace_references(source, replace):
+    """
+    Returns the object source with every reference (see object_references)
+    replaced by replace(xref, generation), a str.
+    """
+    parts = []
+    pos = 0
+    for m in REFERENCE_RE.finditer(_blank(source)):
+        parts.append(source[pos:m.start()])
+        parts.append(replace(int(m.group(1)), int(m.group(2))))
+        pos = m.end()
+    parts.append(source[pos:])
+    return ''.join(parts)
+
+
+def _zero_generations(source):
+    # ImageSpool.save writes every object with generation 0
+    return replace_references(source, lambda xref, gen: '%d 0 R' % xref)
+
+
+def _dict_end(source):
+    # Returns the position of the >> that ends the (stream) dictionary source
+    blanked = _blank(source, top_level=True)
+    end = blanked.rfind('>>')
+    if not blanked.lstrip().startswith('<<') or end < 0:
+        raise ValueError('Not a dictionary: %r' % source[:64])
+    return end
+
+
+def _deflate(source, data):
+    # Compresses the stream data of an object like
+    # fitz.Document.save(..., deflate=True) does, if it is not compressed yet
+    blanked = _blank(source, top_level=True)
+    if FILTER_RE.search(blanked) or METADATA_RE.search(blanked):
+        return source, data
+
+    m = DECODEPARMS_RE.search(_blank(source))
+    if m is not None:
+        source = source[:m.start()] + source[m.end():]
+    end = _dict_end(source)
+    return (source[:end] + '/Filter/FlateDecode' + source[end:],
+            zlib.compress(data))
+
+
+def _set_length(source, length):
+    # Sets /Length of the stream dictionary source to length
+    m = LENGTH_RE.search(_blank(source, top_level=True))
+    if m is not None:
+        return source[:m.start()] + '/Length %d' % length + source[m.end():]
+    end = _dict_end(source)
+    return source[:end] + '/Length %d' % length + source[end:]
+
+
+class ImageSpool(object):
+    """
+    Spool file for the image streams of a fitz document.
+
+    The spooled streams are replaced by a placeholder in the document, so the
+    document can only be saved with ImageSpool.save afterwards.
+    """
+
+    def __init__(self, tmp_dir=None):
+        """
+        Args:
+
+        * tmp_dir (str): Directory to create the spool file in (default is
+          the system temporary directory)
+        """
+        self.fp = TemporaryFile(prefix='spool', dir=tmp_dir)
+        # xref -> (object source, offset in spool file, length)
+        self.streams = {}
+
+    def spool_page_images(self, doc, page):
+        """
+        Move the images of page (and the images they reference, like their
+        masks) out of doc into the spool file.
+
+        Args:
+
+        * doc (fitz.Document): Document of page
+        * page (fitz.Page): Page to spool the images of
+        """
+        todo = [img[0] for img in page.getImageList()]
+        while todo:
+            xref = todo.pop()
+            if xref in self.streams:
+                continue
+
+            source = doc.xref_object(xref, compressed=True)
+            if '/Image' not in source:
+                continue
+
+            self.spool_stream(doc, xref, source=source)
+            todo.extend(ref for ref, _ in object_references(source))
+
+    def spool_stream(self, doc, xref, source=None):
+        """
+        Move the raw stream of object xref out of doc into the spool file.
+        """
+        if source is None:
+            source = doc.xref_object(xref, compressed=True)
+        self._store(doc, xref, source, doc.xref_stream_raw(xref))
+
+    def add_stream(self, doc, xref, source, data):
+        """
+        Make object xref of doc a stream object with dictionary source and
+        raw (still encoded with the filters of source) stream data, which is
+        written to the spool file right away. This is how streams are copied
+        from another PDF without decoding them: fitz.Document.update_stream
+        expects decoded data, and changes the /Filter of the object.
+
+        Args:
+
+        * doc (fitz.Document): Document of xref
+        * xref (int): Object to replace, for example from doc.get_new_xref()
+        * source (str): Stream dictionary of the object
+        * data (bytes): Raw stream data
+        """
+        doc.update_object(xref, source)
+        self._store(doc, xref, source, data, new=True)
+
+    def _store(self, doc, xref, source, data, new=False):
+        source, data = _deflate(_zero_generations(source), data)
+
+        self.fp.seek(0, 2)
+        self.streams[xref] = (source, self.fp.tell(), len(data))
+        self.fp.write(data)
+
+        # The object dictionary is kept in self.streams, so it does not
+        # matter that this changes the /Filter of the object in doc
+        doc.update_stream(xref, b' ', new=new)
+
+    def save(self, doc, path):
+        """
+        Write doc, with the spooled streams put back, to path.
+
+        Every object of doc is written as-is, except that streams that are
+        not compressed (other than XML metadata) are deflated, like
+        fitz.Document.save(..., deflate=True) does. All objects are written
+        with generation 0, and the references to them changed accordingly.
+        """
+        out = open(path, 'wb+')
+        out.write(b'%PDF-1.5\n%\xc2\xb5\xc2\xb6\n\n')
+
+        xref_count = doc.xref_length()
+        offsets = [0] * xref_count
+
+        for xref in range(1, xref_count):
+            offsets[xref] = out.tell()
+            out.write(b'%d 0 obj\n' % xref)
+
+            if xref in self.streams:
+                source, offset, length = self.streams[xref]
+                out.write(_set_length(source, length).encode('latin-1'))
+                out.write(b'\nstream\n')
+
+                self.fp.seek(offset)
+                while length > 0:
+                    chunk = self.fp.read(min(length, COPY_SIZE))
+                    out.write(chunk)
+                    length -= len(chunk)
+                out.write(b'\nendstream\nendobj\n')
+                continue
+
+            source = _zero_generations(doc.xref_object(xref, compressed=True))
+            data = doc.xref_stream_raw(xref)
+            if data is None:
+                out.write(source.encode('latin-1'))
+                out.write(b'\nendobj\n')
+                continue
+
+            source, data = _deflate(source, data)
+            out.write(_set_length(source, len(data)).encode('latin-1'))
+            out.write(b'\nstream\n')
+            out.write(data)
+            out.write(b'\nendstream\nendobj\n')
+
+        trailer = doc.pdf_trailer()
+        info = INFO_RE.search(trailer)
+        file_id = ID_RE.search(trailer)
+        if file_id is not None:
+            file_id = file_id.group(1)
+        else:
+            digest = hashlib.md5(('%s %f %d' % (path, time(),
+                                 out.tell())).encode('utf-8')).hexdigest()
+            file_id = '[<%s><%s>]' % (digest, digest)
+
+        startxref = out.tell()
+        out.write(b'xref\n0 %d\n0000000000 65535 f \n' % xref_count)
+        for xref in range(1, xref_count):
+            out.write(b'%010d 00000 n \n' % offsets[xref])
+
+        out.write(b'trailer\n<</Size %d/Root %d 0 R' % (xref_count,
+                                                       doc.pdf_catalog()))
+        if info is not None:
+            out.write(b'/Info %s 0 R' % info.group(1).encode('ascii'))
+        out.write(b'/ID%s>>\n' % file_id.encode('ascii'))
+        out.write(b'startxref\n%d\n%%%%EOF\n' % startxref)
+        out.close()
+
+    def close(self):
+        """
+        Remove the spool file.
+        """
+        self.fp.close()
+        self.streams = {}
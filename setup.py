@@ -1,4 +1,4 @@
-from setuptools import setup
+from setuptools import setup, Extension
 from distutils.util import convert_path
 
 from Cython.Build import cythonize
@@ -45,7 +45,21 @@ setup(name='archive-pdf-tools',
             'xmltodict==0.12.0',
             'archive-hocr-tools==1.1.9',
       ],
-      ext_modules=cythonize(['cython/sauvola.pyx', 'cython/optimiser.pyx'],
+      ext_modules=cythonize([
+            Extension('sauvola', ['cython/sauvola.pyx'],
+                      extra_compile_args=['-fopenmp'],
+                      extra_link_args=['-fopenmp']),
+            Extension('optimiser', ['cython/optimiser.pyx'],
+                      extra_compile_args=['-fopenmp'],
+                      extra_link_args=['-fopenmp']),
+            # Have to compute exactly what scikit-image does, so no -ffast-math
+            Extension('noise', ['cython/noise.pyx'],
+                      extra_compile_args=['-fopenmp', '-fno-fast-math'],
+                      extra_link_args=['-fopenmp']),
+            Extension('hocrmask', ['cython/hocrmask.pyx'],
+                      extra_compile_args=['-fopenmp', '-fno-fast-math'],
+                      extra_link_args=['-fopenmp']),
+            Extension('speckle', ['cython/speckle.pyx'])],
         compiler_directives={'language_level' : '3'},
       ),
       zip_safe=False,
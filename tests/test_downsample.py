@@ -0,0 +1,22 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from internetarchivepdf.recode import downsampled_size, load_mrc_page_image
+
+
+@pytest.mark.parametrize('image_format', ['JPEG2000', 'JPEG'])
+@pytest.mark.parametrize('size', [(1001, 1499), (1275, 1650)])
+@pytest.mark.parametrize('downsample', [2, 3, 4, 8])
+def test_load_mrc_page_image(image_format, size, downsample):
+    fp = BytesIO()
+    Image.new('RGB', size, (100, 150, 200)).save(fp, format=image_format)
+    data = fp.getvalue()
+
+    image = Image.open(BytesIO(data))
+    image.thumbnail((size[0] / downsample, size[1] / downsample),
+                    resample=Image.LANCZOS, reducing_gap=None)
+
+    assert downsampled_size(size, downsample) == image.size
+    assert load_mrc_page_image(data, downsample=downsample).size == image.size
@@ -0,0 +1,56 @@
+import os
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from internetarchivepdf.imageprobe import probe_image, MAX_ITEMS
+from internetarchivepdf.recode import image_file_size
+
+
+def jpeg_data(size=(40, 30)):
+    fp = BytesIO()
+    Image.new('RGB', size, 'red').save(fp, format='JPEG')
+    return fp.getvalue()
+
+
+def write_file(tmp_path, name, data):
+    path = os.path.join(str(tmp_path), name)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    return path
+
+
+@pytest.mark.parametrize('image_format,ext', [
+    ('PNG', 'png'), ('JPEG', 'jpg'), ('TIFF', 'tif'), ('JPEG2000', 'jp2'),
+    ('BMP', 'bmp')])
+def test_probe_image(tmp_path, image_format, ext):
+    path = os.path.join(str(tmp_path), 'image.' + ext)
+    Image.new('RGB', (123, 45)).save(path, format=image_format)
+
+    probe = probe_image(path)
+    assert probe.format == image_format
+    assert probe.size == (123, 45)
+    assert probe.header_valid
+
+
+def test_probe_jpeg_stray_bytes(tmp_path):
+    data = jpeg_data()
+    idx = data.index(b'\xff\xdb')
+    path = write_file(tmp_path, 'stray.jpg',
+                      data[:idx] + b'\x00\x12stray' + data[idx:])
+
+    assert probe_image(path).size == (40, 30)
+    assert Image.open(path).size == (40, 30)
+
+
+def test_image_file_size_fallback(tmp_path):
+    # More segments than the header parser looks at, which Pillow reads
+    data = jpeg_data()
+    comment = b'\xff\xfe\x00\x03x'
+    path = write_file(tmp_path, 'segments.jpg',
+                      data[:2] + comment * MAX_ITEMS + data[2:])
+
+    with pytest.raises(ValueError):
+        probe_image(path)
+    assert image_file_size(path) == (40, 30)
@@ -0,0 +1,128 @@
+from functools import lru_cache
+from io import BytesIO
+
+import numpy as np
+from scipy import ndimage
+from PIL import Image
+
+from internetarchivepdf.mrc import threshold_image3, mean_estimate_sigma, \
+        estimate_noise, NOISE_ESTIMATOR_WAVELET, NOISE_ESTIMATOR_LAPLACIAN, \
+        BLUR_NOISE_THRESHOLD, DENOISE_NOISE_THRESHOLD
+
+
+# Thresholds that create_threshold_mask used with mean_estimate_sigma
+REFERENCE_BLUR_THRESHOLD = 1.0
+REFERENCE_DENOISE_THRESHOLD = 0.1
+
+SIGMAS = [0, 0.3, 0.6, 1, 1.5, 2, 3, 5, 8, 12]
+SPECKLE_DENSITIES = [0, 0.001, 0.005, 0.01, 0.02, 0.05]
+
+# Fractions of the decisions of the laplacian estimator that may differ from
+# the reference. Its thresholds are calibrated with tools/noise-calibration,
+# where it made the same blur decision on all images, and the same denoise
+# decision on 331/372 masks (the wavelet estimate of masks is rather erratic)
+LAPLACIAN_BLUR_TOLERANCE = 0.05
+LAPLACIAN_DENOISE_TOLERANCE = 0.12
+
+
+def synthetic_page(sigma, variant, seed=0):
+    """
+    A grayscale page (a part of a 150 DPI page of tools/noise-calibration)
+    with lines of text-like blocks, blurred like a scan for the 'blur' and
+    'jpeg' variants and JPEG compressed for 'jpeg', with gaussian noise of
+    standard deviation sigma.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = 510, 660
+    margin, line_height, glyph = 30, 25, 12
+    img = np.empty((height, width), dtype=np.float64)
+    img[:] = 230 + np.arange(width) * 10. / width
+    for top in range(margin, height - margin, line_height):
+        left = margin
+        while left < width - margin - glyph:
+            for _ in range(rng.integers(1, 8)):
+                if left + glyph // 2 > width - margin:
+                    break
+                strokes = rng.random((glyph, glyph // 2)) < 0.35
+                strokes = ndimage.binary_dilation(strokes)
+                img[top:top + glyph, left:left + glyph // 2][strokes] = \
+                        rng.integers(10, 60)
+                left += glyph // 2 + 2
+            left += glyph
+
+    if variant != 'plain':
+        img = ndimage.gaussian_filter(img, sigma=0.5)
+    img += rng.normal(0, sigma, img.shape)
+    img = Image.fromarray(img.clip(0, 255).astype(np.uint8))
+
+    if variant == 'jpeg':
+        buf = BytesIO()
+        img.save(buf, format='JPEG', quality=75)
+        buf.seek(0)
+        img = Image.open(buf)
+
+    return np.array(img)
+
+
+@lru_cache(maxsize=None)
+def corpus():
+    """
+    Returns a list of (page, speckled masks of the page), thresholded like
+    create_threshold_mask does
+    """
+    pages = []
+    for sigma in SIGMAS:
+        for variant in ('plain', 'blur', 'jpeg'):
+            gray = synthetic_page(sigma, variant)
+            imgf = gray.astype(np.float32)
+
+            ref = mean_estimate_sigma(imgf)
+            if ref > REFERENCE_BLUR_THRESHOLD:
+                imgf = ndimage.gaussian_filter(imgf, sigma=ref * 0.1)
+            mask = threshold_image3(imgf.astype(np.uint8))
+
+            rng = np.random.default_rng(0)
+            masks = [mask | (rng.random(mask.shape) < density)
+                     for density in SPECKLE_DENSITIES]
+            pages.append((gray, masks))
+    return pages
+
+
+def decisions(estimator):
+    """
+    Returns the lists of (reference, estimator) blur decisions on the pages
+    and denoise decisions on the masks of the corpus
+    """
+    blur, denoise = [], []
+    for gray, masks in corpus():
+        imgf = gray.astype(np.float32)
+        arr = imgf if estimator == NOISE_ESTIMATOR_WAVELET else gray
+        blur.append((mean_estimate_sigma(imgf) > REFERENCE_BLUR_THRESHOLD,
+                     estimate_noise(arr, estimator) >
+                     BLUR_NOISE_THRESHOLD[estimator]))
+        for mask in masks:
+            denoise.append((mean_estimate_sigma(mask) >
+                            REFERENCE_DENOISE_THRESHOLD,
+                            estimate_noise(mask, estimator) >
+                            DENOISE_NOISE_THRESHOLD[estimator]))
+    return blur, denoise
+
+
+def differing(pairs):
+    return sum(ref != est for ref, est in pairs) / len(pairs)
+
+
+def test_wavelet_decisions():
+    blur, denoise = decisions(NOISE_ESTIMATOR_WAVELET)
+    # Both decisions are made either way on the corpus
+    assert len(set(ref for ref, _ in blur)) == 2
+    assert len(set(ref for ref, _ in denoise)) == 2
+
+    assert differing(blur) == 0
+    assert differing(denoise) == 0
+
+
+def test_laplacian_decisions():
+    blur, denoise = decisions(NOISE_ESTIMATOR_LAPLACIAN)
+    assert differing(blur) <= LAPLACIAN_BLUR_TOLERANCE
+    assert differing(denoise) <= LAPLACIAN_DENOISE_TOLERANCE
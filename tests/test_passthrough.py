@@ -0,0 +1,113 @@
+import os
+
+import fitz
+
+from internetarchivepdf.const import IMAGE_MODE_PASSTHROUGH
+from internetarchivepdf.passthrough import page_image_index, copy_object
+from internetarchivepdf.recode import insert_images
+from internetarchivepdf.spool import ImageSpool
+
+
+PIXELS = bytes(range(12))
+MASK = b'\xff\x80\x40\x00'
+
+# Page 1 draws image 6 (generation 1, with a soft mask), page 2 draws image 8,
+# which references a page and so cannot be copied as it is
+OBJECTS = [
+    (1, 0, b'<</Type/Catalog/Pages 2 0 R>>'),
+    (2, 0, b'<</Type/Pages/Kids[3 0 R 4 0 R]/Count 2>>'),
+    (3, 0, b'<</Type/Page/Parent 2 0 R/MediaBox[0 0 2 2]'
+           b'/Resources<</XObject<</Im0 6 1 R>>>>/Contents 5 0 R>>'),
+    (4, 0, b'<</Type/Page/Parent 2 0 R/MediaBox[0 0 2 2]'
+           b'/Resources<</XObject<</Im1 8 0 R>>>>/Contents 9 0 R>>'),
+    (5, 0, b'<</Length 26>>stream\nq 2 0 0 2 0 0 cm /Im0 Do Q\nendstream'),
+    (6, 1, b'<</Type/XObject/Subtype/Image/Width 2/Height 2'
+           b'/ColorSpace/DeviceRGB/BitsPerComponent 8/SMask 7 0 R'
+           b'/Name(not 3 0 R)/Length 12>>stream\n' + PIXELS + b'\nendstream'),
+    (7, 0, b'<</Type/XObject/Subtype/Image/Width 2/Height 2'
+           b'/ColorSpace/DeviceGray/BitsPerComponent 8/Length 4>>stream\n' +
+           MASK + b'\nendstream'),
+    (8, 0, b'<</Type/XObject/Subtype/Image/Width 2/Height 2'
+           b'/ColorSpace/DeviceRGB/BitsPerComponent 8/Page 4 0 R'
+           b'/Length 12>>stream\n' + PIXELS + b'\nendstream'),
+    (9, 0, b'<</Length 26>>stream\nq 2 0 0 2 0 0 cm /Im1 Do Q\nendstream'),
+]
+
+
+def write_pdf(path):
+    out = bytearray(b'%PDF-1.5\n')
+    offsets = {}
+    for num, gen, data in OBJECTS:
+        offsets[num] = len(out)
+        out += b'%d %d obj\n' % (num, gen) + data + b'\nendobj\n'
+
+    startxref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(OBJECTS) + 1)
+    for num, gen, _ in OBJECTS:
+        out += b'%010d %05d n \n' % (offsets[num], gen)
+    out += b'trailer\n<</Size %d/Root 1 0 R>>\nstartxref\n%d\n%%%%EOF\n' % (
+            len(OBJECTS) + 1, startxref)
+
+    with open(path, 'wb') as fp:
+        fp.write(bytes(out))
+
+
+def test_copy_object(tmp_path):
+    in_path = os.path.join(str(tmp_path), 'in.pdf')
+    write_pdf(in_path)
+    from_pdf = fitz.open(in_path)
+    assert page_image_index(from_pdf) == [6, 8]
+
+    to_pdf = fitz.open()
+    page = to_pdf.new_page(width=2, height=2)
+    spool = ImageSpool(tmp_dir=str(tmp_path))
+    xref_map = {}
+    xref = copy_object(from_pdf, to_pdf, 6, spool, xref_map)
+    assert sorted(xref_map) == [6, 7]
+    assert copy_object(from_pdf, to_pdf, 6, spool, xref_map) == xref
+    page.insert_image(page.rect, overlay=False, xref=xref)
+
+    xref_length = to_pdf.xref_length()
+    try:
+        copy_object(from_pdf, to_pdf, 8, spool, xref_map)
+    except ValueError:
+        pass
+    else:
+        assert False, 'Image referencing a page was copied'
+    assert to_pdf.xref_length() == xref_length
+    assert sorted(xref_map) == [6, 7]
+
+    out_path = os.path.join(str(tmp_path), 'out.pdf')
+    spool.save(to_pdf, out_path)
+    spool.close()
+
+    out = fitz.open(out_path)
+    assert out.xref_stream(xref) == PIXELS
+    assert out.xref_get_key(xref, 'Name') == ('string', 'not 3 0 R')
+    assert out.xref_get_key(xref, 'SMask') == ('xref',
+                                              '%d 0 R' % xref_map[7])
+    assert out.xref_stream(xref_map[7]) == MASK
+
+
+def test_insert_images_fallback(tmp_path):
+    in_path = os.path.join(str(tmp_path), 'in.pdf')
+    write_pdf(in_path)
+    from_pdf = fitz.open(in_path)
+
+    to_pdf = fitz.open()
+    for _ in range(2):
+        to_pdf.new_page(width=2, height=2)
+    spool = ImageSpool(tmp_dir=str(tmp_path))
+    insert_images(from_pdf, to_pdf, IMAGE_MODE_PASSTHROUGH, spool=spool)
+
+    out_path = os.path.join(str(tmp_path), 'out.pdf')
+    spool.save(to_pdf, out_path)
+    spool.close()
+
+    out = fitz.open(out_path)
+    for page in out:
+        images = page.getImageList()
+        assert len(images) == 1
+        pixmap = fitz.Pixmap(out, images[0][0])
+        assert (pixmap.width, pixmap.height) == (2, 2)
+        assert pixmap.samples[:12] == PIXELS
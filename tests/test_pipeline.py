@@ -0,0 +1,36 @@
+import itertools
+import threading
+
+import pytest
+
+from internetarchivepdf.recode import pipeline_map
+
+
+def double(x):
+    return x * 2
+
+
+def fail_on_five(x):
+    if x == 5:
+        raise ValueError(x)
+    return x
+
+
+@pytest.mark.parametrize('depth', [0, 1, 2])
+def test_pipeline_map(depth):
+    threads = threading.active_count()
+
+    assert list(pipeline_map([double, double], range(20), depth=depth)) == \
+        [x * 4 for x in range(20)]
+    assert threading.active_count() == threads
+
+    with pytest.raises(ValueError):
+        list(pipeline_map([fail_on_five, double, double], range(50),
+                          depth=depth))
+    assert threading.active_count() == threads
+
+    # The consumer stops early, while the stages are blocked on full queues
+    results = pipeline_map([double, double], itertools.count(), depth=depth)
+    assert [next(results) for _ in range(3)] == [0, 4, 8]
+    results.close()
+    assert threading.active_count() == threads
@@ -0,0 +1,95 @@
+import os
+import zlib
+from io import BytesIO
+
+import fitz
+from PIL import Image
+
+from internetarchivepdf.spool import ImageSpool, object_references, \
+        replace_references, _deflate, _set_length
+
+
+SOURCE = ('<</A 1 0 R/B[2 5 R 3 0 R]/T(see 4 0 R \\) (5 0 R))'
+          '/H<3420302052>/N 12 0 R>>')
+
+
+def png_image(width, height):
+    img = Image.new('RGB', (width, height))
+    img.putdata([(x % 256, y % 256, (x * y) % 256)
+                 for y in range(height) for x in range(width)])
+    fp = BytesIO()
+    img.save(fp, format='PNG')
+    return img, fp.getvalue()
+
+
+def test_object_references():
+    assert object_references(SOURCE) == [(1, 0), (2, 5), (3, 0), (12, 0)]
+    assert object_references('<</Length 10 0 R>>') == [(10, 0)]
+    assert object_references('[1 2 3 R4 5 R]') == []
+
+
+def test_replace_references():
+    assert replace_references(SOURCE, lambda xref, gen: '%d 0 R' % (xref + 1)) \
+        == ('<</A 2 0 R/B[3 0 R 4 0 R]/T(see 4 0 R \\) (5 0 R))'
+            '/H<3420302052>/N 13 0 R>>')
+
+
+def test_deflate_set_length():
+    source = '<</Subtype/Image/DecodeParms<<>>/T(/Filter>>)/S<</Length 3>>>>\n'
+    source, data = _deflate(source, b'data')
+    assert zlib.decompress(data) == b'data'
+    assert source == ('<</Subtype/Image/T(/Filter>>)/S<</Length 3>>'
+                      '/Filter/FlateDecode>>\n')
+
+    source = _set_length(source, len(data))
+    assert source == ('<</Subtype/Image/T(/Filter>>)/S<</Length 3>>'
+                      '/Filter/FlateDecode/Length %d>>\n' % len(data))
+    assert _set_length(source, 7).endswith('/Length 7>>\n')
+
+    # Compressed streams are left alone
+    source = '<</Filter /DCTDecode /Length 4>>'
+    assert _deflate(source, b'data') == (source, b'data')
+
+
+def test_save(tmp_path):
+    img, png = png_image(64, 48)
+
+    doc = fitz.open()
+    page = doc.new_page(width=64, height=48)
+    page.insert_image(page.rect, stream=png)
+    image_xref = page.getImageList()[0][0]
+
+    # An object with strings that look like references, referencing the
+    # image with a generation number other than 0
+    info_xref = doc.get_new_xref()
+    doc.update_object(info_xref, '<</Note(%d 0 R)/Image %d 1 R>>' %
+                      (image_xref, image_xref))
+
+    spool = ImageSpool(tmp_dir=str(tmp_path))
+    spool.spool_page_images(doc, page)
+
+    # A raw stream, with a dictionary that does not end in >>
+    stream_xref = doc.get_new_xref()
+    spool.add_stream(doc, stream_xref,
+                     '<</Info %d 0 R/Text(<< 1 0 R)>>\n' % info_xref,
+                     b'raw stream data')
+
+    path = os.path.join(str(tmp_path), 'out.pdf')
+    spool.save(doc, path)
+    spool.close()
+
+    out = fitz.open(path)
+    assert out.page_count == 1
+    assert not out.is_repaired
+
+    out_image = out.extractImage(out[0].getImageList()[0][0])
+    assert (out_image['width'], out_image['height']) == (64, 48)
+    out_img = Image.open(BytesIO(out_image['image'])).convert('RGB')
+    assert out_img.tobytes() == img.tobytes()
+
+    assert out.xref_object(info_xref, compressed=True) == \
+        '<</Note(%d 0 R)/Image %d 0 R>>' % (image_xref, image_xref)
+    assert out.xref_stream(stream_xref) == b'raw stream data'
+    assert out.xref_get_key(stream_xref, 'Text') == ('string', '<< 1 0 R')
+    assert out.xref_get_key(stream_xref, 'Info') == ('xref',
+                                                     '%d 0 R' % info_xref)